@@ -1,23 +1,57 @@
+import io
+import html
+import json
+import hashlib
+import math
 import os
 import random
 import re
+import csv
+import gzip
+import string
+import shutil
+import unicodedata
+import sqlite3
+import ssl
+import argparse
+import tempfile
 import aiosqlite
 import uuid
 import secrets
 import logging
 import asyncio
-from datetime import datetime
-from aiogram import Bot, Dispatcher, Router, F
+import contextvars
+import sys
+import threading
+import time
+import traceback
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from datetime import date, datetime, timedelta
+from types import SimpleNamespace
+from functools import lru_cache
+import certifi
+from aiogram import BaseMiddleware, Bot, Dispatcher, Router, F, __version__ as AIOGRAM_VERSION
 from aiogram.types import (
     Message, ReplyKeyboardMarkup, KeyboardButton,
     InlineKeyboardMarkup, InlineKeyboardButton, FSInputFile,
-    CallbackQuery
+    BufferedInputFile, CallbackQuery, InputMediaPhoto, InputMediaVideo,
+    Chat, PhotoSize, Update, User
 )
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.base import BaseSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.telegram import PRODUCTION, TelegramAPIServer
+from aiohttp import ClientSession, TCPConnector, web
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.dispatcher.flags import get_flag
 from aiogram.filters import Command
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
 from dotenv import load_dotenv
 from yookassa import Configuration, Payment
+from PIL import Image, ImageDraw, ImageFont
 
 # Настройка логирования
 logging.basicConfig(
@@ -28,11 +62,321 @@ logger = logging.getLogger(__name__)
 load_dotenv()
 
 # =============== НАСТРОЙКИ ===============
-CURRENT_YEAR = 2026
+# Год для персонального года; пусто — календарный (задаётся вручную для предпросмотра)
+YEAR_OVERRIDE = os.getenv("CURRENT_YEAR", "")
 PRICE = 999
 ADMIN_USER_ID = int(os.getenv("ADMIN_USER_ID", "0"))
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 
+# Изображение матрицы
+MATRIX_CACHE_DIR = os.getenv("MATRIX_CACHE_DIR", "media/matrix_cache")
+MATRIX_FONT_PATH = os.getenv("MATRIX_FONT_PATH", "")
+MATRIX_MEMORY_CACHE_SIZE = int(os.getenv("MATRIX_MEMORY_CACHE_SIZE", "256"))
+
+# Исполнители для тяжёлых участков (вне event loop)
+IO_WORKERS = int(os.getenv("IO_WORKERS", "8"))
+CPU_WORKERS = int(os.getenv("CPU_WORKERS", "2"))
+EXECUTOR_MAX_PENDING = int(os.getenv("EXECUTOR_MAX_PENDING", "64"))
+EXECUTOR_QUEUE_TIMEOUT = float(os.getenv("EXECUTOR_QUEUE_TIMEOUT", "5"))
+EXECUTOR_TIMEOUT = float(os.getenv("EXECUTOR_TIMEOUT", "20"))
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.5"))
+SLOW_CALLBACK_MS = float(os.getenv("SLOW_CALLBACK_MS", "200"))
+LOOP_DEBUG = os.getenv("LOOP_DEBUG", "0") == "1"
+
+# Резервные копии users.db
+BACKUP_DIR = os.getenv("BACKUP_DIR", "backups")
+BACKUP_INTERVAL_HOURS = float(os.getenv("BACKUP_INTERVAL_HOURS", "6"))
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "7"))
+BACKUP_COMPRESS = os.getenv("BACKUP_COMPRESS", "1") == "1"
+
+# Хранилище: sqlite (users.db) или postgres (DATABASE_URL, нужен asyncpg)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite")
+DATABASE_URL = os.getenv("DATABASE_URL", "")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))
+
+# Защита от флуда: "ёмкость/период в секундах" корзины токенов на пользователя
+RATE_LIMITS = {
+    "default": os.getenv("RATE_LIMIT_DEFAULT", "30/60"),
+    "report": os.getenv("RATE_LIMIT_REPORT", "3/60"),
+    "energy": os.getenv("RATE_LIMIT_ENERGY", "5/60"),
+    "name": os.getenv("RATE_LIMIT_NAME", "5/60"),
+    "payment": os.getenv("RATE_LIMIT_PAYMENT", "5/60"),
+}
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "50000"))
+
+# Ограничение параллельной обработки: всего апдейтов одновременно, очередь ожидающих
+# и сколько можно ждать; лимиты по классам хендлеров (класс — флаг rate_limit)
+GOVERNOR_CONCURRENCY = int(os.getenv("GOVERNOR_CONCURRENCY", "64"))
+GOVERNOR_MAX_QUEUE = int(os.getenv("GOVERNOR_MAX_QUEUE", "256"))
+GOVERNOR_MAX_WAIT = float(os.getenv("GOVERNOR_MAX_WAIT", "15"))
+HANDLER_CONCURRENCY = {
+    "report": int(os.getenv("CONCURRENCY_REPORT", "8")),
+    "energy": int(os.getenv("CONCURRENCY_ENERGY", "16")),
+}
+
+# Остановка: сколько ждать хендлеры в обработке; как часто рассылка сохраняет курсор
+SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", "25"))
+BROADCAST_CHECKPOINT = int(os.getenv("BROADCAST_CHECKPOINT", "50"))
+
+# Фоновый пересчёт производных полей пользователей
+RECALC_CHUNK = int(os.getenv("RECALC_CHUNK", "2000"))
+RECALC_PAUSE = float(os.getenv("RECALC_PAUSE", "0.2"))
+
+# Аналитика: кольцевой буфер событий, пакетная запись и дневные агрегаты
+ANALYTICS_BUFFER = int(os.getenv("ANALYTICS_BUFFER", "20000"))
+ANALYTICS_BATCH = int(os.getenv("ANALYTICS_BATCH", "500"))
+ANALYTICS_FLUSH_INTERVAL = float(os.getenv("ANALYTICS_FLUSH_INTERVAL", "5"))
+ANALYTICS_ROLLUP_INTERVAL = float(os.getenv("ANALYTICS_ROLLUP_INTERVAL", "600"))
+ANALYTICS_RETENTION_DAYS = int(os.getenv("ANALYTICS_RETENTION_DAYS", "30"))
+
+# DAU/WAU/MAU: HyperLogLog-скетч на день, 2^precision байт на скетч (ошибка ~1.04/sqrt(2^precision))
+HLL_PRECISION = int(os.getenv("HLL_PRECISION", "14"))
+HLL_KEEP_DAYS = int(os.getenv("HLL_KEEP_DAYS", "31"))
+HLL_FLUSH_INTERVAL = float(os.getenv("HLL_FLUSH_INTERVAL", "60"))
+
+# Запись входящего трафика для нагрузочного воспроизведения (пусто — не пишем)
+TRAFFIC_LOG = os.getenv("TRAFFIC_LOG", "")
+# Соль анонимизации id; без неё — случайная на каждый запуск
+TRAFFIC_SALT = os.getenv("TRAFFIC_SALT", "")
+# Апдейты копятся в памяти и пишутся в файл пачками раз в интервал
+TRAFFIC_BUFFER = int(os.getenv("TRAFFIC_BUFFER", "50000"))
+TRAFFIC_FLUSH_INTERVAL = float(os.getenv("TRAFFIC_FLUSH_INTERVAL", "1"))
+
+# Отправка длинных сообщений
+TELEGRAM_TEXT_LIMIT = 4096
+SEND_RETRIES = int(os.getenv("SEND_RETRIES", "3"))
+
+# Исходящие сообщения: общий лимит Bot API и темп на один чат (корзина с запасом на пачку частей отчёта)
+OUTBOUND_RATE = float(os.getenv("OUTBOUND_RATE", "30"))
+OUTBOUND_CHAT_RATE = float(os.getenv("OUTBOUND_CHAT_RATE", "1"))
+OUTBOUND_CHAT_BURST = float(os.getenv("OUTBOUND_CHAT_BURST", "10"))
+OUTBOUND_MAX_CHATS = int(os.getenv("OUTBOUND_MAX_CHATS", "50000"))
+
+# HTTP-сессия Bot API: пул соединений, keep-alive, кеш DNS, таймаут запроса
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "100"))
+HTTP_KEEPALIVE = float(os.getenv("HTTP_KEEPALIVE", "60"))
+HTTP_DNS_TTL = int(os.getenv("HTTP_DNS_TTL", "300"))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "30"))
+# Свой Bot API сервер (например, http://localhost:8081) — файлы до 2 ГБ; пусто — api.telegram.org
+BOT_API_URL = os.getenv("BOT_API_URL", "")
+BOT_API_LOCAL = os.getenv("BOT_API_LOCAL", "0") == "1"
+
+# =============== МЕТРИКИ ===============
+class Metrics:
+    """Метрики процесса: счётчики, текущие значения и скользящие окна наблюдений"""
+    def __init__(self, window: int = 2048):
+        self.counters = defaultdict(int)
+        self.gauges = {}
+        self.samples = defaultdict(lambda: deque(maxlen=window))
+
+    def inc(self, name: str, value: int = 1):
+        self.counters[name] += value
+
+    def set(self, name: str, value):
+        self.gauges[name] = value
+
+    def observe(self, name: str, value: float):
+        self.samples[name].append(value)
+
+    def percentiles(self, name: str, quantiles=(50, 95, 99)) -> dict:
+        data = sorted(self.samples.get(name, ()))
+        if not data:
+            return {}
+        result = {f"p{q}": data[min(len(data) - 1, len(data) * q // 100)] for q in quantiles}
+        result["max"] = data[-1]
+        return result
+
+    def format(self) -> str:
+        lines = []
+        for name in sorted(self.samples):
+            stats = self.percentiles(name)
+            if stats:
+                lines.append(f"• {name}: " + " / ".join(f"{k} {v:.1f}" for k, v in stats.items()))
+        for name in sorted(self.gauges):
+            value = self.gauges[name]
+            lines.append(f"• {name}: {value:.1f}" if isinstance(value, float) else f"• {name}: {value}")
+        for name in sorted(self.counters):
+            lines.append(f"• {name}: {self.counters[name]}")
+        return "\n".join(lines) if lines else "• нет данных"
+
+METRICS = Metrics()
+
+class LoopWatchdog:
+    """Следит за event loop: задача замеряет задержку планирования, а отдельный
+    поток ловит зависания и пишет в лог стек того, что блокирует loop"""
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL, threshold_ms: float = SLOW_CALLBACK_MS):
+        self.interval = interval
+        self.threshold = threshold_ms / 1000
+        self._last_tick = time.monotonic()
+        self._loop_thread_id = None
+        self._task = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        if LOOP_DEBUG:
+            loop.set_debug(True)
+            loop.slow_callback_duration = self.threshold
+        self._last_tick = time.monotonic()
+        self._task = asyncio.create_task(self._measure())
+        self._thread = threading.Thread(target=self._sample, name="loop-watchdog", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._task:
+            self._task.cancel()
+
+    async def _measure(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            lag_ms = max(loop.time() - started - self.interval, 0.0) * 1000
+            METRICS.observe("loop_lag_ms", lag_ms)
+            self._last_tick = time.monotonic()
+
+    def _sample(self):
+        reported_tick = None
+        while not self._stop.wait(self.threshold / 2):
+            tick = self._last_tick
+            stalled = time.monotonic() - tick - self.interval
+            if stalled < self.threshold or tick == reported_tick:
+                continue
+            reported_tick = tick
+            METRICS.inc("loop_stalls")
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame else "<нет стека>"
+            logger.warning(f"Event loop blocked for {stalled * 1000:.0f} ms:\n{stack}")
+
+    def summary(self) -> str:
+        stats = METRICS.percentiles("loop_lag_ms")
+        if not stats:
+            return "нет данных"
+        return (
+            f"p50 {stats['p50']:.1f} / p95 {stats['p95']:.1f} / p99 {stats['p99']:.1f} / "
+            f"max {stats['max']:.1f} мс, зависаний: {METRICS.counters['loop_stalls']}"
+        )
+
+WATCHDOG = LoopWatchdog()
+
+# =============== ИСПОЛНИТЕЛИ ===============
+class ExecutorBusy(Exception):
+    """Очередь исполнителя переполнена"""
+
+class BoundedExecutor:
+    """Пул потоков или процессов с ограниченной очередью, ожиданием слота и таймаутом"""
+    def __init__(self, name: str, pool_factory, max_pending: int = EXECUTOR_MAX_PENDING,
+                 queue_timeout: float = EXECUTOR_QUEUE_TIMEOUT, timeout: float = EXECUTOR_TIMEOUT):
+        self.name = name
+        self.pool_factory = pool_factory
+        self.max_pending = max_pending
+        self.queue_timeout = queue_timeout
+        self.timeout = timeout
+        self._pool = None
+        self._slots = asyncio.Semaphore(max_pending)
+        self._pending = 0
+        self._waiting = 0
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            self._pool = self.pool_factory()
+        return self._pool
+
+    async def _acquire(self):
+        if not self._slots.locked():
+            await self._slots.acquire()
+            return
+        if self._waiting >= self.max_pending:
+            METRICS.inc(f"executor_{self.name}_rejected")
+            raise ExecutorBusy(self.name)
+        self._waiting += 1
+        queued = time.perf_counter()
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            METRICS.inc(f"executor_{self.name}_rejected")
+            raise ExecutorBusy(self.name)
+        finally:
+            self._waiting -= 1
+        METRICS.observe(f"executor_{self.name}_wait_ms", (time.perf_counter() - queued) * 1000)
+
+    def _release(self):
+        self._pending -= 1
+        METRICS.set(f"executor_{self.name}_pending", self._pending)
+        self._slots.release()
+
+    async def run(self, fn, *args):
+        await self._acquire()
+        self._pending += 1
+        METRICS.set(f"executor_{self.name}_pending", self._pending)
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        try:
+            future = self.pool.submit(fn, *args)
+        except Exception:
+            self._release()
+            raise
+        # Слот освобождается, только когда задача действительно завершилась,
+        # даже если ожидающий уже отвалился по таймауту
+        future.add_done_callback(lambda _: loop.is_closed() or loop.call_soon_threadsafe(self._release))
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+        except asyncio.TimeoutError:
+            METRICS.inc(f"executor_{self.name}_timeouts")
+            raise
+        finally:
+            METRICS.observe(f"executor_{self.name}_run_ms", (time.perf_counter() - started) * 1000)
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+IO_EXECUTOR = BoundedExecutor("io", lambda: ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="report-io"))
+CPU_EXECUTOR = BoundedExecutor("cpu", lambda: ProcessPoolExecutor(max_workers=CPU_WORKERS))
+
+def shutdown_executors():
+    IO_EXECUTOR.shutdown()
+    CPU_EXECUTOR.shutdown()
+
+class SingleFlight:
+    """Склеивает одновременные одинаковые вычисления: пока результат по ключу считается,
+    остальные вызовы ждут тот же future. Это не кэш — после завершения ключ освобождается."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._flights = {}
+
+    def _forget(self, key, future):
+        self._flights.pop(key, None)
+        # Ошибку получат ожидающие; если их не осталось — не засоряем лог "never retrieved"
+        if not future.cancelled():
+            future.exception()
+
+    async def run(self, key, fn, *args):
+        """fn — корутинная функция; отмена одного ожидающего не отменяет общее вычисление"""
+        future = self._flights.get(key)
+        if future is None:
+            METRICS.inc(f"flight_{self.name}_calls")
+            future = asyncio.ensure_future(fn(*args))
+            self._flights[key] = future
+            future.add_done_callback(lambda f: self._forget(key, f))
+        else:
+            METRICS.inc(f"flight_{self.name}_coalesced")
+        return await asyncio.shield(future)
+
+def flight_key(*parts) -> str:
+    """Ключ по входным данным вычисления (списки и словари — через JSON)"""
+    return json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+
+REPORT_FLIGHT = SingleFlight("report")
+NARRATIVE_FLIGHT = SingleFlight("narrative")
+MATRIX_FLIGHT = SingleFlight("matrix")
+
 # YooKassa
 Configuration.account_id = os.getenv("YOOKASSA_SHOP_ID")
 Configuration.secret_key = os.getenv("YOOKASSA_SECRET_KEY")
@@ -40,138 +384,522 @@ Configuration.secret_key = os.getenv("YOOKASSA_SECRET_KEY")
 # =============== БАЗА ДАННЫХ ===============
 DB_PATH = "users.db"
 
-async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            user_id INTEGER PRIMARY KEY,
-            username TEXT,
-            full_name TEXT,
-            birth_date TEXT,
-            status TEXT DEFAULT 'free',
-            archetype TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-        """)
-        await db.execute("""
-        CREATE TABLE IF NOT EXISTS premium_codes (
-            code TEXT PRIMARY KEY,
-            used_by INTEGER,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            used_at TIMESTAMP
-        )
-        """)
-        await db.execute("""
-        CREATE TABLE IF NOT EXISTS user_sessions (
-            user_id INTEGER,
-            session_count INTEGER DEFAULT 1,
-            last_active TIMESTAMP,
-            PRIMARY KEY (user_id)
-        )
-        """)
-        await db.execute("""
-        CREATE TABLE IF NOT EXISTS user_achievements (
-            user_id INTEGER,
-            achievement_id TEXT,
-            unlocked_at TIMESTAMP,
-            PRIMARY KEY (user_id, achievement_id)
-        )
-        """)
-        await db.execute("""
-        CREATE TABLE IF NOT EXISTS user_progress (
-            user_id INTEGER PRIMARY KEY,
-            total_sessions INTEGER DEFAULT 0,
-            insights_received INTEGER DEFAULT 0
-        )
-        """)
-        await db.commit()
-
-async def save_user(user_id: int, username: str, full_name: str, status: str = "free", birth_date: str = None, archetype: str = None):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            """INSERT OR REPLACE INTO users
-            (user_id, username, full_name, status, birth_date, archetype)
-            VALUES (?, ?, ?, ?, ?, ?)""",
-            (user_id, username, full_name, status, birth_date, archetype)
+def utc_now() -> str:
+    """Текущее время в формате CURRENT_TIMESTAMP SQLite — одинаково для обоих бэкендов"""
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+
+# Дневные агрегаты аналитики (одинаковы для обоих бэкендов): по событию и удержание когорт по дню регистрации
+ANALYTICS_SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS daily_events (
+        day TEXT,
+        event TEXT,
+        events INTEGER,
+        users INTEGER,
+        PRIMARY KEY (day, event)
+    )""",
+    """CREATE TABLE IF NOT EXISTS retention (
+        cohort_day TEXT,
+        day TEXT,
+        users INTEGER,
+        PRIMARY KEY (cohort_day, day)
+    )""",
+)
+
+SQLITE_SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY,
+        username TEXT,
+        full_name TEXT,
+        birth_date TEXT,
+        status TEXT DEFAULT 'free',
+        archetype TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        person_num INTEGER,
+        personal_year INTEGER,
+        profile_year INTEGER,
+        matrix_mask INTEGER,
+        mind INTEGER,
+        action INTEGER,
+        realization INTEGER,
+        destiny_lesson INTEGER,
+        karmic_mask INTEGER,
+        soul_urge INTEGER,
+        personality INTEGER
+    )""",
+    """CREATE TABLE IF NOT EXISTS premium_codes (
+        code TEXT PRIMARY KEY,
+        used_by INTEGER,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        used_at TIMESTAMP,
+        batch_tag TEXT
+    )""",
+    """CREATE TABLE IF NOT EXISTS user_sessions (
+        user_id INTEGER,
+        session_count INTEGER DEFAULT 1,
+        last_active TIMESTAMP,
+        PRIMARY KEY (user_id)
+    )""",
+    """CREATE TABLE IF NOT EXISTS user_achievements (
+        user_id INTEGER,
+        achievement_id TEXT,
+        unlocked_at TIMESTAMP,
+        PRIMARY KEY (user_id, achievement_id)
+    )""",
+    """CREATE TABLE IF NOT EXISTS user_progress (
+        user_id INTEGER PRIMARY KEY,
+        total_sessions INTEGER DEFAULT 0,
+        insights_received INTEGER DEFAULT 0
+    )""",
+    """CREATE TABLE IF NOT EXISTS job_state (
+        name TEXT PRIMARY KEY,
+        target TEXT,
+        cursor INTEGER DEFAULT 0,
+        status TEXT,
+        updated_at TIMESTAMP
+    )""",
+    """CREATE TABLE IF NOT EXISTS activity_sketches (
+        day TEXT PRIMARY KEY,
+        registers BLOB,
+        updated_at TIMESTAMP
+    )""",
+    """CREATE TABLE IF NOT EXISTS events (
+        id INTEGER PRIMARY KEY,
+        day TEXT NOT NULL,
+        created_at TIMESTAMP,
+        user_id INTEGER,
+        event TEXT NOT NULL
+    )""",
+    *ANALYTICS_SCHEMA,
+)
+
+# Производные поля users, которые пересчитывает фоновая задача (добавляются и в старые базы)
+USER_DERIVED_COLUMNS = (
+    ("person_num", "INTEGER"),
+    ("personal_year", "INTEGER"),
+    ("profile_year", "INTEGER"),
+    # 9 цифр по 4 бита — не помещается в 32-битный INTEGER Postgres
+    ("matrix_mask", "BIGINT"),
+    ("mind", "INTEGER"),
+    ("action", "INTEGER"),
+    ("realization", "INTEGER"),
+    ("destiny_lesson", "INTEGER"),
+    ("karmic_mask", "INTEGER"),
+    ("soul_urge", "INTEGER"),
+    ("personality", "INTEGER"),
+)
+
+# Кармические долги в karmic_mask: число -> бит
+KARMIC_BITS = {13: 1, 14: 2, 16: 4, 19: 8}
+# Колонки, по которым строятся сегменты рассылки (у каждой свой индекс)
+SEGMENT_COLUMNS = {
+    "mind": "mind",
+    "action": "action",
+    "realization": "realization",
+    "destiny": "destiny_lesson",
+    "soul": "soul_urge",
+    "personality": "personality",
+    "year": "personal_year",
+}
+
+# Время в Postgres храним тем же текстом, что и SQLite: курсоры пагинации и выгрузки не зависят от бэкенда
+PG_NOW = "to_char(now() AT TIME ZONE 'UTC', 'YYYY-MM-DD HH24:MI:SS')"
+POSTGRES_SCHEMA = (
+    f"""CREATE TABLE IF NOT EXISTS users (
+        user_id BIGINT PRIMARY KEY,
+        username TEXT,
+        full_name TEXT,
+        birth_date TEXT,
+        status TEXT DEFAULT 'free',
+        archetype TEXT,
+        created_at TEXT DEFAULT {PG_NOW}
+    )""",
+    f"""CREATE TABLE IF NOT EXISTS premium_codes (
+        code TEXT PRIMARY KEY,
+        used_by BIGINT,
+        created_at TEXT DEFAULT {PG_NOW},
+        used_at TEXT,
+        batch_tag TEXT
+    )""",
+    "ALTER TABLE premium_codes ADD COLUMN IF NOT EXISTS batch_tag TEXT",
+    *(f"ALTER TABLE users ADD COLUMN IF NOT EXISTS {column} {declaration}" for column, declaration in USER_DERIVED_COLUMNS),
+    # matrix_mask занимает 36 бит; ALTER переписывает таблицу под эксклюзивной блокировкой —
+    # только для баз, где колонка создана как INTEGER
+    """DO $$ BEGIN
+        IF EXISTS (
+            SELECT 1 FROM information_schema.columns
+            WHERE table_schema = current_schema() AND table_name = 'users'
+            AND column_name = 'matrix_mask' AND data_type = 'integer'
+        ) THEN
+            ALTER TABLE users ALTER COLUMN matrix_mask TYPE BIGINT;
+        END IF;
+    END $$""",
+    """CREATE TABLE IF NOT EXISTS user_sessions (
+        user_id BIGINT PRIMARY KEY,
+        session_count INTEGER DEFAULT 1,
+        last_active TEXT
+    )""",
+    """CREATE TABLE IF NOT EXISTS user_achievements (
+        user_id BIGINT,
+        achievement_id TEXT,
+        unlocked_at TEXT,
+        PRIMARY KEY (user_id, achievement_id)
+    )""",
+    """CREATE TABLE IF NOT EXISTS user_progress (
+        user_id BIGINT PRIMARY KEY,
+        total_sessions INTEGER DEFAULT 0,
+        insights_received INTEGER DEFAULT 0
+    )""",
+    """CREATE TABLE IF NOT EXISTS job_state (
+        name TEXT PRIMARY KEY,
+        target TEXT,
+        cursor BIGINT DEFAULT 0,
+        status TEXT,
+        updated_at TEXT
+    )""",
+    """CREATE TABLE IF NOT EXISTS activity_sketches (
+        day TEXT PRIMARY KEY,
+        registers BYTEA,
+        updated_at TEXT
+    )""",
+    """CREATE TABLE IF NOT EXISTS events (
+        id BIGSERIAL PRIMARY KEY,
+        day TEXT NOT NULL,
+        created_at TEXT,
+        user_id BIGINT,
+        event TEXT NOT NULL
+    )""",
+    *ANALYTICS_SCHEMA,
+)
+
+# Индексы под постраничный просмотр в админ-панели (keyset-пагинация); синтаксис общий для обоих бэкендов
+SCHEMA_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS idx_premium_codes_created ON premium_codes(created_at, code)",
+    "CREATE INDEX IF NOT EXISTS idx_premium_codes_unused ON premium_codes(created_at, code) WHERE used_by IS NULL",
+    "CREATE INDEX IF NOT EXISTS idx_premium_codes_used ON premium_codes(used_at, code) WHERE used_by IS NOT NULL",
+    "CREATE INDEX IF NOT EXISTS idx_users_status ON users(status)",
+    "CREATE INDEX IF NOT EXISTS idx_users_username_lower ON users(lower(username))",
+    "CREATE INDEX IF NOT EXISTS idx_premium_codes_used_by ON premium_codes(used_by)",
+    # Свёртка аналитики читает события одного дня и регистрации одного дня
+    "CREATE INDEX IF NOT EXISTS idx_events_day ON events(day, event, user_id)",
+    "CREATE INDEX IF NOT EXISTS idx_users_created ON users(created_at)",
+    # Сегменты рассылки: равенство по числу или архетипу, кармические долги — частичными индексами по биту
+    *(f"CREATE INDEX IF NOT EXISTS idx_users_{column} ON users({column})" for column in (*SEGMENT_COLUMNS.values(), "archetype")),
+    *(f"CREATE INDEX IF NOT EXISTS idx_users_karmic_{debt} ON users(user_id) WHERE (karmic_mask & {bit}) != 0"
+      for debt, bit in KARMIC_BITS.items()),
+)
+
+async def ensure_column(db, table: str, column: str, declaration: str):
+    """Добавляет колонку в уже существующую таблицу (миграция старых баз)"""
+    cursor = await db.execute(f"PRAGMA table_info({table})")
+    if column not in [row[1] for row in await cursor.fetchall()]:
+        await db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {declaration}")
+
+class Database:
+    """Общий API бэкендов: запросы с плейсхолдерами ?, строки-кортежи, транзакции.
+    Одиночные запросы берут соединение из пула на время вызова."""
+    dialect = ""
+
+    async def fetchone(self, sql: str, params: tuple = ()):
+        async with self.acquire() as conn:
+            return await conn.fetchone(sql, params)
+
+    async def fetchall(self, sql: str, params: tuple = ()):
+        async with self.acquire() as conn:
+            return await conn.fetchall(sql, params)
+
+    async def fetchval(self, sql: str, params: tuple = ()):
+        async with self.acquire() as conn:
+            return await conn.fetchval(sql, params)
+
+    async def execute(self, sql: str, params: tuple = ()) -> int:
+        async with self.acquire() as conn:
+            return await conn.execute(sql, params)
+
+    async def executemany(self, sql: str, rows: list):
+        async with self.acquire() as conn:
+            await conn.executemany(sql, rows)
+
+class SqliteConnection:
+    dialect = "sqlite"
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    async def fetchone(self, sql: str, params: tuple = ()):
+        cursor = await self.conn.execute(sql, params)
+        return await cursor.fetchone()
+
+    async def fetchall(self, sql: str, params: tuple = ()):
+        cursor = await self.conn.execute(sql, params)
+        return await cursor.fetchall()
+
+    async def fetchval(self, sql: str, params: tuple = ()):
+        row = await self.fetchone(sql, params)
+        return row[0] if row else None
+
+    async def execute(self, sql: str, params: tuple = ()) -> int:
+        """Возвращает число затронутых строк"""
+        before = self.conn.total_changes
+        await self.conn.execute(sql, params)
+        return self.conn.total_changes - before
+
+    async def executemany(self, sql: str, rows: list):
+        await self.conn.executemany(sql, rows)
+
+    @staticmethod
+    def text_list(values: list) -> tuple:
+        """Подзапрос, разворачивающий список строк из одного параметра"""
+        return "SELECT value FROM json_each(?)", json.dumps(list(values))
+
+class SqliteDatabase(Database):
+    """Пул соединений aiosqlite в автокоммите; WAL пускает читателей параллельно с записью"""
+    dialect = "sqlite"
+
+    def __init__(self, path: str, pool_size: int):
+        self.path = path
+        self.pool_size = max(1, pool_size)
+        self._pool = asyncio.Queue()
+        self._connections = []
+
+    async def open(self):
+        for _ in range(self.pool_size):
+            conn = await aiosqlite.connect(self.path, isolation_level=None)
+            await conn.execute("PRAGMA journal_mode=WAL")
+            await conn.execute("PRAGMA busy_timeout=5000")
+            self._connections.append(conn)
+            self._pool.put_nowait(conn)
+        async with self.acquire() as conn:
+            for statement in SQLITE_SCHEMA:
+                await conn.execute(statement)
+            await ensure_column(conn.conn, "premium_codes", "batch_tag", "TEXT")
+            for column, declaration in USER_DERIVED_COLUMNS:
+                await ensure_column(conn.conn, "users", column, declaration)
+            # Поиск по username теперь через lower(), понятный обоим бэкендам
+            await conn.execute("DROP INDEX IF EXISTS idx_users_username")
+            for statement in SCHEMA_INDEXES:
+                await conn.execute(statement)
+
+    async def close(self):
+        for conn in self._connections:
+            await conn.close()
+        self._connections.clear()
+
+    @asynccontextmanager
+    async def acquire(self):
+        conn = await self._pool.get()
+        try:
+            yield SqliteConnection(conn)
+        finally:
+            self._pool.put_nowait(conn)
+
+    @asynccontextmanager
+    async def transaction(self):
+        """BEGIN IMMEDIATE сразу берёт блокировку записи — без гонок между проверкой и обновлением.
+        BEGIN и COMMIT внутри try: отменённый await не останавливает запрос в потоке aiosqlite,
+        поэтому ROLLBACK (он выполнится после них) нужен всегда, иначе соединение вернётся
+        в пул с открытой транзакцией."""
+        async with self.acquire() as conn:
+            try:
+                await conn.conn.execute("BEGIN IMMEDIATE")
+                yield conn
+                await conn.conn.execute("COMMIT")
+            except BaseException:
+                await asyncio.shield(self._rollback(conn.conn))
+                raise
+
+    @staticmethod
+    async def _rollback(conn):
+        try:
+            await conn.execute("ROLLBACK")
+        except sqlite3.OperationalError:
+            # BEGIN не выполнился (база занята) или COMMIT уже прошёл — откатывать нечего
+            pass
+
+@lru_cache(maxsize=512)
+def pg_placeholders(sql: str) -> str:
+    """? -> $1, $2, ... (в наших запросах ? не встречается внутри строковых литералов)"""
+    parts = sql.split("?")
+    return parts[0] + "".join(f"${i}{part}" for i, part in enumerate(parts[1:], 1))
+
+class PostgresConnection:
+    dialect = "postgres"
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    async def fetchone(self, sql: str, params: tuple = ()):
+        row = await self.conn.fetchrow(pg_placeholders(sql), *params)
+        return tuple(row) if row else None
+
+    async def fetchall(self, sql: str, params: tuple = ()):
+        return [tuple(row) for row in await self.conn.fetch(pg_placeholders(sql), *params)]
+
+    async def fetchval(self, sql: str, params: tuple = ()):
+        return await self.conn.fetchval(pg_placeholders(sql), *params)
+
+    async def execute(self, sql: str, params: tuple = ()) -> int:
+        """Возвращает число затронутых строк из статуса команды ("UPDATE 3", "INSERT 0 1")"""
+        status = await self.conn.execute(pg_placeholders(sql), *params)
+        count = status.rsplit(" ", 1)[-1]
+        return int(count) if count.isdigit() else 0
+
+    async def executemany(self, sql: str, rows: list):
+        await self.conn.executemany(pg_placeholders(sql), rows)
+
+    @staticmethod
+    def text_list(values: list) -> tuple:
+        return "SELECT unnest(?::text[]) AS value", list(values)
+
+class PostgresDatabase(Database):
+    """Пул asyncpg; запросы с параметрами идут через кэш подготовленных выражений соединения"""
+    dialect = "postgres"
+
+    def __init__(self, dsn: str, pool_size: int):
+        self.dsn = dsn
+        self.pool_size = max(1, pool_size)
+        self.pool = None
+
+    async def open(self):
+        try:
+            import asyncpg
+        except ImportError:
+            raise RuntimeError("Для STORAGE_BACKEND=postgres установите пакет asyncpg")
+        if not self.dsn:
+            raise RuntimeError("Для STORAGE_BACKEND=postgres задайте DATABASE_URL")
+        self.pool = await asyncpg.create_pool(
+            self.dsn, min_size=1, max_size=self.pool_size, statement_cache_size=256
         )
-        await db.commit()
+        async with self.acquire() as conn:
+            for statement in POSTGRES_SCHEMA + SCHEMA_INDEXES:
+                await conn.execute(statement)
 
-async def update_user_session(user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("SELECT session_count FROM user_sessions WHERE user_id = ?", (user_id,))
-        row = await cursor.fetchone()
-        if row:
-            await db.execute(
-                "UPDATE user_sessions SET session_count = session_count + 1, last_active = datetime('now') WHERE user_id = ?",
-                (user_id,)
-            )
+    async def close(self):
+        if self.pool:
+            await self.pool.close()
+            self.pool = None
+
+    @asynccontextmanager
+    async def acquire(self):
+        async with self.pool.acquire() as conn:
+            yield PostgresConnection(conn)
+
+    @asynccontextmanager
+    async def transaction(self):
+        """Построчные блокировки Postgres сериализуют конкурирующие условные UPDATE"""
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                yield PostgresConnection(conn)
+
+# =============== РЕПОЗИТОРИИ ===============
+# Методы, которые могут участвовать в чужой транзакции, принимают tx (иначе — отдельный запрос)
+PROMO_ALPHABET = string.ascii_uppercase + string.digits
+PROMO_BATCH_MAX = int(os.getenv("PROMO_BATCH_MAX", "10000"))
+
+def make_premium_code() -> str:
+    # Только A-Z и 0-9 — под формат, который принимает process_promo_code
+    return "MATRIX-" + "-".join(
+        "".join(secrets.choice(PROMO_ALPHABET) for _ in range(3)) for _ in range(3)
+    )
+
+ADMIN_PAGE_SIZE = int(os.getenv("ADMIN_PAGE_SIZE", "10"))
+
+# фильтр -> (условие, колонка сортировки); условия совпадают с частичными индексами
+PROMO_PAGE_FILTERS = {
+    "a": ("", "created_at"),
+    "f": ("pc.used_by IS NULL", "created_at"),
+    "u": ("pc.used_by IS NOT NULL", "used_at"),
+}
+USER_PAGE_FILTERS = {"a": None, "f": "free", "p": "paid"}
+SEGMENT_ARCHETYPES = {
+    "воин": "⚔️ Воин Духа",
+    "хранитель": "📚 Хранитель Знаний",
+    "создатель": "🎨 Создатель",
+    "целитель": "💚 Целитель",
+}
+
+def build_segment(segment: str) -> tuple:
+    """'mind=7 karmic=13 status=paid' -> (условие WHERE, параметры).
+    Каждое условие попадает в индекс; кармический бит подставляется литералом,
+    иначе планировщик не сопоставит его с частичным индексом."""
+    conditions, params = [], []
+    for token in segment.replace(",", " ").split():
+        key, sep, value = token.partition("=")
+        key, value = key.lower(), value.lower()
+        if not sep or not value:
+            raise ValueError(f"Ожидается ключ=значение: {token}")
+        if key in SEGMENT_COLUMNS:
+            if not value.isdigit() or not 1 <= int(value) <= 9:
+                raise ValueError(f"{key}: число от 1 до 9")
+            conditions.append(f"{SEGMENT_COLUMNS[key]} = ?")
+            params.append(int(value))
+        elif key == "karmic":
+            bit = KARMIC_BITS.get(int(value)) if value.isdigit() else None
+            if not bit:
+                raise ValueError("karmic: 13, 14, 16 или 19")
+            conditions.append(f"(karmic_mask & {bit}) != 0")
+        elif key == "status":
+            if value not in ("free", "paid"):
+                raise ValueError("status: free или paid")
+            conditions.append("status = ?")
+            params.append(value)
+        elif key == "archetype":
+            if value not in SEGMENT_ARCHETYPES:
+                raise ValueError(f"archetype: {', '.join(SEGMENT_ARCHETYPES)}")
+            conditions.append("archetype = ?")
+            params.append(SEGMENT_ARCHETYPES[value])
         else:
-            await db.execute(
-                "INSERT INTO user_sessions (user_id, last_active) VALUES (?, datetime('now'))",
-                (user_id,)
-            )
-        await db.execute("""
-        INSERT INTO user_progress (user_id, total_sessions)
-        VALUES (?, 1)
-        ON CONFLICT(user_id) DO UPDATE SET
-        total_sessions = total_sessions + 1
-        """, (user_id,))
-        await db.commit()
+            raise ValueError(f"Неизвестный ключ: {key}")
+    if not conditions:
+        raise ValueError("Пустой сегмент")
+    return " AND ".join(conditions), params
 
-# =============== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ===============
-async def get_all_users():
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("SELECT user_id FROM users")
-        return [row[0] for row in await cursor.fetchall()]
-
-async def get_users_by_status(status: str):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("SELECT user_id FROM users WHERE status = ?", (status,))
-        return [row[0] for row in await cursor.fetchall()]
-
-async def generate_premium_code():
-    code = "MATRIX-" + "-".join([
-        secrets.token_urlsafe(3)[:3].upper(),
-        secrets.token_urlsafe(3)[:3].upper(),
-        secrets.token_urlsafe(3)[:3].upper()
-    ])
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("SELECT 1 FROM premium_codes WHERE code = ?", (code,))
-        if await cursor.fetchone():
-            return await generate_premium_code()
-    return code
-
-async def save_premium_code(code: str):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("INSERT OR IGNORE INTO premium_codes (code) VALUES (?)", (code,))
-        await db.commit()
-
-async def use_premium_code(code: str, user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("SELECT used_by FROM premium_codes WHERE code = ?", (code,))
-        result = await cursor.fetchone()
-        if not result or result[0] is not None:
-            return False
-        await db.execute(
-            "UPDATE premium_codes SET used_by = ?, used_at = datetime('now') WHERE code = ?",
-            (user_id, code)
+def finish_page(rows: list, direction: str, limit: int):
+    """Отрезает лишнюю строку-признак «есть ещё» и возвращает страницу в прямом порядке"""
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if direction == "p":
+        rows.reverse()
+    return rows, has_more
+
+class UserRepo:
+    def __init__(self, db: Database):
+        self.db = db
+
+    async def save(self, user_id: int, username: str, full_name: str, status: str = "free", birth_date: str = None, archetype: str = None):
+        # Производные поля считаются один раз — при сохранении даты рождения
+        year = numerology_year()
+        derived = [None] * len(DERIVED_FIELDS)
+        if birth_date:
+            derived = list(derive_fields(birth_date, full_name, year))
+            derived[DERIVED_FIELDS.index("archetype")] = archetype
+        columns = ", ".join(DERIVED_FIELDS)
+        updates = ", ".join(f"{column} = excluded.{column}" for column in DERIVED_FIELDS)
+        await self.db.execute(
+            f"""INSERT INTO users (user_id, username, full_name, status, birth_date, profile_year, {columns})
+            VALUES ({", ".join("?" * (6 + len(DERIVED_FIELDS)))})
+            ON CONFLICT(user_id) DO UPDATE SET
+            username = excluded.username, full_name = excluded.full_name, status = excluded.status,
+            birth_date = excluded.birth_date, profile_year = excluded.profile_year, {updates}""",
+            (user_id, username, full_name, status, birth_date, year if birth_date else None, *derived)
         )
-        await db.commit()
-        return True
 
-async def get_user_status(user_id: int) -> str:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("SELECT status FROM users WHERE user_id = ?", (user_id,))
-        row = await cursor.fetchone()
-        return row[0] if row else "free"
+    async def register(self, user_id: int, username: str, full_name: str, tx=None) -> tuple:
+        """Вход через /start: создаёт пользователя или обновляет только username.
+        Статус, дату рождения и введённое для расчёта имя не трогает; возвращает (has_data, status)."""
+        row = await (tx or self.db).fetchone(
+            """INSERT INTO users (user_id, username, full_name) VALUES (?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET
+            username = excluded.username, full_name = COALESCE(users.full_name, excluded.full_name)
+            RETURNING birth_date IS NOT NULL AND full_name IS NOT NULL, status""",
+            (user_id, username, full_name)
+        )
+        return bool(row[0]), row[1]
 
-async def get_user_data(user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute(
+    async def get(self, user_id: int):
+        row = await self.db.fetchone(
             "SELECT username, full_name, birth_date, status, archetype FROM users WHERE user_id = ?",
             (user_id,)
         )
-        row = await cursor.fetchone()
         if row:
             return {
                 "username": row[0],
@@ -182,15 +910,616 @@ async def get_user_data(user_id: int):
             }
         return None
 
-async def user_has_data(user_id: int) -> bool:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute(
-            "SELECT birth_date, full_name FROM users WHERE user_id = ? AND birth_date IS NOT NULL AND full_name IS NOT NULL",
+    async def get_status(self, user_id: int) -> str:
+        return await self.db.fetchval("SELECT status FROM users WHERE user_id = ?", (user_id,)) or "free"
+
+    async def get_birth_date(self, user_id: int):
+        return await self.db.fetchval("SELECT birth_date FROM users WHERE user_id = ?", (user_id,))
+
+    async def get_person_num(self, user_id: int):
+        row = await self.db.fetchone("SELECT person_num, birth_date FROM users WHERE user_id = ?", (user_id,))
+        if not row or not row[1]:
+            return None
+        # В базе до появления колонки число пусто, пока до пользователя не дойдёт пересчёт
+        return row[0] or person_number(row[1])
+
+    async def birth_dates_after(self, cursor: int, limit: int) -> list:
+        """Следующая пачка (user_id, birth_date, full_name) по возрастанию user_id — для пакетных задач"""
+        return await self.db.fetchall(
+            """SELECT user_id, birth_date, full_name FROM users
+            WHERE user_id > ? AND birth_date IS NOT NULL
+            ORDER BY user_id
+            LIMIT ?""",
+            (cursor, limit)
+        )
+
+    async def update_derived(self, rows: list, tx=None):
+        """rows: (*DERIVED_FIELDS, profile_year, user_id, birth_date, full_name).
+        Строка применяется, только если дата и имя не изменились с момента чтения —
+        иначе пересчёт затёр бы свежие значения, сохранённые save()."""
+        assignments = ", ".join(f"{column} = ?" for column in (*DERIVED_FIELDS, "profile_year"))
+        same_name = "IS NOT DISTINCT FROM" if self.db.dialect == "postgres" else "IS"
+        await (tx or self.db).executemany(
+            f"UPDATE users SET {assignments} WHERE user_id = ? AND birth_date = ? AND full_name {same_name} ?",
+            rows
+        )
+
+    async def has_data(self, user_id: int) -> bool:
+        row = await self.db.fetchone(
+            "SELECT 1 FROM users WHERE user_id = ? AND birth_date IS NOT NULL AND full_name IS NOT NULL",
             (user_id,)
         )
-        row = await cursor.fetchone()
         return row is not None
 
+    async def set_archetype(self, user_id: int, archetype: str):
+        await self.db.execute("UPDATE users SET archetype = ? WHERE user_id = ?", (archetype, user_id))
+
+    async def set_status(self, user_id: int, status: str, tx=None):
+        await (tx or self.db).execute("UPDATE users SET status = ? WHERE user_id = ?", (status, user_id))
+
+    async def ids(self, status: str = None) -> list:
+        if status:
+            rows = await self.db.fetchall("SELECT user_id FROM users WHERE status = ? ORDER BY user_id", (status,))
+        else:
+            rows = await self.db.fetchall("SELECT user_id FROM users ORDER BY user_id")
+        return [row[0] for row in rows]
+
+    async def count(self, status: str = None) -> int:
+        if status:
+            return await self.db.fetchval("SELECT COUNT(*) FROM users WHERE status = ?", (status,))
+        return await self.db.fetchval("SELECT COUNT(*) FROM users")
+
+    async def segment_count(self, segment: str) -> int:
+        where, params = build_segment(segment)
+        return await self.db.fetchval(f"SELECT COUNT(*) FROM users WHERE {where}", params)
+
+    async def segment_ids(self, segment: str) -> list:
+        where, params = build_segment(segment)
+        rows = await self.db.fetchall(f"SELECT user_id FROM users WHERE {where} ORDER BY user_id", params)
+        return [row[0] for row in rows]
+
+    async def page(self, filter_key: str, direction: str = "n", cursor: int = None, limit: int = ADMIN_PAGE_SIZE):
+        status = USER_PAGE_FILTERS[filter_key]
+        where, params = [], []
+        if status:
+            where.append("status = ?")
+            params.append(status)
+        if cursor is not None:
+            where.append(f"user_id {'<' if direction == 'n' else '>'} ?")
+            params.append(cursor)
+        order = "DESC" if direction == "n" else "ASC"
+        rows = await self.db.fetchall(
+            f"""SELECT user_id, username, full_name, status FROM users
+            {"WHERE " + " AND ".join(where) if where else ""}
+            ORDER BY user_id {order}
+            LIMIT ?""",
+            (*params, limit + 1)
+        )
+        return finish_page(rows, direction, limit)
+
+    async def search(self, query: str, limit: int = ADMIN_PAGE_SIZE):
+        query = query.strip().lstrip("@")
+        if query.isdigit():
+            return await self.db.fetchall(
+                "SELECT user_id, username, full_name, status FROM users WHERE user_id = ?", (int(query),)
+            )
+        return await self.db.fetchall(
+            "SELECT user_id, username, full_name, status FROM users WHERE lower(username) = lower(?) LIMIT ?",
+            (query, limit)
+        )
+
+class SessionRepo:
+    def __init__(self, db: Database):
+        self.db = db
+
+    async def touch(self, user_id: int, tx=None):
+        """Счётчик сессий и прогресс — одной транзакцией (своей или переданной)"""
+        if tx is None:
+            async with self.db.transaction() as tx:
+                return await self.touch(user_id, tx)
+        await tx.execute(
+            """INSERT INTO user_sessions (user_id, last_active) VALUES (?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET
+            session_count = user_sessions.session_count + 1, last_active = excluded.last_active""",
+            (user_id, utc_now())
+        )
+        await tx.execute(
+            """INSERT INTO user_progress (user_id, total_sessions) VALUES (?, 1)
+            ON CONFLICT(user_id) DO UPDATE SET
+            total_sessions = user_progress.total_sessions + 1""",
+            (user_id,)
+        )
+
+    async def stats(self, user_id: int):
+        return await self.db.fetchone(
+            """SELECT us.session_count, us.last_active, u.status, u.archetype, u.birth_date, u.full_name
+            FROM user_sessions us
+            LEFT JOIN users u ON us.user_id = u.user_id
+            WHERE us.user_id = ?""",
+            (user_id,)
+        )
+
+class AchievementRepo:
+    def __init__(self, db: Database):
+        self.db = db
+
+    async def unlock(self, user_id: int, achievement_id: str, tx=None):
+        await (tx or self.db).execute(
+            """INSERT INTO user_achievements (user_id, achievement_id, unlocked_at) VALUES (?, ?, ?)
+            ON CONFLICT(user_id, achievement_id) DO NOTHING""",
+            (user_id, achievement_id, utc_now())
+        )
+
+class PromoRepo:
+    def __init__(self, db: Database, users: UserRepo, achievements: AchievementRepo):
+        self.db = db
+        self.users = users
+        self.achievements = achievements
+
+    async def create(self) -> str:
+        """Новый одиночный промокод; при коллизии просто пробуем ещё раз"""
+        while True:
+            code = make_premium_code()
+            if await self.db.execute(
+                "INSERT INTO premium_codes (code) VALUES (?) ON CONFLICT(code) DO NOTHING", (code,)
+            ):
+                return code
+
+    async def create_batch(self, count: int, batch_tag: str) -> list:
+        """Создаёт пачку уникальных промокодов одной транзакцией.
+        Вставка идёт одним запросом по всей пачке; RETURNING отдаёт только реально вставленные,
+        коллизии догенерируются."""
+        codes = set()
+        async with self.db.transaction() as tx:
+            while len(codes) < count:
+                candidates = {make_premium_code() for _ in range(count - len(codes))} - codes
+                source, param = tx.text_list(candidates)
+                # WHERE true снимает неоднозначность INSERT ... SELECT ... ON CONFLICT в SQLite
+                rows = await tx.fetchall(
+                    f"""INSERT INTO premium_codes (code, batch_tag)
+                    SELECT value, ? FROM ({source}) AS batch WHERE true
+                    ON CONFLICT(code) DO NOTHING
+                    RETURNING code""",
+                    (batch_tag, param)
+                )
+                codes.update(row[0] for row in rows)
+        return sorted(codes)
+
+    async def redeem(self, code: str, user_id: int) -> str:
+        """Атомарно активирует промокод и выдаёт премиум: 'ok', 'not_found' или 'used'.
+        Условный UPDATE ... RETURNING внутри транзакции не даёт двум
+        пользователям активировать один код одновременно."""
+        async with self.db.transaction() as tx:
+            row = await tx.fetchone(
+                """UPDATE premium_codes SET used_by = ?, used_at = ?
+                WHERE code = ? AND used_by IS NULL
+                RETURNING code""",
+                (user_id, utc_now(), code)
+            )
+            if row is None:
+                exists = await tx.fetchone("SELECT 1 FROM premium_codes WHERE code = ?", (code,))
+                return "used" if exists else "not_found"
+            await self.users.set_status(user_id, "paid", tx)
+            await self.achievements.unlock(user_id, "premium_seeker", tx)
+            return "ok"
+
+    async def count_unused(self) -> int:
+        return await self.db.fetchval("SELECT COUNT(*) FROM premium_codes WHERE used_by IS NULL")
+
+    async def page(self, filter_key: str, direction: str = "n", cursor: tuple = None, limit: int = ADMIN_PAGE_SIZE):
+        """Страница промокодов по курсору (ключ сортировки, code); возвращает строки и флаг «есть ещё»"""
+        condition, sort_column = PROMO_PAGE_FILTERS[filter_key]
+        where, params = [condition] if condition else [], []
+        if cursor:
+            where.append(f"(pc.{sort_column}, pc.code) {'<' if direction == 'n' else '>'} (?, ?)")
+            params.extend(cursor)
+        order = "DESC" if direction == "n" else "ASC"
+        rows = await self.db.fetchall(
+            f"""SELECT pc.code, pc.{sort_column}, pc.batch_tag, u.username
+            FROM premium_codes pc
+            LEFT JOIN users u ON pc.used_by = u.user_id
+            {"WHERE " + " AND ".join(where) if where else ""}
+            ORDER BY pc.{sort_column} {order}, pc.code {order}
+            LIMIT ?""",
+            (*params, limit + 1)
+        )
+        return finish_page(rows, direction, limit)
+
+class JobRepo:
+    """Состояние фоновых задач: цель (например, год), курсор и статус — для продолжения после рестарта"""
+
+    def __init__(self, db: Database):
+        self.db = db
+
+    async def get(self, name: str):
+        row = await self.db.fetchone("SELECT target, cursor, status FROM job_state WHERE name = ?", (name,))
+        if row:
+            return {"target": row[0], "cursor": row[1], "status": row[2]}
+        return None
+
+    async def save(self, name: str, target: str, cursor: int, status: str, tx=None):
+        await (tx or self.db).execute(
+            """INSERT INTO job_state (name, target, cursor, status, updated_at) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(name) DO UPDATE SET
+            target = excluded.target, cursor = excluded.cursor, status = excluded.status,
+            updated_at = excluded.updated_at""",
+            (name, target, cursor, status, utc_now())
+        )
+
+    async def claim(self, name: str, target: str, busy: tuple = ("running", "paused")) -> bool:
+        """Атомарно запускает задачу с нуля, если она не в статусе из busy; False — задача уже занята"""
+        row = await self.db.fetchone(
+            f"""INSERT INTO job_state (name, target, cursor, status, updated_at) VALUES (?, ?, 0, 'running', ?)
+            ON CONFLICT(name) DO UPDATE SET
+            target = excluded.target, cursor = 0, status = 'running', updated_at = excluded.updated_at
+            WHERE job_state.status NOT IN ({", ".join("?" * len(busy))})
+            RETURNING name""",
+            (name, target, utc_now(), *busy)
+        )
+        return row is not None
+
+class EventRepo:
+    """Аналитика: сырые события (только дописываются) и дневные агрегаты, которые читает админка"""
+
+    def __init__(self, db: Database):
+        self.db = db
+
+    async def append(self, rows: list):
+        """rows: (day, created_at, user_id, event); одна транзакция на пачку"""
+        async with self.db.transaction() as tx:
+            await tx.executemany("INSERT INTO events (day, created_at, user_id, event) VALUES (?, ?, ?, ?)", rows)
+
+    async def first_day(self):
+        return await self.db.fetchval("SELECT MIN(day) FROM events")
+
+    async def rollup_day(self, day: str, retention_days: int):
+        """Пересчитывает агрегаты одного дня. Читаются только события этого дня (idx_events_day)
+        и регистрации за окно когорт (idx_users_created)"""
+        current = date.fromisoformat(day)
+        next_day = (current + timedelta(days=1)).isoformat()
+        first_cohort = (current - timedelta(days=retention_days)).isoformat()
+        upsert = "ON CONFLICT(day, event) DO UPDATE SET events = excluded.events, users = excluded.users"
+        async with self.db.transaction() as tx:
+            await tx.execute(
+                f"""INSERT INTO daily_events (day, event, events, users)
+                SELECT day, event, COUNT(*), COUNT(DISTINCT user_id) FROM events WHERE day = ? GROUP BY day, event
+                {upsert}""",
+                (day,)
+            )
+            await tx.execute(
+                f"""INSERT INTO daily_events (day, event, events, users)
+                SELECT ?, 'active', COUNT(*), COUNT(DISTINCT user_id) FROM events WHERE day = ?
+                {upsert}""",
+                (day, day)
+            )
+            await tx.execute(
+                f"""INSERT INTO daily_events (day, event, events, users)
+                SELECT ?, 'new', COUNT(*), COUNT(*) FROM users WHERE created_at >= ? AND created_at < ?
+                {upsert}""",
+                (day, day, next_day)
+            )
+            await tx.execute(
+                """INSERT INTO retention (cohort_day, day, users)
+                SELECT substr(u.created_at, 1, 10), ?, COUNT(*)
+                FROM (SELECT DISTINCT user_id FROM events WHERE day = ?) AS active
+                JOIN users u ON u.user_id = active.user_id
+                WHERE u.created_at >= ? AND u.created_at < ?
+                GROUP BY substr(u.created_at, 1, 10)
+                ON CONFLICT(cohort_day, day) DO UPDATE SET users = excluded.users""",
+                (day, day, first_cohort, day)
+            )
+
+    async def totals(self, since: str) -> dict:
+        """{event: (events, сумма дневных уникальных пользователей)} начиная с since"""
+        rows = await self.db.fetchall(
+            "SELECT event, SUM(events), SUM(users) FROM daily_events WHERE day >= ? GROUP BY event",
+            (since,)
+        )
+        return {row[0]: (int(row[1]), int(row[2])) for row in rows}
+
+    async def daily(self, event: str, since: str) -> list:
+        return await self.db.fetchall(
+            "SELECT day, users FROM daily_events WHERE event = ? AND day >= ? ORDER BY day",
+            (event, since)
+        )
+
+    async def retention(self, since: str) -> list:
+        return await self.db.fetchall(
+            "SELECT cohort_day, day, users FROM retention WHERE cohort_day >= ?",
+            (since,)
+        )
+
+class SketchRepo:
+    """Дневные HyperLogLog-скетчи активных пользователей (регистры одним BLOB)"""
+
+    def __init__(self, db: Database):
+        self.db = db
+
+    async def load(self, since: str) -> list:
+        return await self.db.fetchall("SELECT day, registers FROM activity_sketches WHERE day >= ?", (since,))
+
+    async def save(self, rows: list):
+        """rows: (day, registers)"""
+        now = utc_now()
+        async with self.db.transaction() as tx:
+            await tx.executemany(
+                """INSERT INTO activity_sketches (day, registers, updated_at) VALUES (?, ?, ?)
+                ON CONFLICT(day) DO UPDATE SET registers = excluded.registers, updated_at = excluded.updated_at""",
+                [(day, registers, now) for day, registers in rows]
+            )
+
+    async def prune(self, before: str):
+        await self.db.execute("DELETE FROM activity_sketches WHERE day < ?", (before,))
+
+class Storage:
+    """Точка доступа к данным: бэкенд + репозитории поверх него"""
+
+    def __init__(self, db: Database):
+        self.db = db
+        self.users = UserRepo(db)
+        self.sessions = SessionRepo(db)
+        self.achievements = AchievementRepo(db)
+        self.promos = PromoRepo(db, self.users, self.achievements)
+        self.jobs = JobRepo(db)
+        self.events = EventRepo(db)
+        self.sketches = SketchRepo(db)
+
+    async def open(self):
+        await self.db.open()
+        logger.info(f"Storage opened: {self.db.dialect}")
+
+    async def close(self):
+        await self.db.close()
+
+    async def start_session(self, user_id: int, username: str, full_name: str) -> tuple:
+        """Всё, что нужно /start, за одну транзакцию: профиль, счётчики сессий, (has_data, status)"""
+        async with self.db.transaction() as tx:
+            result = await self.users.register(user_id, username, full_name, tx)
+            await self.sessions.touch(user_id, tx)
+        return result
+
+    async def grant_premium(self, user_id: int):
+        async with self.db.transaction() as tx:
+            await self.users.set_status(user_id, "paid", tx)
+            await self.achievements.unlock(user_id, "premium_seeker", tx)
+
+def create_storage(backend: str = None, path: str = DB_PATH, dsn: str = None) -> Storage:
+    backend = backend or STORAGE_BACKEND
+    if backend == "postgres":
+        return Storage(PostgresDatabase(dsn or DATABASE_URL, DB_POOL_SIZE))
+    if backend != "sqlite":
+        raise ValueError(f"Unknown STORAGE_BACKEND: {backend}")
+    return Storage(SqliteDatabase(path, DB_POOL_SIZE))
+
+storage = create_storage()
+
+# =============== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ===============
+def promo_codes_csv(codes: list, batch_tag: str) -> bytes:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(["code", "batch_tag"])
+    writer.writerows((code, batch_tag) for code in codes)
+    return buffer.getvalue().encode("utf-8")
+
+# =============== ЭКСПОРТ ===============
+EXPORT_FORMATS = ("csv", "jsonl")
+EXPORT_COLUMNS = (
+    "user_id", "username", "full_name", "birth_date", "status", "archetype", "created_at",
+    "session_count", "last_active", "total_sessions", "insights_received",
+    "achievements", "promo_codes"
+)
+EXPORT_QUERY = """
+SELECT u.user_id, u.username, u.full_name, u.birth_date, u.status, u.archetype, u.created_at,
+       s.session_count, s.last_active, p.total_sessions, p.insights_received,
+       (SELECT group_concat(a.achievement_id, ';') FROM user_achievements a WHERE a.user_id = u.user_id),
+       (SELECT group_concat(c.code, ';') FROM premium_codes c WHERE c.used_by = u.user_id)
+FROM users u
+LEFT JOIN user_sessions s ON s.user_id = u.user_id
+LEFT JOIN user_progress p ON p.user_id = u.user_id
+ORDER BY u.user_id
+"""
+
+def export_users(output_path: str, fmt: str = "csv", db_path: str = None) -> int:
+    """Потоково выгружает пользователей со статистикой в сжатый CSV/JSONL.
+    Читает внутри одной транзакции чтения — согласованный снимок в режиме WAL;
+    строки идут курсором, память не растёт с размером базы."""
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format: {fmt}")
+    source = sqlite3.connect(f"file:{db_path or DB_PATH}?mode=ro", uri=True, isolation_level=None)
+    count = 0
+    try:
+        source.execute("BEGIN")
+        with gzip.open(output_path, "wt", encoding="utf-8", newline="") as out:
+            writer = csv.writer(out) if fmt == "csv" else None
+            if writer:
+                writer.writerow(EXPORT_COLUMNS)
+            for row in source.execute(EXPORT_QUERY):
+                if writer:
+                    writer.writerow(row)
+                else:
+                    out.write(json.dumps(dict(zip(EXPORT_COLUMNS, row)), ensure_ascii=False) + "\n")
+                count += 1
+        source.execute("COMMIT")
+    finally:
+        source.close()
+    return count
+
+# =============== РЕЗЕРВНОЕ КОПИРОВАНИЕ ===============
+def backup_database(dest_dir: str = BACKUP_DIR, compress: bool = BACKUP_COMPRESS, db_path: str = None) -> str:
+    """Онлайн-бэкап через SQLite backup API за один шаг (pages=-1) в отдельном потоке.
+    Пошаговая копия начинается заново после каждой записи в базу и при постоянных
+    записях бота может не закончиться никогда; один шаг читает согласованный снимок,
+    а в режиме WAL бот тем временем продолжает писать.
+    Копия проверяется integrity_check, при желании сжимается, старые удаляются."""
+    os.makedirs(dest_dir, exist_ok=True)
+    started = time.perf_counter()
+    raw_path = os.path.join(dest_dir, f"users_{datetime.now():%Y%m%d_%H%M%S}.db")
+    source = sqlite3.connect(db_path or DB_PATH)
+    target = sqlite3.connect(raw_path)
+    try:
+        source.backup(target, pages=-1)
+        integrity = target.execute("PRAGMA integrity_check").fetchone()[0]
+    finally:
+        target.close()
+        source.close()
+    if integrity != "ok":
+        os.remove(raw_path)
+        raise RuntimeError(f"Backup integrity check failed: {integrity}")
+
+    path = raw_path
+    if compress:
+        path = raw_path + ".gz"
+        with open(raw_path, "rb") as src, gzip.open(path, "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(raw_path)
+    rotate_backups(dest_dir, BACKUP_KEEP)
+
+    duration = time.perf_counter() - started
+    METRICS.observe("backup_duration_s", duration)
+    METRICS.set("backup_last", os.path.basename(path))
+    METRICS.set("backup_size_kb", round(os.path.getsize(path) / 1024, 1))
+    logger.info(f"Backup {path} done in {duration:.2f}s")
+    return path
+
+def rotate_backups(dest_dir: str = BACKUP_DIR, keep: int = BACKUP_KEEP):
+    backups = sorted(f for f in os.listdir(dest_dir) if f.startswith("users_") and (f.endswith(".db") or f.endswith(".db.gz")))
+    for name in backups[:-keep] if keep > 0 else []:
+        os.remove(os.path.join(dest_dir, name))
+
+def restore_database(backup_path: str, db_path: str = None) -> str:
+    """Восстанавливает базу из бэкапа (бот должен быть остановлен).
+    Текущая база предварительно сохраняется рядом как .before_restore."""
+    db_path = db_path or DB_PATH
+    source_path = backup_path
+    if backup_path.endswith(".gz"):
+        fd, source_path = tempfile.mkstemp(suffix=".db")
+        with os.fdopen(fd, "wb") as dst, gzip.open(backup_path, "rb") as src:
+            shutil.copyfileobj(src, dst)
+    try:
+        source = sqlite3.connect(source_path)
+        try:
+            integrity = source.execute("PRAGMA integrity_check").fetchone()[0]
+            if integrity != "ok":
+                raise RuntimeError(f"Backup {backup_path} is corrupted: {integrity}")
+            target = sqlite3.connect(db_path)
+            try:
+                if os.path.getsize(db_path):
+                    safety = sqlite3.connect(f"{db_path}.before_restore")
+                    target.backup(safety)
+                    safety.close()
+                source.backup(target)
+            finally:
+                target.close()
+        finally:
+            source.close()
+    finally:
+        if source_path != backup_path:
+            os.remove(source_path)
+    return db_path
+
+async def backup_scheduler(interval_hours: float = BACKUP_INTERVAL_HOURS):
+    while True:
+        await asyncio.sleep(interval_hours * 3600)
+        try:
+            await asyncio.to_thread(backup_database)
+        except Exception as e:
+            METRICS.inc("backup_failures")
+            logger.error(f"Scheduled backup failed: {e}", exc_info=True)
+
+# =============== АНАЛИТИКА ===============
+ANALYTICS_EVENTS = {
+    "start": "🚀 /start",
+    "birth_date": "📅 Дата рождения",
+    "full_name": "🔤 Имя",
+    "buy": "💳 Переход к оплате",
+    "paid": "💎 Оплата",
+    "promo": "🎫 Промокод",
+    "energy": "🌞 Энергия дня",
+}
+FUNNEL_EVENTS = ("start", "birth_date", "full_name", "buy", "paid")
+ROLLUP_JOB = "analytics_rollup"
+
+class AnalyticsLog:
+    """Хендлеры только кладут событие в кольцевой буфер в памяти, в базу его пишет
+    фоновая задача пачками. При переполнении теряются самые старые события."""
+    def __init__(self, capacity: int = ANALYTICS_BUFFER, batch: int = ANALYTICS_BATCH):
+        self.buffer = deque(maxlen=capacity)
+        self.batch = batch
+        self._wakeup = asyncio.Event()
+
+    def track(self, event: str, user_id: int):
+        if event not in ANALYTICS_EVENTS:
+            raise ValueError(f"Unknown analytics event: {event}")
+        if len(self.buffer) == self.buffer.maxlen:
+            METRICS.inc("analytics_dropped")
+        now = utc_now()
+        self.buffer.append((now[:10], now, user_id, event))
+        if len(self.buffer) >= self.batch:
+            self._wakeup.set()
+
+    async def flush(self) -> int:
+        written = 0
+        while self.buffer:
+            rows = [self.buffer.popleft() for _ in range(min(self.batch, len(self.buffer)))]
+            try:
+                await storage.events.append(rows)
+            except Exception:
+                # Пачка возвращается в начало буфера и уйдёт при следующем сбросе
+                self.buffer.extendleft(reversed(rows))
+                raise
+            written += len(rows)
+            METRICS.inc("analytics_events", len(rows))
+        return written
+
+    async def run(self, interval: float = ANALYTICS_FLUSH_INTERVAL):
+        """Сброс раз в interval секунд или сразу, как набралась пачка"""
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                METRICS.inc("analytics_flush_failures")
+                logger.error(f"Analytics flush failed: {e}")
+
+ANALYTICS = AnalyticsLog()
+
+async def run_rollup(retention_days: int = ANALYTICS_RETENTION_DAYS) -> int:
+    """Досчитывает дневные агрегаты: дни после последнего закрытого плюс текущий.
+    Закрытым считается вчерашний день — сегодняшний пересчитывается при каждом запуске."""
+    await ANALYTICS.flush()
+    state = await storage.jobs.get(ROLLUP_JOB)
+    today = date.fromisoformat(utc_now()[:10])
+    if state:
+        day = date.fromisoformat(state["target"]) + timedelta(days=1)
+    else:
+        first = await storage.events.first_day()
+        if not first:
+            return 0
+        day = date.fromisoformat(first)
+    started = time.perf_counter()
+    days = 0
+    while day <= today:
+        await storage.events.rollup_day(day.isoformat(), retention_days)
+        day += timedelta(days=1)
+        days += 1
+    await storage.jobs.save(ROLLUP_JOB, (today - timedelta(days=1)).isoformat(), 0, "done")
+    METRICS.observe("analytics_rollup_ms", (time.perf_counter() - started) * 1000)
+    return days
+
+async def analytics_scheduler(interval: float = ANALYTICS_ROLLUP_INTERVAL):
+    while True:
+        try:
+            await run_rollup()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Analytics rollup failed: {e}", exc_info=True)
+        await asyncio.sleep(interval)
+
 # =============== МЕДИА-ФУНКЦИИ ===============
 def get_random_file(folder, extensions):
     if not os.path.exists(folder):
@@ -224,9 +1553,15 @@ def get_random_daily_energy_image(energy: int) -> str:
 
 # =============== ПОМОЩНИКИ ===============
 def reduce_number(n: int) -> int:
-    while n >= 10:
-        n = sum(int(d) for d in str(n))
-    return n if n != 0 else 9
+    """Цифровой корень без перебора цифр: 1 + (n - 1) mod 9; ноль даёт 9"""
+    return 1 + (n - 1) % 9 if n > 0 else 9
+
+def numerology_year() -> int:
+    return int(YEAR_OVERRIDE) if YEAR_OVERRIDE else datetime.now().year
+
+def person_number(birth_date: str) -> int:
+    """Число человека для анализа совместимости: все цифры даты рождения, сведённые к 1–9"""
+    return reduce_number(sum(int(d) for d in birth_date.replace(".", "")))
 
 LETTER_VALUES = {
     'А': 1, 'Б': 2, 'В': 3, 'Г': 4, 'Д': 5, 'Е': 6, 'Ё': 7, 'Ж': 8, 'З': 9,
@@ -237,17 +1572,72 @@ LETTER_VALUES = {
 
 VOWELS = set("АЕЁИОУЫЭЮЯ")
 
+# Все буквы LETTER_VALUES однобайтовые в cp1251: имя кодируется один раз, дальше
+# bytes.translate заменяет букву её значением (1–9) и выкидывает остальное — всё на стороне C.
+NAME_CODEC = "cp1251"
+NAME_SEPARATOR = "\0"
+
+def _value_table(letters, with_digits: bool = False) -> tuple:
+    """Аргументы для bytes.translate: (таблица байт -> значение, байты на удаление).
+    Нулевой байт сохраняется как разделитель имён в пакетном режиме."""
+    table = bytearray(256)
+    keep = {0}
+    for char in letters:
+        code = char.encode(NAME_CODEC)[0]
+        table[code] = LETTER_VALUES[char]
+        keep.add(code)
+    if with_digits:
+        # "0" ничего не добавляет к сумме — его просто удаляем
+        for digit in "123456789":
+            table[ord(digit)] = int(digit)
+            keep.add(ord(digit))
+    return bytes(table), bytes(code for code in range(256) if code not in keep)
+
+VOWEL_VALUES = _value_table(VOWELS)
+CONSONANT_VALUES = _value_table(set(LETTER_VALUES) - VOWELS)
+OBJECT_VALUES = _value_table(LETTER_VALUES, with_digits=True)
+
+# Десятичные цифры других письменностей (３, ٣, ३): прежний подсчёт через isdigit()/int()
+# считал их цифрами, cp1251 их не знает — заранее меняем на ASCII. Надстрочные (²)
+# десятичными не являются и не считаются (раньше на них падал int()).
+_UNICODE_DIGIT_RE = re.compile(r"(?![0-9])\d")
+
+def _ascii_digit(match) -> str:
+    return str(unicodedata.decimal(match.group()))
+
+def _encode_upper(text: str) -> bytes:
+    return _UNICODE_DIGIT_RE.sub(_ascii_digit, text.upper()).encode(NAME_CODEC, "ignore")
+
+def _encode_batch(texts: list) -> bytes:
+    return _encode_upper(NAME_SEPARATOR.join(text.replace(NAME_SEPARATOR, "") for text in texts))
+
+def name_numbers(name: str) -> tuple:
+    """(число Души, число Личности) — суммы гласных и согласных имени"""
+    data = _encode_upper(name)
+    return (
+        reduce_number(sum(data.translate(*VOWEL_VALUES))),
+        reduce_number(sum(data.translate(*CONSONANT_VALUES))),
+    )
+
+def name_numbers_batch(names: list) -> list:
+    """name_numbers для тысяч имён сразу: пачка склеивается через \\0 и переводится
+    двумя вызовами translate вместо цикла по символам каждого имени"""
+    if not names:
+        return []
+    data = _encode_batch(names)
+    vowels = data.translate(*VOWEL_VALUES).split(b"\0")
+    consonants = data.translate(*CONSONANT_VALUES).split(b"\0")
+    return [(reduce_number(sum(v)), reduce_number(sum(c))) for v, c in zip(vowels, consonants)]
+
 def name_to_number(name: str, use_vowels: bool = None) -> int:
-    name = name.upper().replace(" ", "")
-    total = 0
-    for char in name:
-        if char in LETTER_VALUES:
-            is_vowel = char in VOWELS
-            if use_vowels is None or is_vowel == use_vowels:
-                total += LETTER_VALUES[char]
-    return reduce_number(total)
+    data = _encode_upper(name)
+    if use_vowels is None:
+        return reduce_number(sum(data.translate(*VOWEL_VALUES)) + sum(data.translate(*CONSONANT_VALUES)))
+    return reduce_number(sum(data.translate(*(VOWEL_VALUES if use_vowels else CONSONANT_VALUES))))
 
 # =============== РАСЧЁТ ЭНЕРГИИ ДНЯ ===============
+# Вход — пара (день рождения, сегодняшний день): не больше 31×31 вариантов
+@lru_cache(maxsize=1024)
 def calculate_daily_energy(birth_day: str, today_date: str) -> int:
     bd = birth_day.lstrip("0") or "1"
     td = today_date.lstrip("0") or "1"
@@ -379,20 +1769,75 @@ def read_narrative(path: str) -> str:
         return "[Ошибка при загрузке текста]"
 
 def calculate_object_number(text: str) -> int:
-    total = 0
-    for char in text.upper():
-        if char.isdigit():
-            total += int(char)
-        elif char in LETTER_VALUES:
-            total += LETTER_VALUES[char]
-    return reduce_number(total)
+    return reduce_number(sum(_encode_upper(text).translate(*OBJECT_VALUES)))
 
-def read_compatibility_narrative(person_num: int, obj_num: int, obj_type: str) -> str:
-    path = f"narratives/full/compatibility/{obj_type}/{person_num}_{obj_num}.txt"
-    try:
-        with open(path, "r", encoding="utf-8") as f:
-            return f.read().strip()
-    except FileNotFoundError:
+def object_numbers_batch(texts: list) -> list:
+    if not texts:
+        return []
+    return [reduce_number(sum(part)) for part in _encode_batch(texts).translate(*OBJECT_VALUES).split(b"\0")]
+
+COMPATIBILITY_DIR = "narratives/full/compatibility"
+COMPATIBILITY_TYPES = ("home", "car")
+
+class CompatibilityEngine:
+    """Все тексты совместимости (2 типа × 9 × 9) в памяти. Таблица типа — плоский список
+    на 81 ячейку с индексом (person_num - 1) * 9 + (obj_num - 1); читается один раз при старте,
+    дальше анализ не трогает диск."""
+
+    def __init__(self, base_dir: str = COMPATIBILITY_DIR):
+        self.base_dir = base_dir
+        self.tables = {obj_type: [None] * 81 for obj_type in COMPATIBILITY_TYPES}
+
+    def load(self) -> list:
+        """Загружает все пары и возвращает список отсутствующих"""
+        tables = {}
+        for obj_type in COMPATIBILITY_TYPES:
+            tables[obj_type] = [
+                self._read_pair(self._pair_path(obj_type, person_num, obj_num))
+                for person_num in range(1, 10)
+                for obj_num in range(1, 10)
+            ]
+        self.tables = tables
+        return self.missing()
+
+    def _pair_path(self, obj_type: str, person_num: int, obj_num: int) -> str:
+        return os.path.join(self.base_dir, obj_type, f"{person_num}_{obj_num}.txt")
+
+    @staticmethod
+    def _read_pair(path: str):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.error(f"Error reading file {path}: {e}")
+            return None
+
+    def missing(self) -> list:
+        return [
+            (obj_type, index // 9 + 1, index % 9 + 1)
+            for obj_type in COMPATIBILITY_TYPES
+            for index, text in enumerate(self.tables[obj_type])
+            if text is None
+        ]
+
+    def validation_report(self) -> str:
+        missing = self.missing()
+        total = 81 * len(COMPATIBILITY_TYPES)
+        if not missing:
+            return f"Compatibility texts: {total}/{total}, nothing missing"
+        lines = [f"Compatibility texts: {total - len(missing)}/{total}, missing {len(missing)}:"]
+        for obj_type in COMPATIBILITY_TYPES:
+            pairs = [f"{p}_{o}" for t, p, o in missing if t == obj_type]
+            if pairs:
+                lines.append(f"  {obj_type}: {', '.join(pairs)}")
+        return "\n".join(lines)
+
+    def analyze(self, person_num: int, obj_num: int, obj_type: str) -> str:
+        text = self.tables[obj_type][(person_num - 1) * 9 + obj_num - 1]
+        if text is not None:
+            return text
         return (
             f"[Текст для {obj_type} {person_num}/{obj_num} ещё не готов.]\n"
             "Но вот краткий анализ:\n"
@@ -401,8 +1846,23 @@ def read_compatibility_narrative(person_num: int, obj_num: int, obj_type: str) -
             "Совместимость будет рассчитана в ближайшем обновлении."
         )
 
+    async def lookup(self, person_num: int, obj_num: int, obj_type: str) -> str:
+        """analyze для хендлеров: пары, которых не было при загрузке, дочитываются с диска
+        (текст могли добавить после старта); одновременные запросы одной пары делят одно чтение"""
+        table = self.tables[obj_type]
+        index = (person_num - 1) * 9 + obj_num - 1
+        if table[index] is None:
+            path = self._pair_path(obj_type, person_num, obj_num)
+            table[index] = await NARRATIVE_FLIGHT.run(
+                flight_key("compatibility", obj_type, person_num, obj_num), IO_EXECUTOR.run, self._read_pair, path
+            )
+        return self.analyze(person_num, obj_num, obj_type)
+
+COMPATIBILITY = CompatibilityEngine()
+
 # =============== РАСЧЁТ ПРОФИЛЯ ===============
-def calculate_numerology_profile(birth_date: str, full_name: str, current_year: int = CURRENT_YEAR):
+def calculate_birth_numbers(birth_date: str) -> dict:
+    """Числа, зависящие только от даты рождения"""
     day, month, year = map(int, birth_date.split('.'))
     mind = reduce_number(day)
     all_digits = [int(d) for d in f"{day:02d}{month:02d}{year}"]
@@ -410,14 +1870,11 @@ def calculate_numerology_profile(birth_date: str, full_name: str, current_year:
     action = reduce_number(action_raw)
     realization = reduce_number(mind + action)
     destiny_lesson = reduce_number(mind + action + realization)
-    personal_year = reduce_number(day + month + current_year)
-    soul_urge = name_to_number(full_name, use_vowels=True)
-    personality = name_to_number(full_name, use_vowels=False)
     karmic_debts = set()
     for num in [action_raw, mind + action, mind + action + realization]:
         temp = num
         while temp >= 10:
-            if temp in (13, 14, 16, 19):
+            if temp in KARMIC_BITS:
                 karmic_debts.add(temp)
             temp = sum(int(d) for d in str(temp))
     return {
@@ -425,10 +1882,18 @@ def calculate_numerology_profile(birth_date: str, full_name: str, current_year:
         "action": action,
         "realization": realization,
         "destiny_lesson": destiny_lesson,
-        "personal_year": personal_year,
+        "karmic_debts": sorted(karmic_debts)
+    }
+
+def calculate_numerology_profile(birth_date: str, full_name: str, current_year: int = None):
+    current_year = current_year or numerology_year()
+    day, month, _ = map(int, birth_date.split('.'))
+    soul_urge, personality = name_numbers(full_name)
+    return {
+        **calculate_birth_numbers(birth_date),
+        "personal_year": reduce_number(day + month + current_year),
         "soul_urge": soul_urge,
         "personality": personality,
-        "karmic_debts": sorted(karmic_debts),
         "birth_date": birth_date,
         "full_name": full_name
     }
@@ -488,6 +1953,7 @@ def analyze_pythagoras_lines(matrix: dict) -> list:
             full_advice = "Нужно наработать " + " и ".join(advice_parts)
             results.append({
                 "title": f"Линия {config['name']} ({'-'.join(config['digits'])})",
+                "digits": config["digits"],
                 "message": f"отвечает за {config['purpose']}. Но у тебя отсутствует(ют) цифра(ы): {', '.join(missing_digits)}. Поэтому эта сфера даётся с трудом. {full_advice}"
             })
     return results
@@ -528,9 +1994,246 @@ def determine_archetype(digit_counts):
     else:
         return "💚 Целитель"
 
+def compute_report_data(birth_date: str, full_name: str, current_year: int = None):
+    """Чистый расчёт профиля и матрицы (выполняется в пуле процессов)"""
+    profile = calculate_numerology_profile(birth_date, full_name, current_year)
+    matrix, digit_counts = calculate_pythagoras_matrix(birth_date)
+    matrix_data = {
+        "matrix_visual": generate_matrix_visual(matrix),
+        "line_analysis": analyze_pythagoras_lines(digit_counts),
+        "archetype": determine_archetype(digit_counts)
+    }
+    return profile, matrix_data
+
+# =============== ПЕРЕСЧЁТ ПРОИЗВОДНЫХ ПОЛЕЙ ===============
+RECALC_JOB = "recalc_derived"
+# Увеличивается при добавлении производных полей — пересчёт текущего года запустится заново
+RECALC_VERSION = 2
+# Порядок колонок в результате derive_fields
+DERIVED_FIELDS = (
+    "personal_year", "archetype", "person_num", "matrix_mask",
+    "mind", "action", "realization", "destiny_lesson", "karmic_mask",
+    "soul_urge", "personality",
+)
+
+def matrix_mask(digit_counts: dict) -> int:
+    """Матрица Пифагора в одном числе: по 4 бита на количество каждой цифры 1–9"""
+    return sum(min(digit_counts[str(i)], 15) << (4 * (i - 1)) for i in range(1, 10))
+
+@lru_cache(maxsize=40000)
+def _birth_date_fields(birth_date: str) -> tuple:
+    # Не зависит от года: у многих пользователей совпадают даты рождения
+    _, digit_counts = calculate_pythagoras_matrix(birth_date)
+    numbers = calculate_birth_numbers(birth_date)
+    return (
+        determine_archetype(digit_counts), person_number(birth_date), matrix_mask(digit_counts),
+        numbers["mind"], numbers["action"], numbers["realization"], numbers["destiny_lesson"],
+        sum(KARMIC_BITS[debt] for debt in numbers["karmic_debts"]),
+    )
+
+def derive_fields(birth_date: str, full_name: str, year: int, name_nums: tuple = None) -> tuple:
+    """Значения DERIVED_FIELDS по дате рождения и имени; без имени soul_urge и personality пустые"""
+    day, month, _ = map(int, birth_date.split("."))
+    if name_nums is None:
+        name_nums = name_numbers(full_name) if full_name else (None, None)
+    return (reduce_number(day + month + year), *_birth_date_fields(birth_date), *name_nums)
+
+def derive_fields_batch(rows: list, year: int) -> list:
+    """Пачка (user_id, birth_date, full_name) -> строки для UserRepo.update_derived (выполняется в пуле процессов)"""
+    names = name_numbers_batch([full_name or "" for _, _, full_name in rows])
+    result = []
+    for (user_id, birth_date, full_name), name_nums in zip(rows, names):
+        try:
+            result.append((
+                *derive_fields(birth_date, full_name, year, name_nums if full_name else (None, None)),
+                year, user_id, birth_date, full_name,
+            ))
+        except ValueError:
+            logger.warning(f"Skip recalculation for user {user_id}: bad birth date {birth_date!r}")
+    return result
+
+async def run_recalculation(year: int, chunk: int = RECALC_CHUNK, pause: float = RECALC_PAUSE, force: bool = False) -> int:
+    """Пересчитывает производные поля всех пользователей на year пачками по user_id.
+    Курсор сохраняется в той же транзакции, что и пачка, — прерванный запуск продолжается с места.
+    Пауза между пачками и общий CPU-пул не дают задаче вытеснить живой трафик."""
+    target = f"{year}/v{RECALC_VERSION}"
+    state = None if force else await storage.jobs.get(RECALC_JOB)
+    if state and state["target"] == target and state["status"] == "done":
+        return 0
+    cursor = state["cursor"] if state and state["target"] == target else 0
+    if cursor:
+        logger.info(f"Resuming recalculation for {year} after user {cursor}")
+    await storage.jobs.save(RECALC_JOB, target, cursor, "running")
+    started = time.perf_counter()
+    updated = 0
+    while True:
+        rows = await storage.users.birth_dates_after(cursor, chunk)
+        if not rows:
+            break
+        try:
+            updates = await CPU_EXECUTOR.run(derive_fields_batch, rows, year)
+        except (ExecutorBusy, asyncio.TimeoutError):
+            # Пул занят отчётами пользователей — уступаем и пробуем ту же пачку позже
+            await asyncio.sleep(max(pause * 10, 1))
+            continue
+        cursor = rows[-1][0]
+        async with storage.db.transaction() as tx:
+            await storage.users.update_derived(updates, tx)
+            await storage.jobs.save(RECALC_JOB, target, cursor, "running", tx)
+        updated += len(updates)
+        METRICS.inc("recalc_rows", len(updates))
+        await asyncio.sleep(pause)
+    await storage.jobs.save(RECALC_JOB, target, cursor, "done")
+    logger.info(f"Recalculated {updated} users for {year} in {time.perf_counter() - started:.1f}s")
+    return updated
+
+def seconds_until_new_year() -> float:
+    now = datetime.now()
+    return (datetime(now.year + 1, 1, 1) - now).total_seconds()
+
+async def recalc_scheduler():
+    """Пересчёт при старте (если год ещё не посчитан или прошлый запуск прервался)
+    и сразу после наступления нового года"""
+    while True:
+        try:
+            await run_recalculation(numerology_year())
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Recalculation failed: {e}", exc_info=True)
+        # Просыпаемся не реже раза в час: переживает перевод часов и сбои
+        await asyncio.sleep(min(seconds_until_new_year() + 1, 3600))
+
+async def recalc_once(year: int, force: bool) -> int:
+    await storage.open()
+    try:
+        return await run_recalculation(year, force=force)
+    finally:
+        await storage.close()
+        shutdown_executors()
+
+# =============== ИЗОБРАЖЕНИЕ МАТРИЦЫ ===============
+MATRIX_CELL_COLORS = {
+    0: (60, 60, 70),
+    1: (52, 120, 220),
+    2: (60, 170, 90),
+    3: (230, 190, 50),
+}
+MATRIX_STRONG_COLOR = (210, 60, 60)
+MATRIX_FONT_CANDIDATES = (
+    "media/fonts/matrix.ttf",
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+    "/usr/share/fonts/TTF/DejaVuSans.ttf",
+    "/usr/share/fonts/dejavu/DejaVuSans.ttf",
+    "C:/Windows/Fonts/arial.ttf",
+)
+
+# Разных векторов digit_counts немного, поэтому PNG кэшируются по вектору:
+# на диске (между перезапусками), в памяти (LRU) и как file_id Telegram.
+_matrix_png_cache = OrderedDict()
+
+def matrix_counts(digit_counts: dict) -> tuple:
+    return tuple(digit_counts[str(i)] for i in range(1, 10))
+
+def matrix_cache_key(counts: tuple) -> str:
+    return "-".join(str(c) for c in counts)
+
+@lru_cache(maxsize=8)
+def _matrix_font(size: int):
+    paths = [MATRIX_FONT_PATH] if MATRIX_FONT_PATH else []
+    for path in paths + list(MATRIX_FONT_CANDIDATES):
+        try:
+            return ImageFont.truetype(path, size)
+        except OSError:
+            continue
+    return ImageFont.load_default()
+
+def render_matrix_png(counts: tuple) -> bytes:
+    """Рисует матрицу 3×3 с линиями и архетипом, возвращает PNG"""
+    digit_counts = {str(i): counts[i - 1] for i in range(1, 10)}
+    lines = analyze_pythagoras_lines(digit_counts)
+    archetype = determine_archetype(digit_counts).split(" ", 1)[-1]
+
+    cell, gap, left, top = 240, 12, 60, 150
+    width = left * 2 + cell * 3 + gap * 2
+    height = top + cell * 3 + gap * 2 + 160 + 44 * len(lines)
+    img = Image.new("RGB", (width, height), (22, 22, 34))
+    draw = ImageDraw.Draw(img)
+    title_font, digit_font, label_font, text_font = (
+        _matrix_font(48), _matrix_font(56), _matrix_font(26), _matrix_font(30)
+    )
+
+    draw.text((width // 2, 70), "МАТРИЦА ПИФАГОРА", font=title_font, fill=(240, 240, 250), anchor="mm")
+
+    centers = {}
+    for idx in range(9):
+        row, col = divmod(idx, 3)
+        x0 = left + col * (cell + gap)
+        y0 = top + row * (cell + gap)
+        color = MATRIX_CELL_COLORS.get(counts[idx], MATRIX_STRONG_COLOR)
+        draw.rounded_rectangle((x0, y0, x0 + cell, y0 + cell), radius=24, fill=color)
+        centers[str(idx + 1)] = (x0 + cell // 2, y0 + cell // 2)
+
+    # Слабые линии (с отсутствующими цифрами) рисуем под цифрами
+    for line in lines:
+        start, end = centers[line["digits"][0]], centers[line["digits"][-1]]
+        draw.line((start, end), fill=(20, 20, 28), width=8)
+
+    for digit, (cx, cy) in centers.items():
+        count = counts[int(digit) - 1]
+        value = digit * count if count else "—"
+        if len(value) > 5:
+            value = f"{digit}×{count}"
+        draw.text((cx, cy), value, font=digit_font, fill=(255, 255, 255), anchor="mm",
+                  stroke_width=3, stroke_fill=(20, 20, 28))
+        draw.text((cx - cell // 2 + 16, cy - cell // 2 + 12), f"{digit}: {count}", font=label_font, fill=(235, 235, 235))
+
+    y = top + cell * 3 + gap * 2 + 40
+    draw.text((left, y), f"Архетип: {archetype}", font=text_font, fill=(250, 220, 120))
+    y += 60
+    if lines:
+        draw.text((left, y), "Слабые линии:", font=text_font, fill=(240, 150, 150))
+        for line in lines:
+            y += 44
+            draw.text((left, y), f"• {line['title']}", font=text_font, fill=(230, 230, 240))
+    else:
+        draw.text((left, y), "Все линии матрицы заполнены", font=text_font, fill=(150, 220, 150))
+
+    buffer = io.BytesIO()
+    img.save(buffer, format="PNG", optimize=True)
+    return buffer.getvalue()
+
+def build_matrix_image(counts: tuple) -> bytes:
+    """Берёт PNG из дискового кэша или рисует его (выполняется в пуле процессов)"""
+    path = os.path.join(MATRIX_CACHE_DIR, f"{matrix_cache_key(counts)}.png")
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        pass
+    png = render_matrix_png(counts)
+    os.makedirs(MATRIX_CACHE_DIR, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(png)
+    os.replace(tmp_path, path)
+    return png
+
+async def get_matrix_png(counts: tuple) -> bytes:
+    key = matrix_cache_key(counts)
+    png = _matrix_png_cache.get(key)
+    if png is not None:
+        _matrix_png_cache.move_to_end(key)
+        return png
+    png = await MATRIX_FLIGHT.run(key, CPU_EXECUTOR.run, build_matrix_image, counts)
+    _matrix_png_cache[key] = png
+    while len(_matrix_png_cache) > MATRIX_MEMORY_CACHE_SIZE:
+        _matrix_png_cache.popitem(last=False)
+    return png
+
 # =============== ГЕНЕРАЦИЯ ОТЧЁТОВ ===============
 def generate_free_report(profile: dict) -> str:
-    """Генерирует бесплатный отчет с проверкой длины"""
+    """Генерирует бесплатный отчет; длину не ограничивает — на части его делит send_chunked"""
     try:
         free_folder = "narratives/free"
         
@@ -570,10 +2273,6 @@ def generate_free_report(profile: dict) -> str:
             "👉 Нажми кнопку ниже, чтобы получить полный разбор!"
         )
         
-        # Проверяем длину
-        if len(report) > 4000:
-            report = report[:3997] + "..."
-        
         return report
         
     except Exception as e:
@@ -581,7 +2280,7 @@ def generate_free_report(profile: dict) -> str:
         return "✨ <b>БЕСПЛАТНЫЙ ОТЧЁТ</b>\n\nК сожалению, произошла ошибка. Пожалуйста, попробуйте позже."
 
 def generate_full_report(profile: dict, matrix_data: dict) -> str:
-    """Генерирует полный отчет с проверкой длины сообщения"""
+    """Генерирует полный отчет; длину не ограничивает — на части его делит send_chunked"""
     try:
         full_folder = "narratives/full"
         
@@ -641,27 +2340,215 @@ def generate_full_report(profile: dict, matrix_data: dict) -> str:
         if line_results:
             narrative += "\n\n🧩 <b>ЛИНИИ МАТРИЦЫ</b>"
             for line in line_results[:3]:  # Ограничиваем 3 линиями
-                line_text = f"\n\n<b>{line.get('title', 'Линия')}</b>\n{line.get('message', '')}"
-                # Проверяем, не превысим ли лимит
-                if len(narrative + line_text) > 3800:
-                    narrative += "\n\n... [ещё линии скрыты из-за ограничения длины]"
-                    break
-                narrative += line_text
+                narrative += f"\n\n<b>{line.get('title', 'Линия')}</b>\n{line.get('message', '')}"
         
         # Добавляем финальную часть
         narrative += "\n\n<i>Этот рассказ — отражение твоей нумерологической карты.</i>"
         
-        # Проверяем общую длину
-        if len(narrative) > 4000:
-            # Если слишком длинный, обрезаем
-            narrative = narrative[:3997] + "..."
-        
+        # Длину не режем: send_chunked разобьёт отчёт на сообщения
         return narrative
         
     except Exception as e:
         logger.error(f"Error in generate_full_report: {e}")
         return "🌟 <b>ПОЛНЫЙ ЭНЕРГЕТИЧЕСКИЙ ОТЧЁТ</b>\n\nК сожалению, произошла ошибка при генерации отчёта. Пожалуйста, попробуйте позже."
 
+# Поля профиля, которые читают генераторы отчётов (дату рождения и имя они не используют)
+REPORT_KEY_FIELDS = {
+    "free": ("mind", "action", "personal_year"),
+    "full": ("mind", "action", "realization", "destiny_lesson", "soul_urge", "personality", "personal_year", "karmic_debts"),
+}
+
+def report_flight_key(kind: str, profile: dict, matrix_data: dict = None) -> str:
+    """Ключ REPORT_FLIGHT: разные пользователи с одинаковыми числами делят одно вычисление"""
+    return flight_key(kind, [profile[field] for field in REPORT_KEY_FIELDS[kind]], matrix_data)
+
+# =============== ОТПРАВКА ДЛИННЫХ СООБЩЕНИЙ ===============
+CHUNK_TAGS = ("b", "i", "code")
+_CHUNK_TAG_RE = re.compile(r"<(/?)(b|i|code)>")
+# Перед переносом закрываем и заново открываем теги — держим на это запас
+_CHUNK_TAG_RESERVE = sum(len(f"<{tag}></{tag}>") for tag in CHUNK_TAGS)
+
+def utf16_len(text: str) -> int:
+    """Длина в UTF-16 code units — так считает лимиты Telegram"""
+    return len(text.encode("utf-16-le")) // 2
+
+def _hard_split(text: str, limit: int):
+    while utf16_len(text) > limit:
+        cut = limit
+        while utf16_len(text[:cut]) > limit:
+            cut -= 1
+        head = text[:cut]
+        # Не режем посреди тега или HTML-сущности
+        for opener, closer in (("<", ">"), ("&", ";")):
+            pos = head.rfind(opener)
+            if pos > 0 and head.rfind(closer) < pos:
+                head = head[:pos]
+        yield head
+        text = text[len(head):]
+    if text:
+        yield text
+
+def _split_pieces(text: str, limit: int):
+    """Абзацы, при нехватке места — предложения, затем строки, затем жёсткий разрез"""
+    for paragraph in re.split(r"(?<=\n\n)", text):
+        if utf16_len(paragraph) <= limit:
+            yield paragraph
+            continue
+        for sentence in re.split(r"(?<=[.!?…]\s)|(?<=\n)", paragraph):
+            if utf16_len(sentence) <= limit:
+                yield sentence
+            else:
+                yield from _hard_split(sentence, limit)
+
+def _update_open_tags(piece: str, open_tags: list) -> list:
+    open_tags = list(open_tags)
+    for closing, tag in _CHUNK_TAG_RE.findall(piece):
+        if not closing:
+            open_tags.append(tag)
+        elif tag in open_tags:
+            del open_tags[len(open_tags) - 1 - open_tags[::-1].index(tag)]
+    return open_tags
+
+def iter_message_chunks(text: str, limit: int = TELEGRAM_TEXT_LIMIT):
+    """Лениво режет HTML-текст на сообщения Telegram, сохраняя баланс <b>/<i>/<code>"""
+    budget = limit - _CHUNK_TAG_RESERVE
+    open_tags = []
+    prefix, current = "", ""
+    for piece in _split_pieces(text, budget):
+        if current.strip() and utf16_len(prefix + current + piece) > budget:
+            yield (prefix + current).rstrip() + "".join(f"</{tag}>" for tag in reversed(open_tags))
+            prefix, current = "".join(f"<{tag}>" for tag in open_tags), ""
+        current += piece
+        open_tags = _update_open_tags(piece, open_tags)
+    if current.strip():
+        yield (prefix + current).rstrip() + "".join(f"</{tag}>" for tag in reversed(open_tags))
+
+async def send_chunked(message: Message, text: str, parse_mode: str = "HTML", reply_markup=None):
+    """Отправляет части подряд; темп и повторы после RetryAfter обеспечивает OUTBOUND.
+    Клавиатура прикрепляется к последней части."""
+    chunks = iter_message_chunks(text)
+    part = next(chunks, None)
+    while part is not None:
+        following = next(chunks, None)
+        await message.answer(part, parse_mode=parse_mode, reply_markup=reply_markup if following is None else None)
+        part = following
+
+# =============== ДОСТАВКА ПРЕМИУМ-ОТЧЁТА ===============
+# Ключ медиа (путь к файлу или matrix:<вектор>) -> file_id, чтобы не загружать файл повторно
+MEDIA_FILE_IDS = {}
+PREMIUM_MEDIA_EXTENSIONS = ('.mp4', '.jpg', '.png', '.gif')
+
+def _media_kind(path: str) -> str:
+    if path.endswith('.mp4'):
+        return "video"
+    if path.endswith('.gif'):
+        return "animation"
+    return "photo"
+
+def _file_item(path: str) -> tuple:
+    async def upload():
+        return FSInputFile(path)
+    return path, _media_kind(path), upload
+
+async def _matrix_item(birth_date: str) -> tuple:
+    _, digit_counts = calculate_pythagoras_matrix(birth_date)
+    counts = matrix_counts(digit_counts)
+    name = matrix_cache_key(counts)
+    key = f"matrix:{name}"
+
+    async def upload():
+        # Нужен и при кэшированном file_id: если Telegram его отвергнет, PNG загружается заново
+        return BufferedInputFile(await get_matrix_png(counts), filename=f"matrix_{name}.png")
+
+    if key not in MEDIA_FILE_IDS:
+        # Рендерим заранее, пока уходит текст отчёта
+        await get_matrix_png(counts)
+    return key, "photo", upload
+
+def _remember_file_id(key: str, sent: Message):
+    media = sent.photo[-1] if sent.photo else (sent.video or sent.animation)
+    if media:
+        MEDIA_FILE_IDS[key] = media.file_id
+
+async def answer_media_item(message: Message, item: tuple, **kwargs):
+    key, kind, upload = item
+    method = getattr(message, f"answer_{kind}")
+    file_id = MEDIA_FILE_IDS.get(key)
+    if file_id:
+        try:
+            return await method(file_id, **kwargs)
+        except TelegramBadRequest as e:
+            logger.warning(f"Cached file_id for {key} rejected: {e}")
+            MEDIA_FILE_IDS.pop(key, None)
+    sent = await method(await upload(), **kwargs)
+    _remember_file_id(key, sent)
+    return sent
+
+async def send_album(message: Message, items: list):
+    """Отправляет фото/видео одним альбомом (один запрос вместо нескольких)"""
+    if len(items) == 1:
+        await answer_media_item(message, items[0])
+        return
+    for attempt in range(2):
+        media = [
+            (InputMediaVideo if kind == "video" else InputMediaPhoto)(media=MEDIA_FILE_IDS.get(key) or await upload())
+            for key, kind, upload in items
+        ]
+        try:
+            sent = await message.answer_media_group(media)
+        except TelegramBadRequest:
+            cached = [key for key, _, _ in items if key in MEDIA_FILE_IDS]
+            if attempt or not cached:
+                raise
+            for key in cached:
+                MEDIA_FILE_IDS.pop(key, None)
+            continue
+        for (key, _, _), sent_message in zip(items, sent):
+            _remember_file_id(key, sent_message)
+        return
+
+def _list_premium_media(karmic_debts: list) -> tuple:
+    return get_random_file("media/premium", PREMIUM_MEDIA_EXTENSIONS), get_karmic_files(karmic_debts)
+
+async def _prepare_premium_media(profile: dict) -> tuple:
+    premium, karmic = await IO_EXECUTOR.run(_list_premium_media, profile["karmic_debts"])
+    album = []
+    try:
+        album.append(await _matrix_item(profile["birth_date"]))
+    except Exception as e:
+        logger.error(f"Error preparing matrix image: {e}")
+    animation = None
+    if premium:
+        if _media_kind(premium) == "animation":
+            animation = _file_item(premium)
+        else:
+            album.append(_file_item(premium))
+    album.extend(_file_item(path) for path in karmic)
+    return animation, album[:10]
+
+async def deliver_premium_report(message: Message, profile: dict, matrix_data: dict, final_text: str, final_markup=None):
+    """Текст отчёта, затем альбом (матрица, премиум-медиа, кармические карты) и итоговое
+    сообщение. Медиа подбираются и рендерятся, пока собирается и уходит текст;
+    порядок сообщений в чате сохраняется."""
+    media_task = asyncio.ensure_future(_prepare_premium_media(profile))
+    try:
+        full_report = await REPORT_FLIGHT.run(
+            report_flight_key("full", profile, matrix_data), IO_EXECUTOR.run, generate_full_report, profile, matrix_data
+        )
+        await send_chunked(message, full_report)
+    except BaseException:
+        media_task.cancel()
+        raise
+    try:
+        animation, album = await media_task
+        if animation:
+            await answer_media_item(message, animation)
+        if album:
+            await send_album(message, album)
+    except Exception as e:
+        logger.error(f"Error sending premium media: {e}")
+    await message.answer(final_text, parse_mode="HTML", reply_markup=final_markup)
+
 # =============== ВАЛИДАЦИЯ ===============
 def validate_date(date_str: str) -> bool:
     try:
@@ -673,7 +2560,7 @@ def validate_date(date_str: str) -> bool:
         return False
 
 def validate_name(name: str) -> bool:
-    cleaned = name.strip().replace(" ", "")
+    cleaned = (name or "").strip().replace(" ", "")
     allowed = "АБВГДЕЁЖЗИЙКЛМНОПРСТУФХЦЧШЩЪЫЬЭЮЯабвгдеёжзийклмнопрстуфхцчшщъыьэюя"
     return len(cleaned) >= 3 and all(c in allowed for c in cleaned)
 
@@ -683,11 +2570,14 @@ class Form(StatesGroup):
     waiting_for_full_name = State()
     waiting_for_payment = State()
     waiting_for_broadcast_target = State()
+    waiting_for_broadcast_segment = State()
     waiting_for_broadcast_message = State()
     waiting_for_premium_user_id = State()
     waiting_for_home_input = State()
     waiting_for_car_input = State()
     waiting_for_promo_code = State()
+    waiting_for_promo_batch = State()
+    waiting_for_user_search = State()
 
 # =============== КЛАВИАТУРЫ ===============
 def get_main_keyboard(user_id: int, has_data: bool = False):
@@ -697,7 +2587,7 @@ def get_main_keyboard(user_id: int, has_data: bool = False):
         [KeyboardButton(text="🎁 Бонусы")],
         [KeyboardButton(text="🌞 Энергия дня")],
     ]
-    if has_
+    if has_data:
         keyboard.insert(0, [KeyboardButton(text="📈 Мой отчёт")])
     keyboard.append([KeyboardButton(text="🏠 Анализ квартиры")])
     keyboard.append([KeyboardButton(text="🚗 Анализ машины")])
@@ -719,8 +2609,11 @@ def get_admin_keyboard():
     return ReplyKeyboardMarkup(
         keyboard=[
             [KeyboardButton(text="👑 Выдать премиум"), KeyboardButton(text="🎫 Создать промокод")],
+            [KeyboardButton(text="📦 Пакет промокодов"), KeyboardButton(text="👥 Пользователи")],
             [KeyboardButton(text="📋 Список промокодов"), KeyboardButton(text="📊 Статистика")],
-            [KeyboardButton(text="📢 Рассылка"), KeyboardButton(text="🔙 На главную")]
+            [KeyboardButton(text="📉 Воронка"), KeyboardButton(text="🔁 Удержание")],
+            [KeyboardButton(text="📢 Рассылка"), KeyboardButton(text="📤 Экспорт")],
+            [KeyboardButton(text="🔙 На главную")]
         ],
         resize_keyboard=True
     )
@@ -736,29 +2629,648 @@ async def create_payment(user_id: int, description: str):
     }, uuid.uuid4())
     return payment
 
+# =============== ЗАЩИТА ОТ ФЛУДА ===============
+def parse_rate_limit(spec: str) -> tuple:
+    capacity, period = spec.split("/")
+    return float(capacity), float(period)
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated", "warned")
+
+    def __init__(self, capacity: float, now: float):
+        self.tokens = capacity
+        self.updated = now
+        self.warned = False
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Корзины токенов на пользователя (лимит выбирается флагом хендлера rate_limit)
+    и склейка одинаковых запросов: повторное нажатие, пока первое ещё обрабатывается,
+    не запускает вычисление заново. Состояние корзин — LRU ограниченного размера."""
+
+    def __init__(self, limits: dict, max_keys: int):
+        self.limits = {name: parse_rate_limit(spec) for name, spec in limits.items()}
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()
+        self.in_flight = {}
+
+    def _take(self, user_id: int, name: str):
+        """Возвращает (сколько секунд ждать — 0, если токен выдан; корзину)"""
+        capacity, period = self.limits.get(name, self.limits["default"])
+        rate = capacity / period
+        now = time.monotonic()
+        key = (user_id, name)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(capacity, now)
+            # Вытесненная корзина всё равно успела бы наполниться — сброс ничего не ломает
+            if len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+            bucket.tokens = min(capacity, bucket.tokens + (now - bucket.updated) * rate)
+            bucket.updated = now
+        if bucket.tokens >= 1:
+            bucket.tokens -= 1
+            bucket.warned = False
+            return 0, bucket
+        return (1 - bucket.tokens) / rate, bucket
+
+    @staticmethod
+    async def _soft_reply(event, text: str):
+        """Message.answer шлёт сообщение, CallbackQuery.answer — всплывающее уведомление"""
+        try:
+            await event.answer(text)
+        except Exception as e:
+            logger.warning(f"Throttle reply failed: {e}")
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+        payload = event.data if isinstance(event, CallbackQuery) else event.text
+        key = (user.id, data["handler"].callback, payload)
+        if key in self.in_flight:
+            METRICS.inc("throttle_coalesced")
+            if not self.in_flight[key]:
+                self.in_flight[key] = True
+                await self._soft_reply(event, "⏳ Уже обрабатываю ваш запрос, подождите немного...")
+            elif isinstance(event, CallbackQuery):
+                await self._soft_reply(event, "⏳ Подождите...")
+            return
+        if user.id != ADMIN_USER_ID:
+            wait, bucket = self._take(user.id, get_flag(data, "rate_limit", default="default"))
+            if wait:
+                METRICS.inc("throttle_limited")
+                if not bucket.warned:
+                    bucket.warned = True
+                    await self._soft_reply(event, f"⏳ Слишком часто. Попробуйте через {int(wait) + 1} сек.")
+                elif isinstance(event, CallbackQuery):
+                    await self._soft_reply(event, "⏳ Подождите...")
+                return
+        self.in_flight[key] = False
+        try:
+            return await handler(event, data)
+        finally:
+            del self.in_flight[key]
+
+THROTTLE = ThrottlingMiddleware(RATE_LIMITS, RATE_LIMIT_MAX_KEYS)
+
+# =============== ОГРАНИЧЕНИЕ ПАРАЛЛЕЛЬНОСТИ ===============
+class ConcurrencyLimit:
+    """Семафор с ограниченной очередью: встать в очередь можно, пока она короче max_queue,
+    ждать — не дольше max_wait секунд. Иначе acquire возвращает False и запрос сбрасывается."""
+
+    def __init__(self, name: str, limit: int, max_queue: int, max_wait: float):
+        self.name = name
+        self.semaphore = asyncio.Semaphore(limit)
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.waiting = 0
+        self.active = 0
+
+    async def acquire(self) -> bool:
+        started = time.perf_counter()
+        if not self.semaphore.locked():
+            # Свободный слот берётся без переключения задач
+            await self.semaphore.acquire()
+        elif self.waiting >= self.max_queue:
+            return False
+        else:
+            self.waiting += 1
+            METRICS.set(f"governor_queue_{self.name}", self.waiting)
+            try:
+                await asyncio.wait_for(self.semaphore.acquire(), self.max_wait)
+            except asyncio.TimeoutError:
+                return False
+            finally:
+                self.waiting -= 1
+                METRICS.set(f"governor_queue_{self.name}", self.waiting)
+        METRICS.observe(f"governor_wait_ms_{self.name}", (time.perf_counter() - started) * 1000)
+        self.active += 1
+        METRICS.set(f"governor_active_{self.name}", self.active)
+        return True
+
+    async def reacquire(self):
+        """Возврат слота апдейтом, который уже был принят: без лимита очереди и таймаута"""
+        await self.semaphore.acquire()
+        self.active += 1
+        METRICS.set(f"governor_active_{self.name}", self.active)
+
+    def release(self):
+        self.active -= 1
+        METRICS.set(f"governor_active_{self.name}", self.active)
+        self.semaphore.release()
+
+# Общий слот текущего апдейта: {"slot": ConcurrencyLimit или None, если слот отдан на время ожидания}
+GOVERNOR_SLOT = contextvars.ContextVar("governor_slot", default=None)
+
+class ConcurrencyGovernor(BaseMiddleware):
+    """Внешний middleware апдейтов держит общий лимит обработки, внутренний (на router)
+    — лимиты тяжёлых хендлеров. Лишнее ждёт в ограниченной очереди; при переполнении
+    или слишком долгом ожидании апдейт сбрасывается с мягким ответом. Админ не ограничивается.
+    Пока апдейт ждёт лимит своего хендлера, общий слот он отдаёт: поток тяжёлых запросов
+    не должен занимать все общие слоты и блокировать /start и остальные хендлеры."""
+
+    def __init__(self, limit: int, handler_limits: dict, max_queue: int, max_wait: float):
+        self.total = ConcurrencyLimit("all", limit, max_queue, max_wait)
+        self.handlers = {
+            name: ConcurrencyLimit(name, handler_limit, max_queue, max_wait)
+            for name, handler_limit in handler_limits.items()
+        }
+        self.in_flight = set()
+
+    async def __call__(self, handler, event, data):
+        if not isinstance(event, Update):
+            return await self._handler_limited(self.handlers.get(get_flag(data, "rate_limit", default="default")), handler, event, data)
+        # Задачи апдейтов в обработке (и в очереди) — их дожидается остановка бота
+        task = asyncio.current_task()
+        self.in_flight.add(task)
+        try:
+            return await self._limited(self.total, handler, event, data)
+        finally:
+            self.in_flight.discard(task)
+
+    async def drain(self, timeout: float) -> int:
+        """Ждёт апдейты в обработке; не успевшие за timeout отменяет. Возвращает число отменённых."""
+        pending = set(self.in_flight)
+        if not pending:
+            return 0
+        _, pending = await asyncio.wait(pending, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.wait(pending, timeout=1)
+        return len(pending)
+
+    @staticmethod
+    async def _shed(limiter, event):
+        METRICS.inc(f"governor_shed_{limiter.name}")
+        target = (event.message or event.callback_query) if isinstance(event, Update) else event
+        if target is not None:
+            await ThrottlingMiddleware._soft_reply(target, "⚠️ Бот сейчас перегружен. Повторите, пожалуйста, через минуту.")
+
+    async def _limited(self, limiter, handler, event, data):
+        user = data.get("event_from_user")
+        if limiter is None or (user and user.id == ADMIN_USER_ID):
+            return await handler(event, data)
+        if not await limiter.acquire():
+            await self._shed(limiter, event)
+            return
+        held = {"slot": limiter}
+        token = GOVERNOR_SLOT.set(held)
+        try:
+            return await handler(event, data)
+        finally:
+            GOVERNOR_SLOT.reset(token)
+            if held["slot"] is not None:
+                held["slot"].release()
+
+    async def _handler_limited(self, limiter, handler, event, data):
+        user = data.get("event_from_user")
+        if limiter is None or (user and user.id == ADMIN_USER_ID):
+            return await handler(event, data)
+        held = GOVERNOR_SLOT.get()
+        yielded = held is not None and held["slot"] is not None and limiter.semaphore.locked()
+        if yielded:
+            held["slot"] = None
+            self.total.release()
+        # При отмене или сбросе общий слот уже отдан — внешнему middleware освобождать нечего
+        if not await limiter.acquire():
+            await self._shed(limiter, event)
+            return
+        try:
+            if yielded:
+                await self.total.reacquire()
+                held["slot"] = self.total
+            return await handler(event, data)
+        finally:
+            limiter.release()
+
+GOVERNOR = ConcurrencyGovernor(GOVERNOR_CONCURRENCY, HANDLER_CONCURRENCY, GOVERNOR_MAX_QUEUE, GOVERNOR_MAX_WAIT)
+
+# =============== АКТИВНЫЕ ПОЛЬЗОВАТЕЛИ ===============
+MASK64 = (1 << 64) - 1
+HLL_POWERS = [2.0 ** -r for r in range(65)]
+
+def mix64(value: int) -> int:
+    """splitmix64: равномерный 64-битный хеш от user_id без hashlib"""
+    value = (value + 0x9E3779B97F4A7C15) & MASK64
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & MASK64
+    return value ^ (value >> 31)
+
+class HyperLogLog:
+    """Оценка числа уникальных значений в фиксированных 2^precision байтах.
+    Скетчи объединяются поэлементным максимумом регистров — так из дневных получаются WAU/MAU."""
+    __slots__ = ("precision", "registers")
+
+    def __init__(self, precision: int = HLL_PRECISION, registers: bytes = None):
+        self.precision = precision
+        self.registers = bytearray(registers) if registers else bytearray(1 << precision)
+
+    def add(self, value: int):
+        hashed = mix64(value)
+        index = hashed >> (64 - self.precision)
+        rest = hashed & ((1 << (64 - self.precision)) - 1)
+        rank = 64 - self.precision - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other: "HyperLogLog") -> "HyperLogLog":
+        return HyperLogLog(self.precision, bytes(map(max, self.registers, other.registers)))
+
+    def count(self) -> int:
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(HLL_POWERS[r] for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            # Малые значения: линейный счёт по пустым регистрам точнее
+            estimate = m * math.log(m / zeros)
+        return round(estimate)
+
+class ActivityMiddleware(BaseMiddleware):
+    """Отмечает автора каждого апдейта в скетче текущего дня (UTC).
+    Память постоянна: HLL_KEEP_DAYS скетчей по 2^HLL_PRECISION байт."""
+
+    def __init__(self, precision: int = HLL_PRECISION, keep_days: int = HLL_KEEP_DAYS):
+        self.precision = precision
+        self.keep_days = keep_days
+        self.sketches = {}
+        self.dirty = set()
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user:
+            self.add(user.id)
+        return await handler(event, data)
+
+    def add(self, user_id: int, day: str = None):
+        day = day or utc_now()[:10]
+        sketch = self.sketches.get(day)
+        if sketch is None:
+            sketch = self.sketches[day] = HyperLogLog(self.precision)
+        sketch.add(user_id)
+        self.dirty.add(day)
+
+    def _since(self) -> str:
+        return (date.fromisoformat(utc_now()[:10]) - timedelta(days=self.keep_days - 1)).isoformat()
+
+    async def load(self):
+        for day, registers in await storage.sketches.load(self._since()):
+            if len(registers) == 1 << self.precision:
+                self.sketches[day] = HyperLogLog(self.precision, registers)
+            else:
+                logger.warning(f"Skip activity sketch {day}: precision changed")
+
+    async def flush(self):
+        """Сохраняет изменённые скетчи и забывает дни старше окна"""
+        since = self._since()
+        for day in [day for day in self.sketches if day < since]:
+            del self.sketches[day]
+            self.dirty.discard(day)
+        days, self.dirty = self.dirty, set()
+        rows = [(day, bytes(self.sketches[day].registers)) for day in sorted(days)]
+        try:
+            if rows:
+                await storage.sketches.save(rows)
+            await storage.sketches.prune(since)
+        except Exception:
+            self.dirty |= days
+            raise
+
+    async def run(self, interval: float = HLL_FLUSH_INTERVAL):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Activity sketch flush failed: {e}")
+
+    def _count_window(self, sketches: list) -> int:
+        merged = HyperLogLog(self.precision)
+        for sketch in sketches:
+            merged = merged.merge(sketch)
+        return merged.count()
+
+    async def summary(self) -> tuple:
+        """(DAU, WAU, MAU) по скетчам последних 1/7/30 дней; объединение идёт в потоке"""
+        today = date.fromisoformat(utc_now()[:10])
+        # Снимки регистров: middleware продолжает писать в живые скетчи
+        snapshot = {day: HyperLogLog(sketch.precision, bytes(sketch.registers)) for day, sketch in self.sketches.items()}
+        result = []
+        for days in (1, 7, 30):
+            since = (today - timedelta(days=days - 1)).isoformat()
+            window = [sketch for day, sketch in snapshot.items() if day >= since]
+            result.append(await asyncio.to_thread(self._count_window, window))
+        return tuple(result)
+
+ACTIVITY = ActivityMiddleware()
+
+# =============== ЗАПИСЬ ТРАФИКА ===============
+# Ключи объектов Telegram, описывающих пользователя или чат
+TRAFFIC_PERSON_KEYS = ("from", "chat", "user", "sender_chat", "forward_from", "forward_from_chat")
+# Введённое имя заменяется одной заглушкой: проходит validate_name, как и оригинал
+TRAFFIC_NAME_PLACEHOLDER = "Иван Иванович Иванов"
+# Дата рождения заменяется датой из этого диапазона (проходит validate_date)
+TRAFFIC_DATE_START = date(1950, 1, 1)
+TRAFFIC_DATE_SPAN = (date(2005, 12, 31) - TRAFFIC_DATE_START).days + 1
+
+def anonymize_id(value: int, salt: bytes) -> int:
+    """Стабильный (при той же соли) положительный id вместо настоящего"""
+    digest = hashlib.blake2b(str(value).encode(), key=salt, digest_size=5).digest()
+    return int.from_bytes(digest, "big") + 1
+
+def anonymize_date(value: str, salt: bytes) -> str:
+    """Стабильная (при той же соли) настоящая дата вместо даты рождения:
+    расчёт при воспроизведении проходит тот же путь, исходная дата не сохраняется"""
+    digest = hashlib.blake2b(value.encode(), key=salt, digest_size=4, person=b"birth_date").digest()
+    fake = TRAFFIC_DATE_START + timedelta(days=int.from_bytes(digest, "big") % TRAFFIC_DATE_SPAN)
+    return fake.strftime("%d.%m.%Y")
+
+def anonymize_update(node, salt: bytes):
+    """Обезличивает выгрузку Update на месте: id, имена и юзернеймы людей и чатов,
+    контакты, тексты, похожие на ФИО, и даты рождения."""
+    if isinstance(node, list):
+        for item in node:
+            anonymize_update(item, salt)
+        return node
+    if not isinstance(node, dict):
+        return node
+    node.pop("contact", None)
+    text = node.get("text")
+    if isinstance(text, str) and not text.startswith("/"):
+        if validate_date(text.strip()):
+            node["text"] = anonymize_date(text.strip(), salt)
+        elif validate_name(text):
+            node["text"] = TRAFFIC_NAME_PLACEHOLDER
+    for key in TRAFFIC_PERSON_KEYS:
+        person = node.get(key)
+        if isinstance(person, dict) and isinstance(person.get("id"), int):
+            anon = anonymize_id(person["id"], salt)
+            person["id"] = -anon if person["id"] < 0 else anon
+            for field in ("last_name", "bio", "phone_number"):
+                person.pop(field, None)
+            if "first_name" in person:
+                person["first_name"] = "User"
+            if "username" in person:
+                person["username"] = f"user{anon}"
+            if "title" in person:
+                person["title"] = f"Chat {anon}"
+    for value in node.values():
+        anonymize_update(value, salt)
+    return node
+
+class TrafficRecorder(BaseMiddleware):
+    """Пишет апдейты в JSONL: время прихода, время обработки и обезличенный Update.
+    В обработке апдейта — только добавление в буфер; выгрузка модели, обезличивание и запись
+    идут пачками в IO_EXECUTOR из фоновой задачи. Файл потом проигрывается командой replay."""
+
+    def __init__(self, path: str, salt: bytes, capacity: int = TRAFFIC_BUFFER):
+        self.path = path
+        self.salt = salt
+        self.buffer = deque(maxlen=capacity)
+        self.file = None
+        self._lock = threading.Lock()
+
+    async def __call__(self, handler, event, data):
+        arrived = time.time()
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            if len(self.buffer) == self.buffer.maxlen:
+                METRICS.inc("traffic_dropped")
+            self.buffer.append((event, arrived, (time.perf_counter() - started) * 1000))
+
+    def _write(self, records: list) -> int:
+        """Выполняется в потоке; отменённый сброс может ещё писать, пока идёт следующий — отсюда замок"""
+        lines = []
+        for update, arrived, duration_ms in records:
+            try:
+                payload = anonymize_update(update.model_dump(mode="json", exclude_none=True, by_alias=True), self.salt)
+                record = {"ts": round(arrived, 4), "ms": round(duration_ms, 2), "update": payload}
+                lines.append(json.dumps(record, ensure_ascii=False) + "\n")
+            except Exception as e:
+                logger.error(f"Traffic recording failed: {e}")
+        with self._lock:
+            if self.file is None:
+                self.file = open(self.path, "a", encoding="utf-8")
+            self.file.write("".join(lines))
+            self.file.flush()
+        return len(lines)
+
+    async def flush(self) -> int:
+        if not self.buffer:
+            return 0
+        records = list(self.buffer)
+        self.buffer.clear()
+        try:
+            written = await IO_EXECUTOR.run(self._write, records)
+        except ExecutorBusy:
+            # До записи дело не дошло — пачка вернётся в начало буфера
+            self.buffer.extendleft(reversed(records))
+            raise
+        METRICS.inc("traffic_recorded", written)
+        return written
+
+    async def run(self, interval: float = TRAFFIC_FLUSH_INTERVAL):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                METRICS.inc("traffic_flush_failures")
+                logger.error(f"Traffic flush failed: {e}")
+
+    def close(self):
+        with self._lock:
+            if self.file:
+                self.file.close()
+                self.file = None
+
+RECORDER = TrafficRecorder(TRAFFIC_LOG, TRAFFIC_SALT.encode() or secrets.token_bytes(16)) if TRAFFIC_LOG else None
+
+# =============== ИСХОДЯЩИЕ СООБЩЕНИЯ ===============
+# Полосы по убыванию приоритета: ответы пользователю, уведомления о событиях, рассылки
+OUTBOUND_LANES = ("interactive", "transactional", "bulk")
+LANE_INTERACTIVE, LANE_TRANSACTIONAL, LANE_BULK = range(len(OUTBOUND_LANES))
+OUTBOUND_LANE = contextvars.ContextVar("outbound_lane", default=LANE_INTERACTIVE)
+# Методы, на которые распространяются лимиты Telegram на сообщения
+OUTBOUND_LIMITED_PREFIXES = ("Send", "Copy", "Forward")
+
+@contextmanager
+def outbound_lane(lane: int):
+    """Все отправки внутри блока (в этой задаче) идут по указанной полосе"""
+    token = OUTBOUND_LANE.set(lane)
+    try:
+        yield
+    finally:
+        OUTBOUND_LANE.reset(token)
+
+class OutboundDispatcher(BaseRequestMiddleware):
+    """Middleware сессии бота: через него проходит каждый вызов Bot API, включая message.answer.
+    Сообщения получают слот общего лимита OUTBOUND_RATE строго по приоритету полос, так что
+    рассылка не отнимает пропускную способность у живых ответов. Темп в один чат — корзина токенов.
+    RetryAfter приостанавливает все отправки и повторяет запрос до SEND_RETRIES раз."""
+
+    def __init__(self, rate: float = OUTBOUND_RATE, chat_rate: float = OUTBOUND_CHAT_RATE,
+                 chat_burst: float = OUTBOUND_CHAT_BURST, max_chats: int = OUTBOUND_MAX_CHATS):
+        self.interval = 1 / rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_chats = max_chats
+        self.lanes = [deque() for _ in OUTBOUND_LANES]
+        self.chats = OrderedDict()
+        self.next_slot = 0.0
+        self._pump_task = None
+
+    def _chat_delay(self, chat_id, now: float) -> float:
+        """Резервирует токен чата; возвращает, сколько ждать до него (токены уходят в минус)"""
+        bucket = self.chats.get(chat_id)
+        if bucket is None:
+            bucket = self.chats[chat_id] = TokenBucket(self.chat_burst, now)
+            if len(self.chats) > self.max_chats:
+                self.chats.popitem(last=False)
+        else:
+            self.chats.move_to_end(chat_id)
+            bucket.tokens = min(self.chat_burst, bucket.tokens + (now - bucket.updated) * self.chat_rate)
+            bucket.updated = now
+        bucket.tokens -= 1
+        return max(-bucket.tokens / self.chat_rate, 0.0)
+
+    async def _admit(self, lane: int):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        if self._pump_task is None and now >= self.next_slot:
+            self.next_slot = now + self.interval
+            return
+        waiter = loop.create_future()
+        self.lanes[lane].append(waiter)
+        METRICS.set(f"outbound_queue_{OUTBOUND_LANES[lane]}", len(self.lanes[lane]))
+        if self._pump_task is None:
+            self._pump_task = asyncio.create_task(self._pump())
+        await waiter
+
+    async def _pump(self):
+        """Раздаёт слоты по одному раз в interval: первой — самой приоритетной непустой полосе"""
+        loop = asyncio.get_running_loop()
+        try:
+            while any(self.lanes):
+                delay = self.next_slot - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                for lane, queue in enumerate(self.lanes):
+                    while queue and queue[0].done():
+                        queue.popleft()
+                    if queue:
+                        queue.popleft().set_result(None)
+                        METRICS.set(f"outbound_queue_{OUTBOUND_LANES[lane]}", len(queue))
+                        break
+                self.next_slot = max(self.next_slot, loop.time()) + self.interval
+        finally:
+            self._pump_task = None
+
+    async def __call__(self, make_request, bot, method):
+        if not type(method).__name__.startswith(OUTBOUND_LIMITED_PREFIXES):
+            return await make_request(bot, method)
+        lane = OUTBOUND_LANE.get()
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        chat_delay = self._chat_delay(getattr(method, "chat_id", None), started)
+        if chat_delay:
+            await asyncio.sleep(chat_delay)
+        for attempt in range(SEND_RETRIES):
+            await self._admit(lane)
+            if attempt == 0:
+                METRICS.observe(f"outbound_wait_ms_{OUTBOUND_LANES[lane]}", (loop.time() - started) * 1000)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                METRICS.inc("outbound_retry_after")
+                if attempt == SEND_RETRIES - 1:
+                    raise
+                logger.warning(f"Flood control on {type(method).__name__}, pausing sends for {e.retry_after}s")
+                self.next_slot = max(self.next_slot, loop.time() + e.retry_after)
+
+OUTBOUND = OutboundDispatcher()
+
 # =============== AIOGRAM БОТ ===============
+class BotApiSession(AiohttpSession):
+    """AiohttpSession со своим TCPConnector: пул, keep-alive и кеш DNS задаются явно.
+    aiogram получает клиент только через create_session, поэтому его внутренние
+    настройки коннектора не трогаем."""
+
+    def __init__(self, pool_size: int = HTTP_POOL_SIZE, keepalive: float = HTTP_KEEPALIVE,
+                 dns_ttl: int = HTTP_DNS_TTL, force_close: bool = False, **kwargs):
+        super().__init__(limit=pool_size, **kwargs)
+        self.pool_size = pool_size
+        self.keepalive = keepalive
+        self.dns_ttl = dns_ttl
+        self.force_close = force_close
+        self.ssl_context = ssl.create_default_context(cafile=certifi.where())
+        self.client = None
+
+    def create_connector(self) -> TCPConnector:
+        options = {"limit": self.pool_size, "ttl_dns_cache": self.dns_ttl, "ssl": self.ssl_context}
+        # keepalive_timeout и force_close aiohttp вместе не принимает
+        if self.force_close:
+            options["force_close"] = True
+        else:
+            options["keepalive_timeout"] = self.keepalive
+        return TCPConnector(**options)
+
+    async def create_session(self) -> ClientSession:
+        if self.client is None or self.client.closed:
+            self.client = ClientSession(
+                connector=self.create_connector(),
+                headers={"User-Agent": f"aiogram/{AIOGRAM_VERSION}"},
+            )
+        return self.client
+
+    async def close(self):
+        if self.client is not None and not self.client.closed:
+            await self.client.close()
+        await super().close()
+
+def create_bot_session(api_url: str = BOT_API_URL, pool_size: int = HTTP_POOL_SIZE,
+                       keepalive: float = HTTP_KEEPALIVE, dns_ttl: int = HTTP_DNS_TTL,
+                       timeout: float = HTTP_TIMEOUT, force_close: bool = False) -> BotApiSession:
+    """aiohttp-сессия Bot API: соединения переиспользуются keepalive секунд,
+    DNS кешируется dns_ttl секунд, одновременно открыто не больше pool_size соединений"""
+    api = TelegramAPIServer.from_base(api_url, is_local=BOT_API_LOCAL) if api_url else PRODUCTION
+    return BotApiSession(pool_size, keepalive, dns_ttl, force_close, api=api, timeout=timeout)
+
 router = Router()
-bot = Bot(token=BOT_TOKEN)
+router.message.middleware(THROTTLE)
+router.callback_query.middleware(THROTTLE)
+router.message.middleware(GOVERNOR)
+router.callback_query.middleware(GOVERNOR)
 dp = Dispatcher()
+dp.update.outer_middleware(ACTIVITY)
+if RECORDER:
+    dp.update.outer_middleware(RECORDER)
+dp.update.outer_middleware(GOVERNOR)
+# Выставляется в начале остановки: длинные циклы (рассылка) сохраняют прогресс и выходят
+SHUTDOWN = asyncio.Event()
 
 # =============== ОСНОВНЫЕ КОМАНДЫ ===============
 @router.message(Command("start"))
 async def cmd_start(message: Message, state: FSMContext):
     await state.clear()
-    await update_user_session(message.from_user.id)
-    await save_user(
+    has_data, _ = await storage.start_session(
         message.from_user.id,
         message.from_user.username,
         message.from_user.full_name or "Unknown"
     )
-    has_data = await user_has_data(message.from_user.id)
+    ANALYTICS.track("start", message.from_user.id)
     welcome_img = get_random_file("media/welcome", ('.jpg', '.png', '.gif'))
     caption = (
         "🌌 Ты не случайно оказался здесь.\n"
         "Этот бот — не просто расчёт чисел.\n"
         "Это <b>карта твоя души</b>, составленная из даты рождения и имени.\n"
     )
-    if has_
+    if has_data:
         caption += (
             "✅ <b>У тебя уже есть сохраненные данные!</b>\n"
             "Ты можешь:\n"
@@ -771,7 +3283,7 @@ async def cmd_start(message: Message, state: FSMContext):
             "✨ <b>Бесплатно</b> — общий прогноз:\n"
             "— С какой энергией ты пришёл в этот мир\n"
             "— Какую миссию выбрала твоя душа\n"
-            "— Что ждёт тебя в 2026 году\n\n"
+            f"— Что ждёт тебя в {numerology_year()} году\n\n"
             "💎 <b>В премиум-версии</b> — глубокое понимание себя:\n"
             "— Число Сердца и Личности\n"
             "— Кармические долги и пути их преодоления\n"
@@ -802,121 +3314,47 @@ async def start_new_calculation(message: Message, state: FSMContext):
     )
     await state.set_state(Form.waiting_for_birth_date)
 
-@router.message(F.text == "📈 Мой отчёт")
+@router.message(F.text == "📈 Мой отчёт", flags={"rate_limit": "report"})
 async def show_my_report(message: Message, state: FSMContext):
     user_id = message.from_user.id
     
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            cursor = await db.execute(
-                "SELECT birth_date, full_name, status, archetype FROM users WHERE user_id = ?",
-                (user_id,)
+        user = await storage.users.get(user_id)
+        if not user or not user["birth_date"] or not user["full_name"]:
+            await message.answer(
+                "📝 <b>У ВАС ЕЩЁ НЕТ СОХРАНЕННОГО ОТЧЁТА</b>\n\n"
+                "Сначала создайте отчёт, нажав «🔄 Новый расчёт» и введя свои данные.",
+                parse_mode="HTML",
+                reply_markup=get_main_keyboard(user_id, False)
             )
-            row = await cursor.fetchone()
-            
-            if not row or not row[0] or not row[1]:
-                await message.answer(
-                    "📝 <b>У ВАС ЕЩЁ НЕТ СОХРАНЕННОГО ОТЧЁТА</b>\n\n"
-                    "Сначала создайте отчёт, нажав «🔄 Новый расчёт» и введя свои данные.",
-                    parse_mode="HTML",
-                    reply_markup=get_main_keyboard(user_id, False)
-                )
-                return
-            
-            birth_date, full_name, current_status, archetype = row
-            
-        profile = calculate_numerology_profile(birth_date, full_name, CURRENT_YEAR)
+            return
         
-        matrix, digit_counts = calculate_pythagoras_matrix(birth_date)
-        matrix_visual = generate_matrix_visual(matrix)
-        line_analysis = analyze_pythagoras_lines(digit_counts)
+        birth_date, full_name = user["birth_date"], user["full_name"]
+        current_status, archetype = user["status"], user["archetype"]
         
-        if not archetype:
-            archetype = determine_archetype(digit_counts)
-            async with aiosqlite.connect(DB_PATH) as db:
-                await db.execute(
-                    "UPDATE users SET archetype = ? WHERE user_id = ?",
-                    (archetype, user_id)
-                )
-                await db.commit()
+        profile, matrix_data = await CPU_EXECUTOR.run(compute_report_data, birth_date, full_name, numerology_year())
         
-        matrix_data = {
-            "matrix_visual": matrix_visual,
-            "line_analysis": line_analysis,
-            "archetype": archetype
-        }
+        if archetype:
+            matrix_data["archetype"] = archetype
+        else:
+            archetype = matrix_data["archetype"]
+            await storage.users.set_archetype(user_id, archetype)
         
         if current_status == "paid":
-            # Генерируем и отправляем отчет частями
-            full_report = generate_full_report(profile, matrix_data)
-            
-            # Разбиваем на части если нужно
-            if len(full_report) > 4000:
-                parts = []
-                current_part = ""
-                
-                # Делим по абзацам
-                paragraphs = full_report.split('\n\n')
-                for para in paragraphs:
-                    if len(current_part) + len(para) + 2 > 4000:
-                        parts.append(current_part)
-                        current_part = para
-                    else:
-                        if current_part:
-                            current_part += "\n\n" + para
-                        else:
-                            current_part = para
-                
-                if current_part:
-                    parts.append(current_part)
-                
-                # Отправляем все части
-                for i, part in enumerate(parts):
-                    try:
-                        await message.answer(part, parse_mode="HTML")
-                        if i < len(parts) - 1:  # Небольшая задержка между сообщениями
-                            await asyncio.sleep(0.5)
-                    except Exception as e:
-                        logger.error(f"Error sending part {i}: {e}")
-            else:
-                await message.answer(full_report, parse_mode="HTML")
-            
-            # Отправляем медиа
-            try:
-                premium_media = get_random_file("media/premium", ('.mp4', '.jpg', '.png', '.gif'))
-                if premium_media:
-                    if premium_media.endswith('.mp4'):
-                        await message.answer_video(video=FSInputFile(premium_media))
-                    elif premium_media.endswith('.gif'):
-                        await message.answer_animation(animation=FSInputFile(premium_media))
-                    else:
-                        await message.answer_photo(photo=FSInputFile(premium_media))
-            except Exception as e:
-                logger.error(f"Error sending premium media: {e}")
-            
-            # Кармические изображения
-            for img_path in get_karmic_files(profile['karmic_debts']):
-                if os.path.exists(img_path):
-                    try:
-                        await message.answer_photo(photo=FSInputFile(img_path))
-                    except Exception as e:
-                        logger.error(f"Error sending karmic image {img_path}: {e}")
-            
-            await message.answer(
+            await deliver_premium_report(
+                message, profile, matrix_data,
                 "✨ <b>ВАШ ПРЕМИУМ-ОТЧЁТ ЗАГРУЖЕН!</b>",
-                parse_mode="HTML",
-                reply_markup=get_report_keyboard()
+                get_report_keyboard()
             )
             
         else:
             # Бесплатный отчет
-            free_report = generate_free_report(profile)
+            free_report = await REPORT_FLIGHT.run(
+                report_flight_key("free", profile), IO_EXECUTOR.run, generate_free_report, profile
+            )
             await state.update_data(profile=profile, matrix_data=matrix_data)
             
-            if len(free_report) > 4000:
-                free_report = free_report[:3997] + "..."
-            
-            await message.answer(free_report, parse_mode="HTML")
+            await send_chunked(message, free_report)
             
             free_img = get_random_file("media/free", ('.jpg', '.png', '.gif'))
             if free_img:
@@ -942,6 +3380,13 @@ async def show_my_report(message: Message, state: FSMContext):
             )
             await state.set_state(Form.waiting_for_payment)
             
+    except (ExecutorBusy, asyncio.TimeoutError):
+        logger.warning(f"Report executor overloaded, user {user_id}")
+        await message.answer(
+            "⏳ <b>СЕЙЧАС МНОГО ЗАПРОСОВ</b>\n\n"
+            "Отчёт не успел собраться. Пожалуйста, повторите через минуту.",
+            parse_mode="HTML"
+        )
     except Exception as e:
         logger.error(f"Error in show_my_report for user {user_id}: {e}", exc_info=True)
         
@@ -967,34 +3412,27 @@ async def show_my_report(message: Message, state: FSMContext):
 @router.message(F.text == "📊 Моя статистика")
 async def show_stats(message: Message):
     user_id = message.from_user.id
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("""
-        SELECT us.session_count, us.last_active, u.status, u.archetype, u.birth_date, u.full_name
-        FROM user_sessions us
-        LEFT JOIN users u ON us.user_id = u.user_id
-        WHERE us.user_id = ?
-        """, (user_id,))
-        row = await cursor.fetchone()
-        if row:
-            sessions, last_active, status, archetype, birth_date, full_name = row
-            stats_text = (
-                f"📊 <b>ВАША СТАТИСТИКА</b>\n"
-                f"• Сессий: {sessions}\n"
-                f"• Последняя активность: {last_active[:16] if last_active else 'Нет'}\n"
-                f"• Статус: {'💎 ПРЕМИУМ' if status == 'paid' else '🆓 БЕСПЛАТНЫЙ'}\n"
-            )
-            if archetype:
-                stats_text += f"• Архетип: {archetype}\n"
-            if birth_date and full_name:
-                stats_text += f"• Данные: сохранены ✅\n"
-                stats_text += f"• Дата рождения: {birth_date}\n"
-                stats_text += f"• Имя: {full_name}\n"
-            else:
-                stats_text += f"• Данные: не сохранены ❌\n"
-            stats_text += "\n🎯 <b>Чем больше сессий — тем точнее анализ!</b>"
-            await message.answer(stats_text, parse_mode="HTML")
+    row = await storage.sessions.stats(user_id)
+    if row:
+        sessions, last_active, status, archetype, birth_date, full_name = row
+        stats_text = (
+            f"📊 <b>ВАША СТАТИСТИКА</b>\n"
+            f"• Сессий: {sessions}\n"
+            f"• Последняя активность: {last_active[:16] if last_active else 'Нет'}\n"
+            f"• Статус: {'💎 ПРЕМИУМ' if status == 'paid' else '🆓 БЕСПЛАТНЫЙ'}\n"
+        )
+        if archetype:
+            stats_text += f"• Архетип: {archetype}\n"
+        if birth_date and full_name:
+            stats_text += f"• Данные: сохранены ✅\n"
+            stats_text += f"• Дата рождения: {birth_date}\n"
+            stats_text += f"• Имя: {full_name}\n"
         else:
-            await message.answer("Сделайте первый расчёт!")
+            stats_text += f"• Данные: не сохранены ❌\n"
+        stats_text += "\n🎯 <b>Чем больше сессий — тем точнее анализ!</b>"
+        await message.answer(stats_text, parse_mode="HTML")
+    else:
+        await message.answer("Сделайте первый расчёт!")
 
 @router.message(F.text == "🎁 Бонусы")
 async def show_bonuses(message: Message):
@@ -1011,43 +3449,42 @@ async def show_bonuses(message: Message):
         "• Энергия дня каждый день\n\n"
         "<i>Чем больше исследуешь — тем больше открываешь!</i>",
         parse_mode="HTML"
-    )
-
-# =============== ЭНЕРГИЯ ДНЯ ===============
-@router.message(F.text == "🌞 Энергия дня")
-async def daily_energy_handler(message: Message):
-    user_id = message.from_user.id
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("SELECT birth_date, status FROM users WHERE user_id = ?", (user_id,))
-        row = await cursor.fetchone()
-        if not row or not row[0]:
-            await message.answer(
-                "📅 <b>СНАЧАЛА ЗАПОЛНИТЕ ДАННЫЕ</b>\n"
-                "Для расчета энергии дня мне нужна ваша дата рождения.\n"
-                "Нажмите «🔄 Новый расчёт» и введите данные.",
-                parse_mode="HTML"
-            )
-            return
-        birth_date, current_status = row
-        if current_status != "paid":
-            buy_kb = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text=f"💎 Получить премиум — {PRICE} ₽", callback_data="buy_full")],
-                [InlineKeyboardButton(text="🎁 Ввести промокод", callback_data="enter_promo")]
-            ])
-            await message.answer(
-                "🔒 <b>ЭНЕРГИЯ ДНЯ — ПРЕМИУМ-ФУНКЦИЯ</b>\n"
-                "Расчет персональной энергии дня доступен только в премиум-версии.\n\n"
-                "💎 <b>Что дает премиум:</b>\n"
-                "• Персональная энергия на каждый день\n"
-                "• Рекомендации по активности\n"
-                "• Лучшее время для принятия решений\n"
-                "• Анализ совместимости с жильем и авто\n"
-                "• Полный нумерологический разбор\n"
-                "• Энергия дня каждый день",
-                parse_mode="HTML",
-                reply_markup=buy_kb
-            )
-            return
+    )
+
+# =============== ЭНЕРГИЯ ДНЯ ===============
+@router.message(F.text == "🌞 Энергия дня", flags={"rate_limit": "energy"})
+async def daily_energy_handler(message: Message):
+    user_id = message.from_user.id
+    user = await storage.users.get(user_id)
+    if not user or not user["birth_date"]:
+        await message.answer(
+            "📅 <b>СНАЧАЛА ЗАПОЛНИТЕ ДАННЫЕ</b>\n"
+            "Для расчета энергии дня мне нужна ваша дата рождения.\n"
+            "Нажмите «🔄 Новый расчёт» и введите данные.",
+            parse_mode="HTML"
+        )
+        return
+    birth_date, current_status = user["birth_date"], user["status"]
+    if current_status != "paid":
+        buy_kb = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text=f"💎 Получить премиум — {PRICE} ₽", callback_data="buy_full")],
+            [InlineKeyboardButton(text="🎁 Ввести промокод", callback_data="enter_promo")]
+        ])
+        await message.answer(
+            "🔒 <b>ЭНЕРГИЯ ДНЯ — ПРЕМИУМ-ФУНКЦИЯ</b>\n"
+            "Расчет персональной энергии дня доступен только в премиум-версии.\n\n"
+            "💎 <b>Что дает премиум:</b>\n"
+            "• Персональная энергия на каждый день\n"
+            "• Рекомендации по активности\n"
+            "• Лучшее время для принятия решений\n"
+            "• Анализ совместимости с жильем и авто\n"
+            "• Полный нумерологический разбор\n"
+            "• Энергия дня каждый день",
+            parse_mode="HTML",
+            reply_markup=buy_kb
+        )
+        return
+    ANALYTICS.track("energy", user_id)
     day_part = birth_date.split(".")[0]
     today_day = datetime.now().strftime("%d")
     energy = calculate_daily_energy(day_part, today_day)
@@ -1087,7 +3524,9 @@ async def daily_energy_handler(message: Message):
         message_text += f"{i}. {rec}\n"
     message_text += "\n✨ <i>Используйте эту энергию максимально эффективно!</i>"
     await message.answer(message_text, parse_mode="HTML")
-    energy_image = get_random_daily_energy_image(energy)
+    energy_image = await NARRATIVE_FLIGHT.run(
+        flight_key("daily_energy_image", energy), IO_EXECUTOR.run, get_random_daily_energy_image, energy
+    )
     if energy_image:
         try:
             await message.answer_photo(photo=FSInputFile(energy_image))
@@ -1099,22 +3538,21 @@ async def daily_energy_handler(message: Message):
 async def admin_panel(message: Message, state: FSMContext):
     if message.from_user.id != ADMIN_USER_ID:
         return
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("SELECT COUNT(*) FROM users")
-        total_users = (await cursor.fetchone())[0]
-        cursor = await db.execute("SELECT COUNT(*) FROM users WHERE status = 'paid'")
-        paid_users = (await cursor.fetchone())[0]
-        cursor = await db.execute("SELECT COUNT(*) FROM premium_codes WHERE used_by IS NULL")
-        available_codes = (await cursor.fetchone())[0]
-        admin_text = (
-            f"⚙️ <b>АДМИН-ПАНЕЛЬ</b>\n"
-            f"• Всего пользователей: {total_users}\n"
-            f"• Премиум: {paid_users}\n"
-            f"• Доступно промокодов: {available_codes}\n"
-            f"• Доход: {paid_users * PRICE} ₽\n\n"
-            "<b>Доступные действия:</b>"
-        )
-        await message.answer(admin_text, parse_mode="HTML", reply_markup=get_admin_keyboard())
+    total_users = await storage.users.count()
+    paid_users = await storage.users.count("paid")
+    available_codes = await storage.promos.count_unused()
+    dau, wau, mau = await ACTIVITY.summary()
+    admin_text = (
+        f"⚙️ <b>АДМИН-ПАНЕЛЬ</b>\n"
+        f"• Всего пользователей: {total_users}\n"
+        f"• Премиум: {paid_users}\n"
+        f"• Активные DAU / WAU / MAU: ~{dau} / ~{wau} / ~{mau}\n"
+        f"• Доступно промокодов: {available_codes}\n"
+        f"• Доход: {paid_users * PRICE} ₽\n"
+        f"• Задержка loop: {WATCHDOG.summary()}\n\n"
+        "<b>Доступные действия:</b>"
+    )
+    await message.answer(admin_text, parse_mode="HTML", reply_markup=get_admin_keyboard())
 
 @router.message(F.text == "👑 Выдать премиум")
 async def grant_premium_menu(message: Message, state: FSMContext):
@@ -1134,24 +3572,18 @@ async def grant_premium_by_id(message: Message, state: FSMContext):
         return
     try:
         user_id = int(message.text.strip())
-        async with aiosqlite.connect(DB_PATH) as db:
-            cursor = await db.execute("SELECT username, full_name, status FROM users WHERE user_id = ?", (user_id,))
-            user_data = await cursor.fetchone()
-            if not user_data:
-                await message.answer("❌ Пользователь не найден")
-                return
-            username, full_name, current_status = user_data
-            if current_status == "paid":
-                await message.answer(f"ℹ️ Пользователь {user_id} уже имеет премиум")
-                return
-            await db.execute("UPDATE users SET status = 'paid' WHERE user_id = ?", (user_id,))
-            await db.execute("""
-            INSERT OR IGNORE INTO user_achievements (user_id, achievement_id, unlocked_at)
-            VALUES (?, 'premium_seeker', datetime('now'))
-            """, (user_id,))
-            await db.commit()
-            try:
-                await bot.send_message(
+        user_data = await storage.users.get(user_id)
+        if not user_data:
+            await message.answer("❌ Пользователь не найден")
+            return
+        username, full_name, current_status = user_data["username"], user_data["full_name"], user_data["status"]
+        if current_status == "paid":
+            await message.answer(f"ℹ️ Пользователь {user_id} уже имеет премиум")
+            return
+        await storage.grant_premium(user_id)
+        try:
+            with outbound_lane(LANE_TRANSACTIONAL):
+                await message.bot.send_message(
                     user_id,
                     "🎉 <b>ПОЗДРАВЛЯЕМ!</b>\n"
                     "Администратор выдал вам <b>ПРЕМИУМ-ДОСТУП</b>!\n"
@@ -1159,15 +3591,15 @@ async def grant_premium_by_id(message: Message, state: FSMContext):
                     "Также теперь вам доступна функция «🌞 Энергия дня»!",
                     parse_mode="HTML"
                 )
-            except:
-                pass
-            await message.answer(
-                f"✅ <b>ПРЕМИУМ ВЫДАН!</b>\n"
-                f"ID: {user_id}\n"
-                f"Имя: {full_name or 'Не указано'}\n"
-                f"Username: @{username or 'Не указан'}",
-                parse_mode="HTML"
-            )
+        except:
+            pass
+        await message.answer(
+            f"✅ <b>ПРЕМИУМ ВЫДАН!</b>\n"
+            f"ID: {user_id}\n"
+            f"Имя: {full_name or 'Не указано'}\n"
+            f"Username: @{username or 'Не указан'}",
+            parse_mode="HTML"
+        )
     except ValueError:
         await message.answer("❌ ID должен быть числом")
     await state.clear()
@@ -1177,72 +3609,285 @@ async def grant_premium_by_id(message: Message, state: FSMContext):
 async def create_promo_code(message: Message):
     if message.from_user.id != ADMIN_USER_ID:
         return
-    code = await generate_premium_code()
-    await save_premium_code(code)
+    code = await storage.promos.create()
     await message.answer(
         f"🎫 <b>НОВЫЙ ПРОМОКОД</b>\n"
         f"<code>{code}</code>",
         parse_mode="HTML"
     )
 
+@router.message(F.text == "📦 Пакет промокодов")
+async def promo_batch_menu(message: Message, state: FSMContext):
+    if message.from_user.id != ADMIN_USER_ID:
+        return
+    await message.answer(
+        "📦 <b>ПАКЕТ ПРОМОКОДОВ</b>\n"
+        f"Отправь количество (до {PROMO_BATCH_MAX}) и метку кампании:\n"
+        "<code>500 spring-sale</code>",
+        parse_mode="HTML"
+    )
+    await state.set_state(Form.waiting_for_promo_batch)
+
+@router.message(Form.waiting_for_promo_batch)
+async def create_promo_batch(message: Message, state: FSMContext):
+    if message.from_user.id != ADMIN_USER_ID:
+        return
+    parts = (message.text or "").split()
+    if not parts or not parts[0].isdigit() or not 1 <= int(parts[0]) <= PROMO_BATCH_MAX:
+        await message.answer(f"❌ Количество должно быть числом от 1 до {PROMO_BATCH_MAX}")
+        return
+    count = int(parts[0])
+    batch_tag = parts[1] if len(parts) > 1 else f"batch-{datetime.now():%Y%m%d-%H%M}"
+    if not re.fullmatch(r"[\w-]{1,32}", batch_tag):
+        await message.answer("❌ Метка: до 32 символов, буквы, цифры, «-» и «_»")
+        return
+    await state.clear()
+    started = time.perf_counter()
+    codes = await storage.promos.create_batch(count, batch_tag)
+    logger.info(f"Created {len(codes)} promo codes for {batch_tag} in {time.perf_counter() - started:.2f}s")
+    await message.answer_document(
+        BufferedInputFile(promo_codes_csv(codes, batch_tag), filename=f"promo_{batch_tag}_{len(codes)}.csv"),
+        caption=f"🎫 Создано промокодов: {len(codes)}\nКампания: {batch_tag}",
+        reply_markup=get_admin_keyboard()
+    )
+
+def _page_navigation(prefix: str, filter_key: str, rows: list, has_more: bool, direction: str, cursor, encode) -> list:
+    """Кнопки «назад/дальше»; курсор — ключ первой/последней строки в callback_data"""
+    has_prev = has_more if direction == "p" else cursor is not None
+    has_next = has_more if direction == "n" else True
+    buttons = []
+    if rows and has_prev:
+        buttons.append(InlineKeyboardButton(text="⬅️", callback_data=f"{prefix}|{filter_key}|p|{encode(rows[0])}"))
+    if rows and has_next:
+        buttons.append(InlineKeyboardButton(text="➡️", callback_data=f"{prefix}|{filter_key}|n|{encode(rows[-1])}"))
+    return buttons
+
+async def render_promo_page(filter_key: str = "f", direction: str = "n", cursor: tuple = None):
+    rows, has_more = await storage.promos.page(filter_key, direction, cursor)
+    title = {"a": "ВСЕ", "f": "ДОСТУПНЫЕ", "u": "ИСПОЛЬЗОВАННЫЕ"}[filter_key]
+    text = f"🎫 <b>ПРОМОКОДЫ — {title}</b>\n"
+    if not rows:
+        text += "⚠️ Промокодов нет\n"
+    for code, _, batch_tag, username in rows:
+        line = f"• <code>{code}</code>"
+        if batch_tag:
+            line += f" [{html.escape(batch_tag)}]"
+        if filter_key != "f" and username:
+            line += f" (@{html.escape(username)})"
+        text += line + "\n"
+    filters = [
+        InlineKeyboardButton(text=("• " if key == filter_key else "") + label, callback_data=f"pc|{key}|n|")
+        for key, label in (("f", "Свободные"), ("u", "Использованные"), ("a", "Все"))
+    ]
+    navigation = _page_navigation("pc", filter_key, rows, has_more, direction, cursor, lambda row: f"{row[1]}|{row[0]}")
+    return text, InlineKeyboardMarkup(inline_keyboard=[filters, navigation] if navigation else [filters])
+
+def _format_user_row(row) -> str:
+    user_id, username, full_name, status = row
+    badge = "💎" if status == "paid" else "🆓"
+    name = html.escape(full_name or "—")
+    login = f" @{html.escape(username)}" if username else ""
+    return f"{badge} <code>{user_id}</code>{login} — {name}"
+
+async def render_user_page(filter_key: str = "a", direction: str = "n", cursor: int = None):
+    rows, has_more = await storage.users.page(filter_key, direction, cursor)
+    title = {"a": "ВСЕ", "f": "БЕСПЛАТНЫЕ", "p": "ПРЕМИУМ"}[filter_key]
+    text = f"👥 <b>ПОЛЬЗОВАТЕЛИ — {title}</b>\n"
+    text += "\n".join(_format_user_row(row) for row in rows) if rows else "⚠️ Пользователей нет"
+    filters = [
+        InlineKeyboardButton(text=("• " if key == filter_key else "") + label, callback_data=f"us|{key}|n|")
+        for key, label in (("a", "Все"), ("f", "Бесплатные"), ("p", "Премиум"))
+    ]
+    navigation = _page_navigation("us", filter_key, rows, has_more, direction, cursor, lambda row: str(row[0]))
+    keyboard = [filters, navigation] if navigation else [filters]
+    keyboard.append([InlineKeyboardButton(text="🔎 Найти по ID или username", callback_data="us_search")])
+    return text, InlineKeyboardMarkup(inline_keyboard=keyboard)
+
 @router.message(F.text == "📋 Список промокодов")
 async def list_promo_codes(message: Message):
     if message.from_user.id != ADMIN_USER_ID:
         return
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("SELECT code FROM premium_codes WHERE used_by IS NULL ORDER BY created_at DESC LIMIT 10")
-        available = await cursor.fetchall()
-        cursor = await db.execute("""
-        SELECT pc.code, u.username
-        FROM premium_codes pc
-        LEFT JOIN users u ON pc.used_by = u.user_id
-        WHERE pc.used_by IS NOT NULL
-        ORDER BY pc.used_at DESC LIMIT 10
-        """)
-        used = await cursor.fetchall()
-        response = "🎫 <b>ПРОМОКОДЫ</b>\n"
-        if available:
-            response += "<b>Доступные:</b>\n"
-            for code, in available:
-                response += f"• <code>{code}</code>\n"
-        else:
-            response += "⚠️ Нет доступных промокодов\n"
-        if used:
-            response += "\n<b>Использованные:</b>\n"
-            for code, username in used:
-                user = f"@{username}" if username else "Неизвестно"
-                response += f"• <code>{code}</code> ({user})\n"
-        await message.answer(response, parse_mode="HTML")
+    text, keyboard = await render_promo_page()
+    await message.answer(text, parse_mode="HTML", reply_markup=keyboard)
+
+async def edit_page(callback: CallbackQuery, text: str, keyboard):
+    """Перерисовывает страницу; повторное нажатие на текущий фильтр/страницу не меняет текст"""
+    try:
+        await callback.message.edit_text(text, parse_mode="HTML", reply_markup=keyboard)
+    except TelegramBadRequest as e:
+        if "message is not modified" not in str(e):
+            raise
+    await callback.answer()
+
+@router.callback_query(F.data.startswith("pc|"))
+async def page_promo_codes(callback: CallbackQuery):
+    if callback.from_user.id != ADMIN_USER_ID:
+        await callback.answer()
+        return
+    _, filter_key, direction, *cursor = callback.data.split("|")
+    if filter_key not in PROMO_PAGE_FILTERS:
+        await callback.answer()
+        return
+    text, keyboard = await render_promo_page(filter_key, direction, tuple(cursor) if cursor[0] else None)
+    await edit_page(callback, text, keyboard)
+
+@router.message(F.text == "👥 Пользователи")
+async def list_users(message: Message):
+    if message.from_user.id != ADMIN_USER_ID:
+        return
+    text, keyboard = await render_user_page()
+    await message.answer(text, parse_mode="HTML", reply_markup=keyboard)
+
+@router.callback_query(F.data.startswith("us|"))
+async def page_users(callback: CallbackQuery):
+    if callback.from_user.id != ADMIN_USER_ID:
+        await callback.answer()
+        return
+    _, filter_key, direction, cursor = callback.data.split("|")
+    if filter_key not in USER_PAGE_FILTERS:
+        await callback.answer()
+        return
+    text, keyboard = await render_user_page(filter_key, direction, int(cursor) if cursor else None)
+    await edit_page(callback, text, keyboard)
+
+@router.callback_query(F.data == "us_search")
+async def user_search_prompt(callback: CallbackQuery, state: FSMContext):
+    if callback.from_user.id != ADMIN_USER_ID:
+        await callback.answer()
+        return
+    await callback.message.answer("🔎 Отправь ID пользователя или @username:")
+    await state.set_state(Form.waiting_for_user_search)
+    await callback.answer()
+
+@router.message(Form.waiting_for_user_search)
+async def user_search(message: Message, state: FSMContext):
+    if message.from_user.id != ADMIN_USER_ID:
+        return
+    await state.clear()
+    rows = await storage.users.search(message.text or "")
+    if not rows:
+        await message.answer("❌ Пользователь не найден", reply_markup=get_admin_keyboard())
+        return
+    await message.answer(
+        "🔎 <b>НАЙДЕНО:</b>\n" + "\n".join(_format_user_row(row) for row in rows),
+        parse_mode="HTML",
+        reply_markup=get_admin_keyboard()
+    )
 
 @router.message(F.text == "📊 Статистика")
 async def admin_stats(message: Message):
     if message.from_user.id != ADMIN_USER_ID:
         return
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("SELECT COUNT(*) FROM users")
-        total = (await cursor.fetchone())[0]
-        cursor = await db.execute("SELECT COUNT(*) FROM users WHERE status = 'paid'")
-        paid = (await cursor.fetchone())[0]
-        stats_text = (
-            f"📈 <b>СТАТИСТИКА БОТА</b>\n"
-            f"👥 <b>ПОЛЬЗОВАТЕЛИ:</b>\n"
-            f"• Всего: {total}\n"
-            f"• Премиум: {paid} ({paid/total*100:.1f}%)\n\n"
-            f"💰 <b>ФИНАНСЫ:</b>\n"
-            f"• Доход: {paid * PRICE} ₽"
+    total = await storage.users.count()
+    paid = await storage.users.count("paid")
+    stats_text = (
+        f"📈 <b>СТАТИСТИКА БОТА</b>\n"
+        f"👥 <b>ПОЛЬЗОВАТЕЛИ:</b>\n"
+        f"• Всего: {total}\n"
+        f"• Премиум: {paid} ({paid/total*100:.1f}%)\n\n"
+        f"💰 <b>ФИНАНСЫ:</b>\n"
+        f"• Доход: {paid * PRICE} ₽\n\n"
+        f"⚙️ <b>ПРОИЗВОДИТЕЛЬНОСТЬ:</b>\n"
+        f"• Задержка event loop: {WATCHDOG.summary()}\n"
+        f"{METRICS.format()}"
+    )
+    await send_chunked(message, stats_text)
+
+@router.message(F.text == "📉 Воронка")
+async def admin_funnel(message: Message):
+    if message.from_user.id != ADMIN_USER_ID:
+        return
+    since = (date.fromisoformat(utc_now()[:10]) - timedelta(days=6)).isoformat()
+    totals = await storage.events.totals(since)
+    started = totals.get("start", (0, 0))[1]
+    lines = [
+        "📉 <b>ВОРОНКА ЗА 7 ДНЕЙ</b>",
+        "<i>Сумма дневных уникальных пользователей</i>\n",
+    ]
+    for event in FUNNEL_EVENTS:
+        users = totals.get(event, (0, 0))[1]
+        share = f" ({users / started * 100:.1f}%)" if started and event != "start" else ""
+        lines.append(f"{ANALYTICS_EVENTS[event]}: {users}{share}")
+    lines.append("")
+    for event in ANALYTICS_EVENTS:
+        if event not in FUNNEL_EVENTS:
+            lines.append(f"{ANALYTICS_EVENTS[event]}: {totals.get(event, (0, 0))[1]}")
+    lines.append("\n👥 <b>DAU:</b>")
+    lines.extend(f"• {day}: {users}" for day, users in await storage.events.daily("active", since))
+    lines.append(f"\n<i>Обновляется раз в {ANALYTICS_ROLLUP_INTERVAL / 60:.0f} мин.</i>")
+    await send_chunked(message, "\n".join(lines))
+
+@router.message(F.text == "🔁 Удержание")
+async def admin_retention(message: Message):
+    if message.from_user.id != ADMIN_USER_ID:
+        return
+    today = date.fromisoformat(utc_now()[:10])
+    since = (today - timedelta(days=13)).isoformat()
+    cohorts = dict(await storage.events.daily("new", since))
+    returned = {(cohort, day): users for cohort, day, users in await storage.events.retention(since)}
+
+    def rate(cohort: str, size: int, offset: int) -> str:
+        day = date.fromisoformat(cohort) + timedelta(days=offset)
+        if day > today:
+            return "—"
+        return f"{returned.get((cohort, day.isoformat()), 0) / size * 100:.0f}%"
+
+    lines = ["🔁 <b>УДЕРЖАНИЕ ПО ДНЮ РЕГИСТРАЦИИ</b>\n"]
+    for cohort in sorted(cohorts, reverse=True):
+        size = cohorts[cohort]
+        if size:
+            lines.append(f"• {cohort}: {size} чел. · D1 {rate(cohort, size, 1)} · D7 {rate(cohort, size, 7)}")
+    if len(lines) == 1:
+        lines.append("Пока нет данных")
+    await send_chunked(message, "\n".join(lines))
+
+@router.message(F.text == "📤 Экспорт")
+@router.message(Command("export"))
+async def admin_export(message: Message):
+    if message.from_user.id != ADMIN_USER_ID:
+        return
+    args = (message.text or "").split()
+    fmt = args[1].lower() if len(args) > 1 and args[0] == "/export" else "csv"
+    if fmt not in EXPORT_FORMATS:
+        await message.answer("❌ Формат: /export csv или /export jsonl")
+        return
+    if storage.db.dialect != "sqlite":
+        await message.answer("❌ Выгрузка работает только с SQLite-хранилищем")
+        return
+    await message.answer("⏳ Готовлю выгрузку...")
+    fd, path = tempfile.mkstemp(suffix=f".{fmt}.gz")
+    os.close(fd)
+    try:
+        started = time.perf_counter()
+        count = await asyncio.to_thread(export_users, path, fmt)
+        logger.info(f"Exported {count} users to {fmt} in {time.perf_counter() - started:.2f}s")
+        await message.answer_document(
+            FSInputFile(path, filename=f"users_{datetime.now():%Y%m%d_%H%M}.{fmt}.gz"),
+            caption=f"📤 Выгружено пользователей: {count}"
         )
-        await message.answer(stats_text, parse_mode="HTML")
+    finally:
+        os.remove(path)
 
 # =============== РАССЫЛКА ===============
+BROADCAST_BUSY_TEXT = (
+    "⏳ <b>ПРЕДЫДУЩАЯ РАССЫЛКА ЕЩЁ НЕ ЗАВЕРШЕНА</b>\n"
+    "Она идёт сейчас или продолжится после перезапуска. Новую можно начать, когда придёт итог."
+)
+
 @router.message(F.text == "📢 Рассылка")
 async def admin_broadcast(message: Message, state: FSMContext):
     if message.from_user.id != ADMIN_USER_ID:
         return
+    job = await storage.jobs.get(BROADCAST_JOB)
+    if job and job["status"] in ("running", "paused"):
+        await message.answer(BROADCAST_BUSY_TEXT, parse_mode="HTML")
+        return
     kb = ReplyKeyboardMarkup(
         keyboard=[
             [KeyboardButton(text="👥 Всем")],
             [KeyboardButton(text="🆓 Бесплатным")],
             [KeyboardButton(text="💎 Премиум")],
+            [KeyboardButton(text="🎯 Сегмент")],
             [KeyboardButton(text="🔙 Назад")]
         ],
         resize_keyboard=True
@@ -1258,6 +3903,24 @@ async def handle_broadcast_target(message: Message, state: FSMContext):
         await admin_panel(message, state)
         await state.clear()
         return
+    if message.text == "🎯 Сегмент":
+        await message.answer(
+            "🎯 <b>СЕГМЕНТ АУДИТОРИИ</b>\n"
+            "Условия через пробел, все должны выполняться:\n"
+            "• <code>mind</code>, <code>action</code>, <code>realization</code>, <code>destiny</code>, "
+            "<code>soul</code>, <code>personality</code>, <code>year</code> = 1–9\n"
+            "• <code>karmic</code> = 13, 14, 16 или 19\n"
+            "• <code>archetype</code> = воин, хранитель, создатель или целитель\n"
+            "• <code>status</code> = free или paid\n\n"
+            "Пример: <code>mind=7 karmic=13 status=paid</code>",
+            parse_mode="HTML",
+            reply_markup=ReplyKeyboardMarkup(
+                keyboard=[[KeyboardButton(text="❌ Отменить рассылку")]],
+                resize_keyboard=True
+            )
+        )
+        await state.set_state(Form.waiting_for_broadcast_segment)
+        return
     target = {
         "👥 Всем": "all",
         "🆓 Бесплатным": "free",
@@ -1279,6 +3942,96 @@ async def handle_broadcast_target(message: Message, state: FSMContext):
     )
     await state.set_state(Form.waiting_for_broadcast_message)
 
+@router.message(Form.waiting_for_broadcast_segment)
+async def handle_broadcast_segment(message: Message, state: FSMContext):
+    if message.from_user.id != ADMIN_USER_ID:
+        return
+    if message.text == "❌ Отменить рассылку":
+        await message.answer("Рассылка отменена.", reply_markup=get_admin_keyboard())
+        await state.clear()
+        return
+    segment = (message.text or "").strip()
+    try:
+        size = await storage.users.segment_count(segment)
+    except ValueError as e:
+        await message.answer(f"❌ {e}\nИсправьте условия или нажмите ❌ Отменить рассылку")
+        return
+    if not size:
+        await message.answer("В сегменте нет пользователей. Измените условия.")
+        return
+    await state.update_data(broadcast_target="segment", broadcast_segment=segment)
+    await message.answer(
+        f"🎯 В сегменте <b>{size}</b> пользователей.\n\n"
+        "📝 <b>ВВЕДИТЕ СООБЩЕНИЕ ДЛЯ РАССЫЛКИ:</b>\n"
+        "Можно использовать HTML-разметку\n"
+        "<i>Или нажмите ❌ Отменить рассылку</i>",
+        parse_mode="HTML"
+    )
+    await state.set_state(Form.waiting_for_broadcast_message)
+
+BROADCAST_JOB = "broadcast"
+
+async def broadcast_recipients(spec: dict) -> list:
+    if spec["target"] == "segment":
+        return await storage.users.segment_ids(spec["segment"])
+    if spec["target"] == "all":
+        return await storage.users.ids()
+    return await storage.users.ids(spec["target"])
+
+async def run_broadcast(bot: Bot, spec: dict, cursor: int = 0) -> tuple:
+    """Рассылка по возрастанию user_id. Курсор (последний обработанный id) сохраняется в job_state
+    каждые BROADCAST_CHECKPOINT сообщений и при остановке бота, после рестарта рассылка продолжается.
+    Запись в job_state одна на все рассылки: новую запускает только успешный storage.jobs.claim.
+    Возвращает (отправлено, не удалось, получателей, завершена ли)."""
+    target = json.dumps(spec, ensure_ascii=False)
+    recipients = [user_id for user_id in await broadcast_recipients(spec) if user_id > cursor]
+    await storage.jobs.save(BROADCAST_JOB, target, cursor, "running")
+    success = 0
+    failed = 0
+    try:
+        # Темп задаёт OUTBOUND: рассылка занимает только слоты, не нужные живым ответам
+        with outbound_lane(LANE_BULK):
+            for sent, user_id in enumerate(recipients, 1):
+                if SHUTDOWN.is_set():
+                    await storage.jobs.save(BROADCAST_JOB, target, cursor, "paused")
+                    logger.info(f"Broadcast paused after user {cursor}: {success} sent, {len(recipients) - sent + 1} left")
+                    return success, failed, len(recipients), False
+                try:
+                    await bot.send_message(
+                        user_id,
+                        f"📢 <b>РАССЫЛКА ОТ АДМИНИСТРАЦИИ:</b>\n{spec['text']}",
+                        parse_mode="HTML"
+                    )
+                    success += 1
+                except Exception as e:
+                    failed += 1
+                    logger.error(f"Failed to send to {user_id}: {e}")
+                cursor = user_id
+                if sent % BROADCAST_CHECKPOINT == 0:
+                    await storage.jobs.save(BROADCAST_JOB, target, cursor, "running")
+    except asyncio.CancelledError:
+        await storage.jobs.save(BROADCAST_JOB, target, cursor, "paused")
+        raise
+    await storage.jobs.save(BROADCAST_JOB, target, cursor, "done")
+    return success, failed, len(recipients), True
+
+async def resume_broadcast(bot: Bot):
+    """Продолжает рассылку, прерванную остановкой или падением бота, и сообщает админу итог"""
+    state = await storage.jobs.get(BROADCAST_JOB)
+    if not state or state["status"] not in ("running", "paused"):
+        return
+    logger.info(f"Resuming broadcast after user {state['cursor']}")
+    success, failed, total, finished = await run_broadcast(bot, json.loads(state["target"]), state["cursor"])
+    if finished and ADMIN_USER_ID:
+        await bot.send_message(
+            ADMIN_USER_ID,
+            f"✅ <b>РАССЫЛКА ПОСЛЕ ПЕРЕЗАПУСКА ЗАВЕРШЕНА</b>\n"
+            f"• Отправлено: {success}\n"
+            f"• Не удалось: {failed}\n"
+            f"• Оставалось получателей: {total}",
+            parse_mode="HTML"
+        )
+
 @router.message(Form.waiting_for_broadcast_message)
 async def handle_broadcast_message(message: Message, state: FSMContext):
     if message.from_user.id != ADMIN_USER_ID:
@@ -1288,36 +4041,35 @@ async def handle_broadcast_message(message: Message, state: FSMContext):
         await state.clear()
         return
     data = await state.get_data()
-    target = data.get("broadcast_target", "all")
+    spec = {
+        "text": message.text,
+        "target": data.get("broadcast_target", "all"),
+        "segment": data.get("broadcast_segment"),
+    }
+    await state.clear()
+    # Одновременно идёт не больше одной рассылки: иначе курсоры перезаписывают друг друга
+    if not await storage.jobs.claim(BROADCAST_JOB, json.dumps(spec, ensure_ascii=False)):
+        await message.answer(BROADCAST_BUSY_TEXT, parse_mode="HTML", reply_markup=get_admin_keyboard())
+        return
     await message.answer("⏳ Начинаю рассылку...")
-    users_to_send = []
-    if target == "all":
-        users_to_send = await get_all_users()
-    else:
-        users_to_send = await get_users_by_status(target)
-    success = 0
-    failed = 0
-    for user_id in users_to_send:
-        try:
-            await bot.send_message(
-                user_id,
-                f"📢 <b>РАССЫЛКА ОТ АДМИНИСТРАЦИИ:</b>\n{message.text}",
-                parse_mode="HTML"
-            )
-            success += 1
-            await asyncio.sleep(0.05)
-        except Exception as e:
-            failed += 1
-            logger.error(f"Failed to send to {user_id}: {e}")
+    success, failed, total, finished = await run_broadcast(message.bot, spec)
+    if not finished:
+        await message.answer(
+            f"⏸ <b>РАССЫЛКА ПРИОСТАНОВЛЕНА</b> — бот перезапускается.\n"
+            f"• Отправлено: {success}\n"
+            f"Остальным сообщение уйдёт автоматически после запуска.",
+            parse_mode="HTML",
+            reply_markup=get_admin_keyboard()
+        )
+        return
     await message.answer(
         f"✅ <b>РАССЫЛКА ЗАВЕРШЕНА</b>\n"
         f"• Отправлено: {success}\n"
         f"• Не удалось: {failed}\n"
-        f"• Всего получателей: {len(users_to_send)}",
+        f"• Всего получателей: {total}",
         parse_mode="HTML",
         reply_markup=get_admin_keyboard()
     )
-    await state.clear()
 
 # =============== КНОПКА НАЗАД ===============
 @router.message(F.text == "🔙 Назад")
@@ -1349,6 +4101,7 @@ async def process_birth_date(message: Message, state: FSMContext):
         )
         return
     await state.update_data(birth_date=message.text.strip())
+    ANALYTICS.track("birth_date", message.from_user.id)
     await message.answer(
         "✅ <b>ДАТА ПРИНЯТА!</b>\n"
         "🔤 Теперь пришли своё <b>полное имя</b> (имя, отчество, фамилия):\n"
@@ -1358,27 +4111,12 @@ async def process_birth_date(message: Message, state: FSMContext):
     )
     await state.set_state(Form.waiting_for_full_name)
 
-@router.message(Form.waiting_for_full_name)
+# Неверное имя отсекается фильтром и не тратит токены корзины "name"
+@router.message(Form.waiting_for_full_name, F.text.func(validate_name), flags={"rate_limit": "name"})
 async def process_full_name(message: Message, state: FSMContext):
     full_name = message.text.strip()
     user_id = message.from_user.id
     
-    if not validate_name(full_name):
-        await message.answer(
-            "❌ <b>НЕВЕРНЫЙ ФОРМАТ ИМЕНИ</b>\n\n"
-            "Имя должно:\n"
-            "• Содержать только русские буквы, пробелы и дефисы\n"
-            "• Быть полным (например: Имя Отчество Фамилия)\n"
-            "• Содержать минимум 2 символа\n\n"
-            "Примеры:\n"
-            "• <i>Иван Иванович Иванов</i>\n"
-            "• <i>Анна-Мария Петрова</i>\n"
-            "• <i>Сергей Сидоров</i>\n\n"
-            "Пожалуйста, введите имя заново:",
-            parse_mode="HTML"
-        )
-        return
-    
     data = await state.get_data()
     birth_date = data.get('birth_date')
     if not birth_date:
@@ -1389,29 +4127,15 @@ async def process_full_name(message: Message, state: FSMContext):
     try:
         logger.info(f"Calculating for user {user_id}: {birth_date}, {full_name}")
         
-        # Рассчитываем профиль
-        profile = calculate_numerology_profile(birth_date, full_name, CURRENT_YEAR)
-        
-        # Рассчитываем матрицу
-        matrix, digit_counts = calculate_pythagoras_matrix(birth_date)
-        matrix_visual = generate_matrix_visual(matrix)
-        line_analysis = analyze_pythagoras_lines(digit_counts)
-        archetype = determine_archetype(digit_counts)
-        
-        matrix_data = {
-            "matrix_visual": matrix_visual,
-            "line_analysis": line_analysis,
-            "archetype": archetype
-        }
+        # Рассчитываем профиль и матрицу вне event loop
+        profile, matrix_data = await CPU_EXECUTOR.run(compute_report_data, birth_date, full_name, numerology_year())
+        archetype = matrix_data["archetype"]
         
         # Получаем статус
-        async with aiosqlite.connect(DB_PATH) as db:
-            cursor = await db.execute("SELECT status FROM users WHERE user_id = ?", (user_id,))
-            row = await cursor.fetchone()
-            current_status = row[0] if row else "free"
+        current_status = await storage.users.get_status(user_id)
         
         # Сохраняем пользователя
-        await save_user(
+        await storage.users.save(
             user_id,
             message.from_user.username,
             full_name,
@@ -1419,64 +4143,24 @@ async def process_full_name(message: Message, state: FSMContext):
             birth_date,
             archetype
         )
+        ANALYTICS.track("full_name", user_id)
         
         if current_status == "paid":
-            # Отправляем отчет частями
-            full_report = generate_full_report(profile, matrix_data)
-            
-            # Разбиваем отчет на части если он слишком длинный
-            if len(full_report) > 4000:
-                # Делим по абзацам
-                parts = full_report.split('\n\n')
-                current_part = ""
-                
-                for part in parts:
-                    if len(current_part) + len(part) + 2 > 4000:
-                        # Отправляем текущую часть
-                        await message.answer(current_part, parse_mode="HTML")
-                        current_part = part
-                    else:
-                        if current_part:
-                            current_part += "\n\n" + part
-                        else:
-                            current_part = part
-                
-                # Отправляем последнюю часть
-                if current_part:
-                    await message.answer(current_part, parse_mode="HTML")
-            else:
-                await message.answer(full_report, parse_mode="HTML")
-            
-            # Отправляем медиа
-            try:
-                premium_media = get_random_file("media/premium", ('.mp4', '.jpg', '.png', '.gif'))
-                if premium_media:
-                    if premium_media.endswith('.mp4'):
-                        await message.answer_video(video=FSInputFile(premium_media))
-                    elif premium_media.endswith('.gif'):
-                        await message.answer_animation(animation=FSInputFile(premium_media))
-                    else:
-                        await message.answer_photo(photo=FSInputFile(premium_media))
-            except Exception as e:
-                logger.error(f"Error sending premium media: {e}")
-            
-            await message.answer(
+            await deliver_premium_report(
+                message, profile, matrix_data,
                 "✨ <b>ВАШ ПРЕМИУМ-ОТЧЁТ СОХРАНЁН!</b>\n\n"
                 "Теперь вы можете в любой момент посмотреть его, нажав «📈 Мой отчёт».",
-                parse_mode="HTML",
-                reply_markup=get_main_keyboard(user_id, True)
+                get_main_keyboard(user_id, True)
             )
             
         else:
             # Бесплатный отчет
-            free_report = generate_free_report(profile)
+            free_report = await REPORT_FLIGHT.run(
+                report_flight_key("free", profile), IO_EXECUTOR.run, generate_free_report, profile
+            )
             await state.update_data(profile=profile, matrix_data=matrix_data)
             
-            if len(free_report) > 4000:
-                # Обрезаем если слишком длинный
-                free_report = free_report[:3997] + "..."
-            
-            await message.answer(free_report, parse_mode="HTML")
+            await send_chunked(message, free_report)
             
             # Медиа
             try:
@@ -1506,6 +4190,13 @@ async def process_full_name(message: Message, state: FSMContext):
             )
             await state.set_state(Form.waiting_for_payment)
             
+    except (ExecutorBusy, asyncio.TimeoutError):
+        logger.warning(f"Report executor overloaded, user {user_id}")
+        await message.answer(
+            "⏳ <b>СЕЙЧАС МНОГО ЗАПРОСОВ</b>\n\n"
+            "Отчёт не успел собраться. Пожалуйста, повторите через минуту.",
+            parse_mode="HTML"
+        )
     except Exception as e:
         logger.error(f"Error in process_full_name for user {user_id}: {e}", exc_info=True)
         
@@ -1534,6 +4225,22 @@ async def process_full_name(message: Message, state: FSMContext):
                 reply_markup=get_main_keyboard(user_id, False)
             )
 
+@router.message(Form.waiting_for_full_name)
+async def reject_full_name(message: Message):
+    await message.answer(
+        "❌ <b>НЕВЕРНЫЙ ФОРМАТ ИМЕНИ</b>\n\n"
+        "Имя должно:\n"
+        "• Содержать только русские буквы, пробелы и дефисы\n"
+        "• Быть полным (например: Имя Отчество Фамилия)\n"
+        "• Содержать минимум 2 символа\n\n"
+        "Примеры:\n"
+        "• <i>Иван Иванович Иванов</i>\n"
+        "• <i>Анна-Мария Петрова</i>\n"
+        "• <i>Сергей Сидоров</i>\n\n"
+        "Пожалуйста, введите имя заново:",
+        parse_mode="HTML"
+    )
+
 # =============== ОПЛАТА И ПРОМОКОДЫ ===============
 @router.callback_query(F.data == "buy_full")
 async def process_buy(callback: CallbackQuery, state: FSMContext):
@@ -1543,6 +4250,7 @@ async def process_buy(callback: CallbackQuery, state: FSMContext):
         await callback.message.answer("Сначала введи дату и имя.")
         return
     payment = await create_payment(callback.from_user.id, "Полный нумерологический разбор")
+    ANALYTICS.track("buy", callback.from_user.id)
     pay_kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="Оплатить", url=payment.confirmation.confirmation_url)],
         [InlineKeyboardButton(text="Я оплатил", callback_data="check_payment")]
@@ -1555,36 +4263,25 @@ async def process_buy(callback: CallbackQuery, state: FSMContext):
     )
     await callback.answer()
 
-@router.callback_query(F.data == "check_payment")
+@router.callback_query(F.data == "check_payment", flags={"rate_limit": "payment"})
 async def check_payment(callback: CallbackQuery, state: FSMContext):
     user_id = callback.from_user.id
     data = await state.get_data()
     profile = data.get("profile")
     matrix_data = data.get("matrix_data")
     if profile and matrix_data:
-        await save_user(
+        await storage.users.save(
             user_id,
             callback.from_user.username,
-            callback.from_user.full_name or "Unknown",
+            profile["full_name"],
             "paid",
             profile["birth_date"],
             matrix_data["archetype"]
         )
-        full_report = generate_full_report(profile, matrix_data)
-        await callback.message.answer(full_report, parse_mode="HTML")
-        premium_media = get_random_file("media/premium", ('.mp4', '.jpg', '.png', '.gif'))
-        if premium_media:
-            if premium_media.endswith('.mp4'):
-                await callback.message.answer_video(video=FSInputFile(premium_media))
-            elif premium_media.endswith('.gif'):
-                await callback.message.answer_animation(animation=FSInputFile(premium_media))
-            else:
-                await callback.message.answer_photo(photo=FSInputFile(premium_media))
-        for img_path in get_karmic_files(profile['karmic_debts']):
-            if os.path.exists(img_path):
-                await callback.message.answer_photo(photo=FSInputFile(img_path))
+        ANALYTICS.track("paid", user_id)
         await callback.answer("✅ Премиум-доступ активирован!")
-        await callback.message.answer(
+        await deliver_premium_report(
+            callback.message, profile, matrix_data,
             "✨ <b>ВАШ ПРЕМИУМ-ДОСТУП АКТИВИРОВАН!</b>\n"
             "Теперь вам доступны все функции бота:\n"
             "• 📈 Мой отчёт (ваши данные сохранены)\n"
@@ -1593,8 +4290,7 @@ async def check_payment(callback: CallbackQuery, state: FSMContext):
             "• 🌞 Энергия дня\n"
             "• 📊 Полная статистика\n"
             "Используйте меню для навигации!",
-            parse_mode="HTML",
-            reply_markup=get_main_keyboard(user_id, True)
+            get_main_keyboard(user_id, True)
         )
     else:
         await callback.answer("❌ Ошибка активации. Пожалуйста, начните заново с команды /start")
@@ -1609,33 +4305,32 @@ async def enter_promo(callback: CallbackQuery):
     )
     await callback.answer()
 
-@router.callback_query(F.data == "daily_energy")
+@router.callback_query(F.data == "daily_energy", flags={"rate_limit": "energy"})
 async def show_daily_energy_callback(callback_query: CallbackQuery):
     user_id = callback_query.from_user.id
-    user_status = await get_user_status(user_id)
+    user_status = await storage.users.get_status(user_id)
     if user_status != "paid":
         await callback_query.answer("Энергия дня доступна только в премиум-версии", show_alert=True)
         return
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("SELECT birth_date FROM users WHERE user_id = ?", (user_id,))
-        row = await cursor.fetchone()
-        if not row or not row[0]:
-            await callback_query.answer("Сначала укажите дату рождения через «🔄 Новый расчёт»", show_alert=True)
-            return
-        birth_date = row[0]
-        day_part = birth_date.split(".")[0]
-        today_day = datetime.now().strftime("%d")
-        energy = calculate_daily_energy(day_part, today_day)
-        energy_text = read_narrative(f"narratives/full/daily_energy/{energy}.txt")
-        if not energy_text or "не готов" in energy_text:
-            energy_text = (
-                f"Ваша энергия сегодня: {energy}\n"
-                "Доверяйте интуиции и действуйте осознанно. "
-                "Это день важных insights и внутренних открытий."
-            )
-        full_message = f"✨ <b>Твоя энергия на {datetime.now().strftime('%d.%m.%Y')}:</b>\n{energy_text}"
-        await callback_query.message.answer(full_message, parse_mode="HTML")
-        await callback_query.answer()
+    birth_date = await storage.users.get_birth_date(user_id)
+    if not birth_date:
+        await callback_query.answer("Сначала укажите дату рождения через «🔄 Новый расчёт»", show_alert=True)
+        return
+    ANALYTICS.track("energy", user_id)
+    day_part = birth_date.split(".")[0]
+    today_day = datetime.now().strftime("%d")
+    energy = calculate_daily_energy(day_part, today_day)
+    path = f"narratives/full/daily_energy/{energy}.txt"
+    energy_text = await NARRATIVE_FLIGHT.run(path, IO_EXECUTOR.run, read_narrative, path)
+    if not energy_text or "не готов" in energy_text:
+        energy_text = (
+            f"Ваша энергия сегодня: {energy}\n"
+            "Доверяйте интуиции и действуйте осознанно. "
+            "Это день важных insights и внутренних открытий."
+        )
+    full_message = f"✨ <b>Твоя энергия на {datetime.now().strftime('%d.%m.%Y')}:</b>\n{energy_text}"
+    await send_chunked(callback_query.message, full_message)
+    await callback_query.answer()
 
 # =============== ОБРАБОТКА ПРОМОКОДОВ ===============
 @router.message(F.text.regexp(r'^MATRIX-[A-Z0-9]{3}-[A-Z0-9]{3}-[A-Z0-9]{3}$'))
@@ -1644,54 +4339,36 @@ async def process_promo_code(message: Message, state: FSMContext):
     code = message.text.strip().upper()
     logger.info(f"Пользователь {user_id} пытается активировать промокод: {code}")
     try:
-        current_status = await get_user_status(user_id)
+        current_status = await storage.users.get_status(user_id)
         if current_status == "paid":
             await message.answer(
                 "✅ <b>У вас уже есть премиум-доступ!</b>\n"
                 "Нажмите «📈 Мой отчёт» для получения полного отчета.",
                 parse_mode="HTML",
-                reply_markup=get_main_keyboard(user_id, await user_has_data(user_id))
+                reply_markup=get_main_keyboard(user_id, await storage.users.has_data(user_id))
             )
             return
-        async with aiosqlite.connect(DB_PATH) as db:
-            cursor = await db.execute(
-                "SELECT code, used_by FROM premium_codes WHERE code = ?",
-                (code,)
-            )
-            code_row = await cursor.fetchone()
-            if not code_row:
-                await message.answer(
-                    "❌ <b>ПРОМОКОД НЕ НАЙДЕН</b>\n"
-                    "Такого промокода не существует. Проверьте правильность ввода.",
-                    parse_mode="HTML",
-                    reply_markup=get_main_keyboard(user_id, await user_has_data(user_id))
-                )
-                return
-            if code_row[1] is not None:
-                await message.answer(
-                    "❌ <b>ПРОМОКОД УЖЕ ИСПОЛЬЗОВАН</b>\n"
-                    "Этот промокод уже был активирован другим пользователем.",
-                    parse_mode="HTML",
-                    reply_markup=get_main_keyboard(user_id, await user_has_data(user_id))
-                )
-                return
-        async with aiosqlite.connect(DB_PATH) as db:
-            await db.execute(
-                "UPDATE premium_codes SET used_by = ?, used_at = datetime('now') WHERE code = ?",
-                (user_id, code)
+        result = await storage.promos.redeem(code, user_id)
+        if result == "not_found":
+            await message.answer(
+                "❌ <b>ПРОМОКОД НЕ НАЙДЕН</b>\n"
+                "Такого промокода не существует. Проверьте правильность ввода.",
+                parse_mode="HTML",
+                reply_markup=get_main_keyboard(user_id, await storage.users.has_data(user_id))
             )
-            await db.execute(
-                "UPDATE users SET status = 'paid' WHERE user_id = ?",
-                (user_id,)
+            return
+        if result == "used":
+            await message.answer(
+                "❌ <b>ПРОМОКОД УЖЕ ИСПОЛЬЗОВАН</b>\n"
+                "Этот промокод уже был активирован другим пользователем.",
+                parse_mode="HTML",
+                reply_markup=get_main_keyboard(user_id, await storage.users.has_data(user_id))
             )
-            await db.execute("""
-            INSERT OR IGNORE INTO user_achievements (user_id, achievement_id, unlocked_at)
-            VALUES (?, 'premium_seeker', datetime('now'))
-            """, (user_id,))
-            await db.commit()
+            return
         logger.info(f"Промокод {code} успешно активирован для пользователя {user_id}")
-        has_data = await user_has_data(user_id)
-        if has_
+        ANALYTICS.track("promo", user_id)
+        has_data = await storage.users.has_data(user_id)
+        if has_data:
             await message.answer(
                 "🎉 <b>ПРОМОКОД УСПЕШНО АКТИВИРОВАН!</b>\n"
                 "✅ <b>Ваш премиум-доступ активирован!</b>\n"
@@ -1727,75 +4404,437 @@ async def process_promo_code(message: Message, state: FSMContext):
             "Пожалуйста, попробуйте позже или обратитесь к администратору.\n"
             "Если ошибка повторяется, напишите в поддержку.",
             parse_mode="HTML",
-            reply_markup=get_main_keyboard(user_id, await user_has_data(user_id))
+            reply_markup=get_main_keyboard(user_id, await storage.users.has_data(user_id))
         )
 
 # =============== АНАЛИЗ СОВМЕСТИМОСТИ ===============
 @router.message(F.text == "🏠 Анализ квартиры")
 async def handle_home_analysis(message: Message, state: FSMContext):
-    user_status = await get_user_status(message.from_user.id)
+    user_status = await storage.users.get_status(message.from_user.id)
     if user_status != "paid":
         await message.answer("🔒 Эта функция доступна только в премиум-версии.")
         return
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("SELECT birth_date FROM users WHERE user_id = ?", (message.from_user.id,))
-        row = await cursor.fetchone()
-        if not row or not row[0]:
-            await message.answer("Сначала отправь дату рождения.")
-            return
+    birth_date = await storage.users.get_birth_date(message.from_user.id)
+    if not birth_date:
+        await message.answer("Сначала отправь дату рождения.")
+        return
     await message.answer("🏠 Пришли номер своей квартиры, дома или этажа (например: 72, 15А, 3)")
     await state.set_state(Form.waiting_for_home_input)
 
 @router.message(F.text == "🚗 Анализ машины")
 async def handle_car_analysis(message: Message, state: FSMContext):
-    user_status = await get_user_status(message.from_user.id)
+    user_status = await storage.users.get_status(message.from_user.id)
     if user_status != "paid":
         await message.answer("🔒 Эта функция доступна только в премиум-версии.")
         return
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("SELECT birth_date FROM users WHERE user_id = ?", (message.from_user.id,))
-        row = await cursor.fetchone()
-        if not row or not row[0]:
-            await message.answer("Сначала отправь дату рождения.")
-            return
+    birth_date = await storage.users.get_birth_date(message.from_user.id)
+    if not birth_date:
+        await message.answer("Сначала отправь дату рождения.")
+        return
     await message.answer("🚗 Пришли свой автомобильный номер (например: А123БВ)")
     await state.set_state(Form.waiting_for_car_input)
 
-@router.message(Form.waiting_for_home_input)
+@router.message(Form.waiting_for_home_input, flags={"rate_limit": "energy"})
 async def process_home_input(message: Message, state: FSMContext):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("SELECT birth_date FROM users WHERE user_id = ?", (message.from_user.id,))
-        row = await cursor.fetchone()
-        if not row or not row[0]:
-            await message.answer("Ошибка: дата рождения не найдена.")
-            return
-    birth_date = row[0]
-    person_num = reduce_number(sum(int(d) for d in birth_date.replace(".", "")))
+    person_num = await storage.users.get_person_num(message.from_user.id)
+    if not person_num:
+        await message.answer("Ошибка: дата рождения не найдена.")
+        return
     obj_num = calculate_object_number(message.text.strip())
-    report = read_compatibility_narrative(person_num, obj_num, "home")
-    await message.answer(f"🏠 <b>ГЛУБОКИЙ АНАЛИЗ КВАРТИРЫ</b>\n\n{report}", parse_mode="HTML")
+    report = await COMPATIBILITY.lookup(person_num, obj_num, "home")
+    await send_chunked(message, f"🏠 <b>ГЛУБОКИЙ АНАЛИЗ КВАРТИРЫ</b>\n\n{report}")
     await state.clear()
 
-@router.message(Form.waiting_for_car_input)
+@router.message(Form.waiting_for_car_input, flags={"rate_limit": "energy"})
 async def process_car_input(message: Message, state: FSMContext):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("SELECT birth_date FROM users WHERE user_id = ?", (message.from_user.id,))
-        row = await cursor.fetchone()
-        if not row or not row[0]:
-            await message.answer("Ошибка: дата рождения не найдена.")
-            return
-    birth_date = row[0]
-    person_num = reduce_number(sum(int(d) for d in birth_date.replace(".", "")))
+    person_num = await storage.users.get_person_num(message.from_user.id)
+    if not person_num:
+        await message.answer("Ошибка: дата рождения не найдена.")
+        return
     obj_num = calculate_object_number(message.text.strip())
-    report = read_compatibility_narrative(person_num, obj_num, "car")
-    await message.answer(f"🚗 <b>ГЛУБОКИЙ АНАЛИЗ АВТОМОБИЛЯ</b>\n\n{report}", parse_mode="HTML")
+    report = await COMPATIBILITY.lookup(person_num, obj_num, "car")
+    await send_chunked(message, f"🚗 <b>ГЛУБОКИЙ АНАЛИЗ АВТОМОБИЛЯ</b>\n\n{report}")
     await state.clear()
 
+# =============== БЕНЧМАРК ХРАНИЛИЩА ===============
+async def bench_storage(backend: str, ops: int, concurrency: int, path: str = None, dsn: str = None) -> dict:
+    """Смешанная нагрузка как у живого бота: чтения профиля/статуса, сессии, сохранения, страницы админки"""
+    store = create_storage(backend, path=path or DB_PATH, dsn=dsn)
+    await store.open()
+    try:
+        base = 10 ** 9
+        for user_id in range(base, base + 200):
+            await store.users.save(user_id, f"bench{user_id}", "Bench User", birth_date="14.05.1990")
+        operations = (
+            (40, lambda uid: store.users.get(uid)),
+            (20, lambda uid: store.users.get_status(uid)),
+            (20, lambda uid: store.sessions.touch(uid)),
+            (15, lambda uid: store.users.save(uid, f"bench{uid}", "Bench User", birth_date="14.05.1990")),
+            (5, lambda uid: store.users.page("a")),
+        )
+        weights = [weight for weight, _ in operations]
+        queue = asyncio.Queue()
+        for _ in range(ops):
+            queue.put_nowait(random.choices(operations, weights)[0][1])
+
+        async def worker():
+            while not queue.empty():
+                operation = queue.get_nowait()
+                await operation(base + random.randrange(200))
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+        return {"backend": backend, "ops": ops, "seconds": elapsed, "ops_per_sec": ops / elapsed}
+    finally:
+        await store.close()
+
+async def run_storage_bench(ops: int, concurrency: int, dsn: str = None):
+    backends = [("sqlite", None)]
+    if dsn:
+        backends.append(("postgres", dsn))
+    with tempfile.TemporaryDirectory() as tmp:
+        for backend, backend_dsn in backends:
+            result = await bench_storage(backend, ops, concurrency, os.path.join(tmp, "bench.db"), backend_dsn)
+            print(f"{result['backend']:>8}: {result['ops']} ops in {result['seconds']:.2f}s — {result['ops_per_sec']:.0f} ops/s")
+
+# =============== ВОСПРОИЗВЕДЕНИЕ ТРАФИКА ===============
+class ReplaySession(BaseSession):
+    """Поддельный Bot API для replay: ничего не отправляет, отвечает правдоподобными объектами
+    с задержкой api_latency секунд и считает вызовы по методам"""
+
+    def __init__(self, api_latency: float = 0.0):
+        super().__init__()
+        self.api_latency = api_latency
+        self.calls = defaultdict(int)
+        self._message_ids = iter(range(1, 1 << 62))
+
+    async def close(self):
+        pass
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b""
+
+    def _message(self, method, **extra) -> Message:
+        chat_id = getattr(method, "chat_id", None) or 0
+        return Message(
+            message_id=next(self._message_ids),
+            date=datetime.now(),
+            chat=Chat(id=chat_id if isinstance(chat_id, int) else 0, type="private"),
+            **extra
+        )
+
+    async def make_request(self, bot, method, timeout=None):
+        name = type(method).__name__
+        self.calls[name] += 1
+        if self.api_latency:
+            await asyncio.sleep(self.api_latency)
+        photo = [PhotoSize(file_id=f"replay{next(self._message_ids)}", file_unique_id="replay", width=1, height=1)]
+        if name == "SendMediaGroup":
+            return [self._message(method, photo=photo) for _ in method.media]
+        if name == "SendPhoto":
+            return self._message(method, photo=photo)
+        if name.startswith("Send") or name.startswith("Edit"):
+            return self._message(method, text=getattr(method, "text", None))
+        if name == "GetMe":
+            return User(id=1, is_bot=True, first_name="Replay")
+        return True
+
+async def replay_payment(user_id: int, description: str):
+    """Платёж для replay: в ЮKassa не ходим"""
+    return SimpleNamespace(id=str(uuid.uuid4()), confirmation=SimpleNamespace(confirmation_url="https://example.invalid/pay"))
+
+def replay_label(update: dict) -> str:
+    """Ключ группировки задержек: команда, кнопка, callback_data или просто «текст»"""
+    if "callback_query" in update:
+        return f"callback:{update['callback_query'].get('data', '')}"
+    message = update.get("message") or {}
+    text = message.get("text")
+    if text is None:
+        return "message:other"
+    if text.startswith("/"):
+        return text.split()[0]
+    if not text[:1].isalnum() and len(text) <= 32:
+        return text
+    return "message:text"
+
+async def replay_traffic(path: str, speed: float = 1.0, db_path: str = None, api_latency: float = 0.0, max_gap: float = 5.0) -> Metrics:
+    """Проигрывает записанный трафик через настоящие Dispatcher и router на поддельном Bot API
+    и scratch-базе. speed — ускорение относительно записи (0 — без пауз), паузы длиннее max_gap
+    (перезапуски, ночь) сжимаются. Возвращает задержки обработки по группам."""
+    global storage, create_payment
+    with open(path, encoding="utf-8") as f:
+        records = sorted((json.loads(line) for line in f if line.strip()), key=lambda record: record["ts"])
+    workdir = tempfile.mkdtemp(prefix="replay_")
+    storage = create_storage("sqlite", db_path or os.path.join(workdir, "users.db"))
+    session = ReplaySession(api_latency)
+    session.middleware(OUTBOUND)
+    bot = Bot(token=BOT_TOKEN, session=session)
+    create_payment = replay_payment
+    dp.include_router(router)
+    await storage.open()
+    results = Metrics(window=max(len(records), 1))
+    errors = 0
+
+    async def feed(record: dict, previous: asyncio.Task = None):
+        nonlocal errors
+        # Апдейты одного пользователя идут строго по порядку, как он их и отправлял
+        if previous:
+            await previous
+        update = Update.model_validate(record["update"], context={"bot": bot})
+        label = replay_label(record["update"])
+        started = time.perf_counter()
+        try:
+            await dp.feed_update(bot, update)
+        except Exception as e:
+            errors += 1
+            logger.error(f"Replay of update {update.update_id} failed: {e}")
+        elapsed = (time.perf_counter() - started) * 1000
+        results.observe("all", elapsed)
+        results.observe(label, elapsed)
+        if "ms" in record:
+            results.observe("recorded", record["ms"])
+
+    tasks = []
+    last_by_user = {}
+    started = time.perf_counter()
+    offset = 0.0
+    previous = records[0]["ts"] if records else 0.0
+    try:
+        for record in records:
+            offset += min(record["ts"] - previous, max_gap)
+            previous = record["ts"]
+            if speed > 0:
+                delay = offset / speed - (time.perf_counter() - started)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            event = record["update"].get("message") or record["update"].get("callback_query") or {}
+            user_id = event.get("from", {}).get("id")
+            task = asyncio.create_task(feed(record, last_by_user.get(user_id)))
+            last_by_user[user_id] = task
+            tasks.append(task)
+        await asyncio.gather(*tasks)
+        await ANALYTICS.flush()
+    finally:
+        await storage.close()
+    results.set("updates", len(records))
+    results.set("errors", errors)
+    results.set("wall_s", round(time.perf_counter() - started, 2))
+    for name, count in session.calls.items():
+        results.inc(f"api_{name}", count)
+    for name in ("throttle_limited", "throttle_coalesced"):
+        results.inc(name, METRICS.counters[name])
+    logger.info(f"Replay scratch directory: {workdir}")
+    return results
+
+def format_replay_report(results: Metrics) -> str:
+    lines = [f"Updates: {results.gauges['updates']}, errors: {results.gauges['errors']}, wall: {results.gauges['wall_s']}s"]
+    lines.append(f"{'group':<32} {'n':>6} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}  ms")
+    names = sorted(results.samples, key=lambda name: (name not in ("all", "recorded"), -len(results.samples[name])))
+    for name in names:
+        stats = results.percentiles(name)
+        lines.append(
+            f"{name[:32]:<32} {len(results.samples[name]):>6} "
+            f"{stats['p50']:>8.1f} {stats['p95']:>8.1f} {stats['p99']:>8.1f} {stats['max']:>8.1f}"
+        )
+    lines.extend(f"{name}: {count}" for name, count in sorted(results.counters.items()))
+    return "\n".join(lines)
+
+# =============== БЕНЧМАРК HTTP ===============
+async def fake_bot_api(latency: float) -> web.AppRunner:
+    """Локальный поддельный Bot API: отвечает на sendMessage после задержки latency секунд"""
+    message_ids = iter(range(1, 1 << 62))
+
+    async def send_message(request: web.Request) -> web.Response:
+        form = await request.post()
+        if latency:
+            await asyncio.sleep(latency)
+        return web.json_response({"ok": True, "result": {
+            "message_id": next(message_ids),
+            "date": int(time.time()),
+            "chat": {"id": int(form.get("chat_id", 0)), "type": "private"},
+            "text": form.get("text", ""),
+        }})
+
+    app = web.Application()
+    app.router.add_post("/bot{token}/sendMessage", send_message)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", 0).start()
+    return runner
+
+async def bench_http_session(session: AiohttpSession, requests: int, concurrency: int) -> float:
+    """sendMessage в concurrency потоков; возвращает отправок в секунду"""
+    client = Bot(token="1:bench", session=session)
+    queue = asyncio.Queue()
+    for i in range(requests):
+        queue.put_nowait(i)
+
+    async def worker():
+        while not queue.empty():
+            await client.send_message(queue.get_nowait() % 1000 + 1, "bench")
+
+    try:
+        await client.send_message(1, "warmup")
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        return requests / (time.perf_counter() - started)
+    finally:
+        await session.close()
+
+async def run_http_bench(requests: int, concurrency: int, latency_ms: float):
+    runner = await fake_bot_api(latency_ms / 1000)
+    try:
+        port = runner.addresses[0][1]
+        url = f"http://127.0.0.1:{port}"
+        variants = (
+            ("aiogram default", AiohttpSession(api=TelegramAPIServer.from_base(url))),
+            ("no keep-alive", create_bot_session(url, force_close=True)),
+            ("tuned", create_bot_session(url)),
+        )
+        for name, session in variants:
+            rate = await bench_http_session(session, requests, concurrency)
+            print(f"{name:>16}: {rate:.0f} sends/s ({requests} sends, concurrency {concurrency}, latency {latency_ms:.0f} ms)")
+    finally:
+        await runner.cleanup()
+
 # =============== ЗАПУСК ===============
 async def main():
-    await init_db()
+    bot = Bot(token=BOT_TOKEN, session=create_bot_session())
+    bot.session.middleware(OUTBOUND)
+    await storage.open()
+    await ACTIVITY.load()
+    missing = await asyncio.to_thread(COMPATIBILITY.load)
+    if missing:
+        logger.warning(COMPATIBILITY.validation_report())
     dp.include_router(router)
-    await dp.start_polling(bot)
+    WATCHDOG.start()
+    background = []
+    if BACKUP_INTERVAL_HOURS > 0 and storage.db.dialect == "sqlite":
+        background.append(asyncio.create_task(backup_scheduler()))
+    background.append(asyncio.create_task(recalc_scheduler()))
+    background.append(asyncio.create_task(ANALYTICS.run()))
+    background.append(asyncio.create_task(analytics_scheduler()))
+    background.append(asyncio.create_task(ACTIVITY.run()))
+    if RECORDER:
+        background.append(asyncio.create_task(RECORDER.run()))
+    background.append(asyncio.create_task(resume_broadcast(bot)))
+    try:
+        # Сверх лимита и очереди апдейты не забираются из Telegram — ждут там, а не в памяти.
+        # Сессию закрываем сами: хендлерам в обработке она ещё нужна
+        await dp.start_polling(
+            bot,
+            tasks_concurrency_limit=GOVERNOR_CONCURRENCY + GOVERNOR_MAX_QUEUE,
+            close_bot_session=False
+        )
+    finally:
+        await shutdown(bot, background)
+
+async def shutdown(bot: Bot, background: list, timeout: float = SHUTDOWN_TIMEOUT):
+    """Остановка по шагам (polling к этому моменту уже не принимает апдейты):
+    дождаться хендлеров, остановить фоновые задачи (они сохраняют курсоры),
+    сбросить буферы, закрыть базу и HTTP-сессию"""
+    timings = {}
+    started = step = time.perf_counter()
+
+    def mark(name: str):
+        nonlocal step
+        now = time.perf_counter()
+        timings[name] = now - step
+        step = now
+
+    SHUTDOWN.set()
+    in_flight = len(GOVERNOR.in_flight)
+    cancelled = await GOVERNOR.drain(timeout)
+    mark("handlers")
+    for task in background:
+        task.cancel()
+    await asyncio.gather(*background, return_exceptions=True)
+    WATCHDOG.stop()
+    mark("background")
+    try:
+        await ANALYTICS.flush()
+        await ACTIVITY.flush()
+    except Exception as e:
+        logger.error(f"Analytics flush on shutdown failed: {e}")
+    if RECORDER:
+        try:
+            await RECORDER.flush()
+        except Exception as e:
+            logger.error(f"Traffic flush on shutdown failed: {e}")
+        RECORDER.close()
+    mark("flush")
+    await storage.close()
+    mark("storage")
+    await bot.session.close()
+    mark("session")
+    shutdown_executors()
+    mark("executors")
+    logger.info(
+        f"Shutdown in {time.perf_counter() - started:.2f}s: {in_flight} updates in flight, {cancelled} cancelled; "
+        + ", ".join(f"{name} {seconds:.2f}s" for name, seconds in timings.items())
+    )
+
+def cli():
+    parser = argparse.ArgumentParser(description="Нумерологический бот")
+    commands = parser.add_subparsers(dest="command")
+    export_parser = commands.add_parser("export", help="выгрузить пользователей в сжатый CSV/JSONL")
+    export_parser.add_argument("--format", choices=EXPORT_FORMATS, default="csv")
+    export_parser.add_argument("--output", help="файл выгрузки (по умолчанию users.<format>.gz)")
+    export_parser.add_argument("--db", default=DB_PATH)
+    backup_parser = commands.add_parser("backup", help="сделать онлайн-бэкап базы")
+    backup_parser.add_argument("--dir", default=BACKUP_DIR)
+    backup_parser.add_argument("--no-compress", action="store_true")
+    restore_parser = commands.add_parser("restore", help="восстановить базу из бэкапа (остановите бота)")
+    restore_parser.add_argument("backup")
+    restore_parser.add_argument("--db", default=DB_PATH)
+    bench_parser = commands.add_parser("bench-storage", help="сравнить пропускную способность sqlite и postgres")
+    bench_parser.add_argument("--ops", type=int, default=5000)
+    bench_parser.add_argument("--concurrency", type=int, default=20)
+    bench_parser.add_argument("--dsn", default=DATABASE_URL, help="тестовая база Postgres (без неё — только sqlite)")
+    recalc_parser = commands.add_parser("recalc", help="пересчитать производные поля пользователей")
+    recalc_parser.add_argument("--year", type=int, default=None)
+    recalc_parser.add_argument("--force", action="store_true", help="с начала, даже если год уже посчитан")
+    commands.add_parser("check-compat", help="проверить, что все тексты совместимости на месте")
+    http_parser = commands.add_parser("bench-http", help="пропускная способность HTTP-сессии на локальном поддельном Bot API")
+    http_parser.add_argument("--requests", type=int, default=3000)
+    http_parser.add_argument("--concurrency", type=int, default=50)
+    http_parser.add_argument("--latency-ms", type=float, default=20.0, help="задержка ответа поддельного сервера")
+    replay_parser = commands.add_parser("replay", help="проиграть записанный трафик (TRAFFIC_LOG) и показать задержки")
+    replay_parser.add_argument("traffic", nargs="?", default=TRAFFIC_LOG or "traffic.jsonl")
+    replay_parser.add_argument("--speed", type=float, default=1.0, help="ускорение относительно записи, 0 — без пауз")
+    replay_parser.add_argument("--db", default=None, help="scratch-база (по умолчанию пустая во временном каталоге)")
+    replay_parser.add_argument("--api-latency", type=float, default=0.0, help="задержка поддельного Bot API, мс")
+    replay_parser.add_argument("--max-gap", type=float, default=5.0, help="сжимать паузы длиннее, сек")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        output = args.output or f"users.{args.format}.gz"
+        count = export_users(output, args.format, args.db)
+        print(f"Exported {count} users to {output}")
+    elif args.command == "backup":
+        print(f"Backup written to {backup_database(args.dir, not args.no_compress)}")
+    elif args.command == "restore":
+        restore_database(args.backup, args.db)
+        print(f"Restored {args.db} from {args.backup} (previous copy: {args.db}.before_restore)")
+    elif args.command == "recalc":
+        year = args.year or numerology_year()
+        print(f"Recalculated {asyncio.run(recalc_once(year, args.force))} users for {year}")
+    elif args.command == "check-compat":
+        missing = COMPATIBILITY.load()
+        print(COMPATIBILITY.validation_report())
+        sys.exit(1 if missing else 0)
+    elif args.command == "replay":
+        if args.db and os.path.abspath(args.db) == os.path.abspath(DB_PATH):
+            parser.error("replay пишет в базу — укажите копию, а не рабочую users.db")
+        results = asyncio.run(replay_traffic(args.traffic, args.speed, args.db, args.api_latency / 1000, args.max_gap))
+        print(format_replay_report(results))
+    elif args.command == "bench-http":
+        asyncio.run(run_http_bench(args.requests, args.concurrency, args.latency_ms))
+    elif args.command == "bench-storage":
+        asyncio.run(run_storage_bench(args.ops, args.concurrency, args.dsn))
+    else:
+        asyncio.run(main())
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    cli()
\ No newline at end of file
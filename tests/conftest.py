@@ -0,0 +1,6 @@
+import os
+import sys
+
+# bot.py читает настройки при импорте; токен нужен только формально
+os.environ.setdefault("BOT_TOKEN", "1:test")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,53 @@
+import math
+import random
+
+import pytest
+
+import bot
+
+PRECISION = 14
+SIGMA = 1.04 / math.sqrt(1 << PRECISION)
+
+
+def sketch(ids) -> "bot.HyperLogLog":
+    hll = bot.HyperLogLog(PRECISION)
+    for user_id in ids:
+        hll.add(user_id)
+    return hll
+
+
+@pytest.mark.parametrize("ids", [
+    range(1, 100_001),
+    random.Random(45).sample(range(10 ** 6, 8 * 10 ** 9), 100_000),
+], ids=["sequential", "random"])
+def test_estimate_within_three_sigma(ids):
+    hll = sketch(ids)
+    estimate = hll.count()
+    for user_id in list(ids)[:1000]:
+        hll.add(user_id)
+    # Повторы не меняют оценку
+    assert hll.count() == estimate
+    assert abs(estimate - 100_000) / 100_000 < 3 * SIGMA
+
+
+def test_small_counts_use_linear_counting():
+    assert sketch([]).count() == 0
+    assert abs(sketch(range(1, 1001)).count() - 1000) <= 10
+
+
+def test_merge_equals_sketch_of_union():
+    left, right = sketch(range(1, 60_001)), sketch(range(40_001, 100_001))
+    merged = left.merge(right)
+    assert merged.registers == sketch(range(1, 100_001)).registers
+    assert abs(merged.count() - 100_000) / 100_000 < 3 * SIGMA
+    # Объединение не трогает исходные скетчи
+    assert left.count() < merged.count() and right.count() < merged.count()
+
+
+def test_serialization_roundtrip():
+    hll = sketch(range(1, 20_001))
+    restored = bot.HyperLogLog(PRECISION, bytes(hll.registers))
+    assert restored.registers == hll.registers
+    assert restored.count() == hll.count()
+    restored.add(10 ** 12)
+    assert restored.registers != hll.registers
@@ -0,0 +1,64 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+from aiogram.types import Update
+
+import bot
+
+
+def update(update_id: int) -> Update:
+    return Update.model_validate({"update_id": update_id})
+
+
+async def dispatch(governor, update_id: int, rate_limit: str, work: float, done: list):
+    """Апдейт проходит оба уровня, как в диспетчере: внешний middleware, затем middleware router"""
+    user = SimpleNamespace(id=1000 + update_id)
+
+    async def run_handler(event, data):
+        await asyncio.sleep(work)
+        done.append((update_id, time.perf_counter()))
+
+    async def route(event, data):
+        handler_data = {"event_from_user": user, "handler": SimpleNamespace(flags={"rate_limit": rate_limit})}
+        return await governor(run_handler, object(), handler_data)
+
+    return await governor(route, update(update_id), {"event_from_user": user})
+
+
+def test_waiting_for_handler_limit_frees_global_slot():
+    async def scenario():
+        governor = bot.ConcurrencyGovernor(4, {"report": 1}, max_queue=100, max_wait=10)
+        done = []
+        reports = [asyncio.create_task(dispatch(governor, i, "report", 0.2, done)) for i in range(10)]
+        await asyncio.sleep(0.05)
+        started = time.perf_counter()
+        await dispatch(governor, 99, "default", 0, done)
+        start_latency = time.perf_counter() - started
+        await asyncio.gather(*reports)
+        return governor, done, start_latency
+
+    governor, done, start_latency = asyncio.run(scenario())
+    # /start не стоит в очереди за тяжёлыми хендлерами
+    assert start_latency < 0.1
+    assert len(done) == 11
+    # После всех апдейтов слоты и счётчики вернулись в исходное состояние
+    assert governor.total.active == 0 and not governor.total.semaphore.locked()
+    assert governor.handlers["report"].active == 0 and governor.handlers["report"].waiting == 0
+
+
+def test_cancelled_waiter_does_not_leak_global_slot():
+    async def scenario():
+        governor = bot.ConcurrencyGovernor(2, {"report": 1}, max_queue=100, max_wait=10)
+        done = []
+        running = asyncio.create_task(dispatch(governor, 1, "report", 0.2, done))
+        waiting = asyncio.create_task(dispatch(governor, 2, "report", 0.2, done))
+        await asyncio.sleep(0.05)
+        waiting.cancel()
+        await asyncio.gather(running, waiting, return_exceptions=True)
+        return governor, done
+
+    governor, done = asyncio.run(scenario())
+    assert [update_id for update_id, _ in done] == [1]
+    assert governor.total.active == 0
+    assert governor.total.semaphore._value == 2
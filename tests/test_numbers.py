@@ -0,0 +1,97 @@
+"""Табличные расчёты (bytes.translate) против прежней посимвольной реализации"""
+import random
+
+import pytest
+
+import bot
+
+ALPHABET = (
+    "абвгдеёжзийклмнопрстуфхцчшщъыьэюя"
+    "АБВГДЕЁЖЗИЙКЛМНОПРСТУФХЦЧШЩЪЫЬЭЮЯ"
+    "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+    "0123456789"
+    " -'.,№/"
+)
+UNICODE_DIGITS = "３٣७０"
+
+
+def old_reduce_number(n: int) -> int:
+    while n >= 10:
+        n = sum(int(d) for d in str(n))
+    return n if n != 0 else 9
+
+
+def old_name_to_number(name: str, use_vowels: bool = None) -> int:
+    name = name.upper().replace(" ", "")
+    total = 0
+    for char in name:
+        if char in bot.LETTER_VALUES:
+            is_vowel = char in bot.VOWELS
+            if use_vowels is None or is_vowel == use_vowels:
+                total += bot.LETTER_VALUES[char]
+    return old_reduce_number(total)
+
+
+def old_object_number(text: str) -> int:
+    total = 0
+    for char in text.upper():
+        if char.isdigit():
+            total += int(char)
+        elif char in bot.LETTER_VALUES:
+            total += bot.LETTER_VALUES[char]
+    return old_reduce_number(total)
+
+
+def random_texts(alphabet: str, count: int = 3000, seed: int = 40) -> list:
+    rng = random.Random(seed)
+    texts = ["", " ", "Ё", "ё", "Анна-Мария", "Петров Иван Сергеевич", "John Smith", "А123БВ777", "72", "15а", "0"]
+    texts += ["".join(rng.choice(alphabet) for _ in range(rng.randint(1, 40))) for _ in range(count)]
+    return texts
+
+
+def test_reduce_number_matches_digit_loop():
+    for n in range(0, 20000):
+        assert bot.reduce_number(n) == old_reduce_number(n), n
+    for n in (99999, 10 ** 12 + 7, 2 ** 40):
+        assert bot.reduce_number(n) == old_reduce_number(n), n
+
+
+def test_name_numbers_match_per_character():
+    names = random_texts(ALPHABET)
+    expected = [(old_name_to_number(name, True), old_name_to_number(name, False)) for name in names]
+    assert [bot.name_numbers(name) for name in names] == expected
+    assert bot.name_numbers_batch(names) == expected
+    for name in names[:500]:
+        for use_vowels in (None, True, False):
+            assert bot.name_to_number(name, use_vowels) == old_name_to_number(name, use_vowels), name
+
+
+def test_object_numbers_match_per_character():
+    texts = random_texts(ALPHABET + UNICODE_DIGITS)
+    expected = [old_object_number(text) for text in texts]
+    assert [bot.calculate_object_number(text) for text in texts] == expected
+    assert bot.object_numbers_batch(texts) == expected
+
+
+def test_batches_keep_separator_out_of_names():
+    assert bot.name_numbers_batch(["Анна\0Петрова", "Иван"]) == [bot.name_numbers("АннаПетрова"), bot.name_numbers("Иван")]
+    assert bot.name_numbers_batch([]) == []
+    assert bot.object_numbers_batch([]) == []
+
+
+@pytest.mark.parametrize("text, value", [
+    ("３", 3),        # полноширинная цифра — как int("３")
+    ("٣", 3),         # арабско-индийская цифра
+    ("А１２", 4),
+    ("१२३", 6),       # деванагари
+])
+def test_unicode_decimal_digits_count_as_digits(text, value):
+    assert bot.calculate_object_number(text) == old_object_number(text) == value
+    assert bot.object_numbers_batch([text, "1"]) == [value, 1]
+
+
+def test_superscript_digits_are_ignored():
+    # isdigit() у "²" истинно, но int("²") падает — прежняя реализация не считала такие номера вовсе
+    with pytest.raises(ValueError):
+        old_object_number("15²")
+    assert bot.calculate_object_number("15²") == bot.calculate_object_number("15") == 6
@@ -0,0 +1,45 @@
+import asyncio
+
+import bot
+
+USERS = 50
+
+
+async def redeem_concurrently(path: str):
+    storage = bot.create_storage("sqlite", path=path)
+    await storage.open()
+    try:
+        code = await storage.promos.create()
+        for user_id in range(1, USERS + 1):
+            await storage.users.register(user_id, f"user{user_id}", f"User {user_id}")
+        results = await asyncio.gather(*(storage.promos.redeem(code, user_id) for user_id in range(1, USERS + 1)))
+        used_by = await storage.db.fetchall("SELECT used_by FROM premium_codes WHERE code = ?", (code,))
+        paid = await storage.db.fetchval("SELECT COUNT(*) FROM users WHERE status = 'paid'")
+        unlocked = await storage.db.fetchval(
+            "SELECT COUNT(*) FROM user_achievements WHERE achievement_id = 'premium_seeker'"
+        )
+        return results, used_by, paid, unlocked
+    finally:
+        await storage.close()
+
+
+def test_redeem_is_exactly_once(tmp_path):
+    results, used_by, paid, unlocked = asyncio.run(redeem_concurrently(str(tmp_path / "users.db")))
+    assert results.count("ok") == 1
+    assert results.count("used") == USERS - 1
+    winner = results.index("ok") + 1
+    assert used_by == [(winner,)]
+    assert paid == 1
+    assert unlocked == 1
+
+
+def test_redeem_unknown_code(tmp_path):
+    async def run():
+        storage = bot.create_storage("sqlite", path=str(tmp_path / "users.db"))
+        await storage.open()
+        try:
+            return await storage.promos.redeem("NOSUCHCODE", 1)
+        finally:
+            await storage.close()
+
+    assert asyncio.run(run()) == "not_found"
@@ -0,0 +1,21 @@
+import itertools
+from collections import defaultdict
+
+import bot
+
+BIRTH_DATES = [f"{d:02d}.{m:02d}.{y}" for d, m, y in itertools.product(range(1, 29), range(1, 13), (1984, 1991))]
+
+
+def test_report_keys_are_shared_and_sound():
+    """Один ключ — один и тот же текст; разные даты рождения и имена делят ключ"""
+    for kind in ("free", "full"):
+        reports = defaultdict(set)
+        for birth_date, full_name in zip(BIRTH_DATES, itertools.cycle(["Анна Петрова", "Ivan Smirnov", "Ольга"])):
+            profile, matrix_data = bot.compute_report_data(birth_date, full_name, 2026)
+            if kind == "free":
+                key, text = bot.report_flight_key("free", profile), bot.generate_free_report(profile)
+            else:
+                key, text = bot.report_flight_key("full", profile, matrix_data), bot.generate_full_report(profile, matrix_data)
+            reports[key].add(text)
+        assert all(len(texts) == 1 for texts in reports.values()), kind
+        assert len(reports) < len(BIRTH_DATES), kind
@@ -0,0 +1,334 @@
+"""Один и тот же набор проверок репозиториев для обоих бэкендов хранилища.
+
+Postgres проверяется, если установлен asyncpg и задан TEST_DATABASE_URL; каждый тест
+работает в своей временной схеме и удаляет её за собой.
+"""
+import asyncio
+import os
+import sqlite3
+import uuid
+from datetime import date
+
+import pytest
+
+import bot
+
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL", "")
+
+BIRTH_DATES = ["01.02.1990", "13.07.1985", "29.11.2001", "05.05.1975", "16.03.1968", "19.09.1999"]
+
+
+async def _postgres_schema(sql: str):
+    import asyncpg
+
+    conn = await asyncpg.connect(TEST_DATABASE_URL)
+    try:
+        await conn.execute(sql)
+    finally:
+        await conn.close()
+
+
+@pytest.fixture(params=["sqlite", "postgres"])
+def storage(request, tmp_path):
+    if request.param == "sqlite":
+        yield bot.create_storage("sqlite", path=str(tmp_path / "users.db"))
+        return
+    pytest.importorskip("asyncpg")
+    if not TEST_DATABASE_URL:
+        pytest.skip("TEST_DATABASE_URL не задан")
+    schema = f"test_{uuid.uuid4().hex[:12]}"
+    asyncio.run(_postgres_schema(f"CREATE SCHEMA {schema}"))
+    # Неизвестные параметры DSN asyncpg передаёт серверу как настройки сессии
+    dsn = f"{TEST_DATABASE_URL}{'&' if '?' in TEST_DATABASE_URL else '?'}search_path={schema}"
+    try:
+        yield bot.create_storage("postgres", dsn=dsn)
+    finally:
+        asyncio.run(_postgres_schema(f"DROP SCHEMA {schema} CASCADE"))
+
+
+def run(storage, scenario):
+    async def main():
+        await storage.open()
+        try:
+            return await scenario(storage)
+        finally:
+            await storage.close()
+
+    return asyncio.run(main())
+
+
+def test_register_keeps_entered_data(storage):
+    async def scenario(s):
+        first = await s.users.register(1, "alice", "Alice Telegram")
+        await s.users.save(1, "alice", "Анна Петрова", birth_date="01.02.1990", archetype="🎨 Создатель")
+        again = await s.users.register(1, "alice_new", "Other Name")
+        return first, again, await s.users.get(1), await s.users.get_person_num(1), await s.users.has_data(1)
+
+    first, again, user, person_num, has_data = run(storage, scenario)
+    assert first == (False, "free")
+    assert again == (True, "free")
+    assert user == {
+        "username": "alice_new",
+        "full_name": "Анна Петрова",
+        "birth_date": "01.02.1990",
+        "status": "free",
+        "archetype": "🎨 Создатель",
+    }
+    assert person_num == bot.person_number("01.02.1990")
+    assert has_data
+
+
+def test_person_num_falls_back_to_birth_date(storage):
+    async def scenario(s):
+        # Пользователь из базы до колонки person_num, ещё не пересчитанный
+        await s.db.execute("INSERT INTO users (user_id, birth_date) VALUES (?, ?)", (1, BIRTH_DATES[1]))
+        await s.users.register(2, "b", "B")
+        return await s.users.get_person_num(1), await s.users.get_person_num(2), await s.users.get_person_num(3)
+
+    assert run(storage, scenario) == (bot.person_number(BIRTH_DATES[1]), None, None)
+
+
+def test_start_session_counts_sessions(storage):
+    async def scenario(s):
+        await s.start_session(7, "bob", "Bob")
+        result = await s.start_session(7, "bob", "Bob")
+        stats = await s.sessions.stats(7)
+        progress = await s.db.fetchval("SELECT total_sessions FROM user_progress WHERE user_id = ?", (7,))
+        return result, stats[0], progress
+
+    assert run(storage, scenario) == ((False, "free"), 2, 2)
+
+
+def test_transaction_rolls_back(storage):
+    async def scenario(s):
+        await s.users.register(3, "carol", "Carol")
+        with pytest.raises(RuntimeError):
+            async with s.db.transaction() as tx:
+                await s.users.set_status(3, "paid", tx)
+                await s.achievements.unlock(3, "premium_seeker", tx)
+                raise RuntimeError("boom")
+        unlocked = await s.db.fetchval("SELECT COUNT(*) FROM user_achievements WHERE user_id = ?", (3,))
+        return await s.users.get_status(3), unlocked
+
+    assert run(storage, scenario) == ("free", 0)
+
+
+def test_promo_redeem_outcomes(storage):
+    async def scenario(s):
+        await s.users.register(10, "u10", "U10")
+        await s.users.register(11, "u11", "U11")
+        code = await s.promos.create()
+        results = [
+            await s.promos.redeem(code, 10),
+            await s.promos.redeem(code, 11),
+            await s.promos.redeem("MATRIX-NOP-NOP-NOP", 11),
+        ]
+        return results, await s.users.get_status(10), await s.users.get_status(11), await s.promos.count_unused()
+
+    assert run(storage, scenario) == (["ok", "used", "not_found"], "paid", "free", 0)
+
+
+def test_promo_batch_pages(storage):
+    async def scenario(s):
+        codes = await s.promos.create_batch(25, "batch-1")
+        seen, cursor = [], None
+        while True:
+            rows, has_more = await s.promos.page("f", "n", cursor, limit=10)
+            seen.extend(row[0] for row in rows)
+            if not has_more:
+                break
+            cursor = (rows[-1][1], rows[-1][0])
+        back, _ = await s.promos.page("f", "p", (rows[0][1], rows[0][0]), limit=10)
+        return codes, seen, back, await s.promos.count_unused()
+
+    codes, seen, back, unused = run(storage, scenario)
+    assert len(codes) == len(set(codes)) == 25
+    assert sorted(seen) == codes
+    assert [row[0] for row in back] == seen[10:20]
+    assert unused == 25
+
+
+def test_user_pages_and_search(storage):
+    async def scenario(s):
+        for user_id in range(1, 13):
+            await s.users.register(user_id, f"User{user_id}", f"User {user_id}")
+        await s.users.set_status(5, "paid")
+        first, more = await s.users.page("a", limit=10)
+        rest, last = await s.users.page("a", "n", first[-1][0], limit=10)
+        paid, _ = await s.users.page("p")
+        return first, more, rest, last, paid, await s.users.search("@user7"), await s.users.search("12")
+
+    first, more, rest, last, paid, by_name, by_id = run(storage, scenario)
+    assert [row[0] for row in first] == list(range(12, 2, -1)) and more
+    assert [row[0] for row in rest] == [2, 1] and not last
+    assert [row[0] for row in paid] == [5]
+    assert by_name == [(7, "User7", "User 7", "free")]
+    assert by_id == [(12, "User12", "User 12", "free")]
+
+
+def test_segments_match_derived_fields(storage):
+    year = bot.numerology_year()
+    people = [(user_id, birth_date, "Иван Петров") for user_id, birth_date in enumerate(BIRTH_DATES, 1)]
+
+    async def scenario(s):
+        for user_id, birth_date, full_name in people:
+            await s.users.save(user_id, f"u{user_id}", full_name, birth_date=birth_date)
+        await s.users.set_status(2, "paid")
+        segments = {}
+        for spec in ("mind=1", "karmic=13", "karmic=19 status=free", "status=paid"):
+            segments[spec] = (await s.users.segment_count(spec), await s.users.segment_ids(spec))
+        return segments
+
+    derived = {user_id: dict(zip(bot.DERIVED_FIELDS, bot.derive_fields(birth_date, full_name, year)))
+               for user_id, birth_date, full_name in people}
+    expected = {
+        "mind=1": [u for u, f in derived.items() if f["mind"] == 1],
+        "karmic=13": [u for u, f in derived.items() if f["karmic_mask"] & 1],
+        "karmic=19 status=free": [u for u, f in derived.items() if f["karmic_mask"] & 8 and u != 2],
+        "status=paid": [2],
+    }
+    for spec, (count, ids) in run(storage, scenario).items():
+        assert ids == expected[spec], spec
+        assert count == len(ids), spec
+
+
+def test_recalculation_skips_rows_changed_since_read(storage):
+    year = bot.numerology_year()
+
+    async def scenario(s):
+        await s.users.save(1, "u1", "Иван Петров", birth_date=BIRTH_DATES[0])
+        await s.users.save(2, "u2", None, birth_date=BIRTH_DATES[1])
+        stale = await s.users.birth_dates_after(0, 10)
+        # Пользователь 1 ввёл новые данные, пока пачка считалась
+        await s.users.save(1, "u1", "Анна Петрова", birth_date=BIRTH_DATES[2])
+        await s.users.update_derived(bot.derive_fields_batch(stale, year + 1))
+        return await s.db.fetchall(
+            "SELECT person_num, matrix_mask, soul_urge, personal_year, profile_year FROM users ORDER BY user_id"
+        )
+
+    def expected(birth_date, full_name, profile_year):
+        fields = dict(zip(bot.DERIVED_FIELDS, bot.derive_fields(birth_date, full_name, profile_year)))
+        return (fields["person_num"], fields["matrix_mask"], fields["soul_urge"], fields["personal_year"], profile_year)
+
+    fresh, recalculated = run(storage, scenario)
+    assert tuple(fresh) == expected(BIRTH_DATES[2], "Анна Петрова", year)
+    assert tuple(recalculated) == expected(BIRTH_DATES[1], None, year + 1)
+
+
+def test_job_state_roundtrip(storage):
+    async def scenario(s):
+        missing = await s.jobs.get("job")
+        await s.jobs.save("job", "2026/v2", 10, "running")
+        await s.jobs.save("job", "2026/v2", 20, "done")
+        return missing, await s.jobs.get("job")
+
+    assert run(storage, scenario) == (None, {"target": "2026/v2", "cursor": 20, "status": "done"})
+
+
+def test_job_claim_refuses_busy_job(storage):
+    async def scenario(s):
+        results = [await s.jobs.claim("broadcast", "first")]
+        results.append(await s.jobs.claim("broadcast", "second"))
+        await s.jobs.save("broadcast", "first", 500, "paused")
+        results.append(await s.jobs.claim("broadcast", "second"))
+        kept = await s.jobs.get("broadcast")
+        await s.jobs.save("broadcast", "first", 900, "done")
+        results.append(await s.jobs.claim("broadcast", "second"))
+        return results, kept, await s.jobs.get("broadcast")
+
+    results, kept, claimed = run(storage, scenario)
+    assert results == [True, False, False, True]
+    assert kept == {"target": "first", "cursor": 500, "status": "paused"}
+    assert claimed == {"target": "second", "cursor": 0, "status": "running"}
+
+
+def test_events_rollup(storage):
+    today = date.today().isoformat()
+
+    async def scenario(s):
+        await s.users.register(1, "a", "A")
+        await s.users.register(2, "b", "B")
+        now = bot.utc_now()
+        await s.events.append([
+            (today, now, 1, "start"), (today, now, 1, "start"), (today, now, 2, "start"), (today, now, 2, "buy"),
+        ])
+        await s.events.rollup_day(today, 30)
+        await s.events.rollup_day(today, 30)
+        return await s.events.first_day(), await s.events.totals(today), await s.events.daily("start", today)
+
+    first_day, totals, daily = run(storage, scenario)
+    assert first_day == today
+    assert totals["start"] == (3, 2)
+    assert totals["buy"] == (1, 1)
+    assert totals["active"] == (4, 2)
+    assert totals["new"] == (2, 2)
+    assert daily == [(today, 2)]
+
+
+def test_sketches_roundtrip(storage):
+    registers = bytes(range(256)) * 4
+
+    async def scenario(s):
+        await s.sketches.save([("2026-01-01", b"\x00" * 16), ("2026-01-02", registers)])
+        await s.sketches.save([("2026-01-02", registers[::-1])])
+        await s.sketches.prune("2026-01-02")
+        return await s.sketches.load("2026-01-01")
+
+    rows = run(storage, scenario)
+    assert [(day, bytes(data)) for day, data in rows] == [("2026-01-02", registers[::-1])]
+
+
+def test_postgres_widens_integer_matrix_mask(storage):
+    if storage.db.dialect != "postgres":
+        pytest.skip("миграция типа колонки только для Postgres")
+
+    async def scenario(s):
+        # База из версии, где колонка была INTEGER
+        await s.db.execute("ALTER TABLE users ALTER COLUMN matrix_mask TYPE INTEGER")
+        await s.close()
+        await s.open()
+        await s.users.save(1, "a", "Анна", birth_date="19.09.1999")
+        return await s.db.fetchval(
+            """SELECT data_type FROM information_schema.columns
+            WHERE table_schema = current_schema() AND table_name = 'users' AND column_name = 'matrix_mask'"""
+        ), await s.db.fetchval("SELECT matrix_mask FROM users WHERE user_id = ?", (1,))
+
+    data_type, mask = run(storage, scenario)
+    assert data_type == "bigint"
+    assert mask == dict(zip(bot.DERIVED_FIELDS, bot.derive_fields("19.09.1999", "Анна", 2026)))["matrix_mask"]
+
+
+def test_cancelled_begin_does_not_leak_transaction(tmp_path):
+    """Отмена во время BEGIN: BEGIN всё равно выполняется в потоке aiosqlite,
+    соединение не должно вернуться в пул с открытой транзакцией."""
+    path = str(tmp_path / "users.db")
+    storage = bot.create_storage("sqlite", path=path)
+
+    async def scenario(s):
+        await s.users.register(1, "a", "A")
+        blocker = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        blocker.execute("BEGIN IMMEDIATE")
+
+        async def write():
+            async with s.db.transaction() as tx:
+                await s.users.set_status(1, "paid", tx)
+
+        task = asyncio.create_task(write())
+        await asyncio.sleep(0.2)
+        task.cancel()
+        await asyncio.sleep(0.1)
+        blocker.execute("COMMIT")
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        # Каждое соединение пула пишет в автокоммите, и запись видна снаружи
+        for user_id in range(100, 100 + bot.DB_POOL_SIZE):
+            await s.users.register(user_id, "x", "X")
+        leaked = [conn for conn in s.db._connections if conn.in_transaction]
+        visible = blocker.execute("SELECT COUNT(*) FROM users WHERE user_id >= 100").fetchone()[0]
+        blocker.close()
+        return leaked, visible, await s.users.get_status(1)
+
+    leaked, visible, status = run(storage, scenario)
+    assert leaked == []
+    assert visible == bot.DB_POOL_SIZE
+    assert status == "free"